@@ -10,25 +10,40 @@ urlpatterns = [
     path('buildings', views.college.BuildingList.as_view(), name="buildings"),
     path('places', views.college.PlaceList.as_view(), name="places"),
     path('rooms', views.college.RoomList.as_view(), name="rooms"),
+    path('rooms/free', views.college.FreeRoomList.as_view(), name="free_rooms"),
+    path('rooms/utilization', views.college.RoomUtilization.as_view(), name="room_utilization"),
+    path('room/<int:room_id>/calendar.ics', views.calendar.room_calendar_feed, name="room_calendar_feed"),
+    path('room/<int:room_id>/occurrences', views.college.RoomOccurrences.as_view(), name="room_occurrences"),
+    path('room/<int:room_id>/schedule/layout', views.calendar.room_schedule_layout, name="room_schedule_layout"),
     path('building/<int:building_id>/', views.college.Building.as_view(), name="building"),
     path('building/<int:building_id>/rooms', views.calendar.building_schedule_rooms_view,
          name="building_schedule_rooms"),
     path('building/<int:building_id>/schedule', views.calendar.building_schedule_shifts_view, name="building_schedule"),
+    path('building/<int:building_id>/occupation', views.calendar.building_occupation_view,
+         name="building_occupation"),
     path('departments', views.college.DepartmentList.as_view(), name="departments"),
     path('department/<int:department_id>/', views.college.DepartmentDetailed.as_view(), name="department"),
     path('classes', views.college.ClassList.as_view(), name="classes"),
     path('courses', views.college.CoursesList.as_view(), name="courses"),
     path('course/<int:course_id>/', views.college.CourseDetailed.as_view(), name="course"),
+    path('course/<int:course_id>/schedule', views.college.CourseSchedule.as_view(), name="course_schedule"),
     path('class/<int:class_id>/', views.college.Class.as_view(), name="class"),
     path('class/i/<int:instance_id>/', views.college.ClassInstance.as_view(), name="class_instance"),
     path('class/i/<int:instance_id>/shifts', views.college.ClassInstanceShifts.as_view(),
          name="class_instance_shifts"),
     path('class/i/<int:instance_id>/files', views.college.ClassFiles.as_view(), name="class_instance_files"),
     path('class/i/<int:instance_id>/schedule', views.calendar.class_instance_schedule, name="class_instance_schedule"),
+    path('class/i/<int:instance_id>/schedule/layout', views.calendar.class_instance_schedule_layout,
+         name="class_instance_schedule_layout"),
+    path('class/i/<int:instance_id>/conflicts', views.college.ClassInstanceConflicts.as_view(),
+         name="class_instance_conflicts"),
+    path('class/i/<int:instance_id>/calendar.ics', views.calendar.class_instance_calendar_feed,
+         name="class_instance_calendar_feed"),
     path('shift/<int:shift_id>', views.college.Shift.as_view(), name="shift"),
     path('enrollment/<int:enrollment_id>', views.college.Enrollment.as_view(), name="enrollment"),
     path('teacher/<int:teacher_id>/', views.college.Teacher.as_view(), name="teacher"),
     path('student/<int:student_id>/', views.college.Student.as_view(), name="student"),
+    path('student/<int:student_id>/conflicts', views.college.StudentConflicts.as_view(), name="student_conflicts"),
     path('teacher/<int:teacher_id>/schedule', views.calendar.teacher_schedule, name="teacher_schedule"),
 
     # Chat
@@ -43,6 +58,7 @@ urlpatterns = [
     path('groups/', views.groups.GroupList.as_view(), name="groups"),
     path('group/<int:group_id>/', views.groups.Group.as_view(), name="group_activities"),
     path('group/<str:abbr>/calendar', views.calendar.group_calendar, name='group_calendar'),
+    path('group/<str:abbr>/calendar.ics', views.calendar.group_calendar_feed, name='group_calendar_feed'),
     path('group/<str:abbr>/subscribe', views.groups.GroupSubscription.as_view(), name='group_subscription'),
     path('group/<str:abbr>/membership', views.groups.GroupMembershipRequest.as_view(), name='group_membership_request'),
     # News
@@ -79,6 +95,7 @@ urlpatterns = [
     path('profile/<str:nickname>/external_pages', views.users.UserExternalPages.as_view(), name='user_external_pages'),
     path('user/<str:nickname>/current_shifts', views.college.UserShiftInstances.as_view()),
     path('user/<str:nickname>/calendar', views.calendar.user_calendar, name='user_calendar'),
+    path('user/<str:nickname>/calendar.ics', views.calendar.user_calendar_feed, name='user_calendar_feed'),
     path('user/<str:nickname>/schedule', views.calendar.user_schedule, name='user_schedule'),
     path('notification/count', views.users.notification_count_view, name='notification_count'),
     path('notification/list', views.users.UserNotificationList.as_view(), name='notification_list'),
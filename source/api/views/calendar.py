@@ -1,20 +1,24 @@
 import datetime
 
-from django.core.cache import cache
+from django.conf import settings
+from django.db.models import Max
+from django.http import StreamingHttpResponse, Http404
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.exceptions import PermissionDenied
+from rest_framework.exceptions import PermissionDenied, ValidationError
 from rest_framework.generics import get_object_or_404
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 
 from api import permissions
 from college.choice_types import RoomType
-from users.utils import get_students
 from users import models as users
-from college import models as college
+from college import models as college, occupation, schedules
 from groups import models as groups
 from api.serializers import college as college_serializer
+from supernova import calendars, ics
 
 
 @api_view(['GET'])
@@ -25,132 +29,55 @@ def user_schedule(request, nickname):
     :param nickname: User nickname
     :return: Response with the current and historical events
     """
-    cache_key = f'user_{nickname}_schedule'
-    user_schedule = cache.get(cache_key)
-    if user_schedule is None:
-        user = get_object_or_404(users.User.objects.prefetch_related('students', 'groups_custom'), nickname=nickname)
-    else:
-        user = get_object_or_404(users.User, nickname=nickname)
+    user = get_object_or_404(users.User, nickname=nickname)
 
     permissions = user.profile_permissions_for(request.user)
     if not permissions['schedule_visibility']:
         raise PermissionDenied(detail=f'{request.user.nickname} atempted to view {user.nickname} schedule.')
 
-    if user_schedule:
-        return Response(user_schedule)
-
-    primary_students, _ = get_students(user)
-    user_groups = user.groups_custom.all()
-    schedule_entries = []
-
-    today = datetime.date.today()
-    period_instances = college.PeriodInstance.objects.filter(date_from__lte=today, date_to__gte=today)
-    shift_instances = college.ShiftInstance.objects \
-        .select_related('shift__class_instance__parent') \
-        .prefetch_related('room__building') \
-        .filter(shift__student__in=primary_students,
-                shift__class_instance__period_instance__in=period_instances) \
-        .all()
-    for instance in shift_instances:
-        schedule_entries.append({
-            'type': instance.shift.type_abbreviation,
-            'title': instance.title,
-            'weekday': instance.weekday,
-            'time': instance.start_str,
-            'duration': instance.duration,
-            'url': instance.shift.get_absolute_url(),
-        })
-
-    own_periodic_schedule_entries = users.SchedulePeriodic.objects.filter(user=user)
-    for entry in own_periodic_schedule_entries:
-        schedule_entries.append({
-            'type': 'U',
-            'title': entry.title,
-            'weekday': entry.weekday,
-            'time': entry.time,
-            'duration': entry.duration,
-            'start': entry.start_date,
-            'end': entry.end_date,
-        })
-
-    group_periodic_schedule_entries = groups.SchedulePeriodic.objects.filter(group__in=user_groups)
-    for entry in group_periodic_schedule_entries:
-        schedule_entries.append({
-            'type': 'G',
-            'title': entry.title,
-            'weekday': entry.weekday,
-            'time': entry.time,
-            'duration': entry.duration,
-            'start': entry.start_date,
-            'end': entry.end_date,
-        })
-
-    cache.set(cache_key, schedule_entries, timeout=60 * 60)
-    return Response(schedule_entries)
+    return Response(calendars.user_schedule(user))
 
 
 @api_view(['GET'])
 @permission_classes((IsAuthenticated,))
 def class_instance_schedule(request, instance_id):
-    cache_key = f'class_instance_{instance_id}_schedule'
-    instance_schedule = cache.get(cache_key)
-
-    if instance_schedule:
-        return Response(instance_schedule)
-
     instance = get_object_or_404(college.ClassInstance, id=instance_id)
-
-    schedule_entries = []
-    shift_instances = college.ShiftInstance.objects \
-        .select_related('shift__class_instance') \
-        .filter(shift__class_instance=instance) \
-        .all()
-
-    for instance in shift_instances:
-        schedule_entries.append({
-            'type': instance.shift.type_abbreviation,
-            'title': f"{instance.shift.long_abbreviation}",
-            'weekday': instance.weekday,
-            'time': instance.start_str,
-            'duration': instance.duration,
-            'url': instance.shift.get_absolute_url(),
-        })
-
-    cache.set(cache_key, schedule_entries, timeout=60 * 60)
-    return Response(schedule_entries)
+    return Response(calendars.class_instance_schedule(instance))
 
 
 @api_view(['GET'])
 @permission_classes((IsAuthenticated,))
 def teacher_schedule(request, teacher_id):
-    cache_key = f'teacher_{teacher_id}_schedule'
-    teacher_schedule = cache.get(cache_key)
-
-    if teacher_schedule:
-        return Response(teacher_schedule)
-
     teacher = get_object_or_404(college.Teacher, id=teacher_id)
+    return Response(calendars.teacher_schedule(teacher))
 
-    today = datetime.date.today()
-    period_instances = college.PeriodInstance.objects.filter(date_from__lte=today, date_to__gte=today)
-    schedule_entries = []
-    shift_instances = teacher.shifts\
-        .select_related('class_instance__parent')\
-        .filter(class_instance__period_instance__in=period_instances)\
-        .all()
 
-    for instance in shift_instances:
-        schedule_entries.append({
-            'type': instance.shift.type_abbreviation,
-            'title': instance.title,
-            'weekday': instance.weekday,
-            'time': instance.start_str,
-            'duration': instance.duration,
-            'url': instance.shift.get_absolute_url(),
-        })
+@api_view(['GET'])
+@permission_classes((IsAuthenticated,))
+def class_instance_schedule_layout(request, instance_id):
+    """
+    Exposes the weekly schedule of the shifts of a class instance in the compact layout format
+    :param instance_id: Class instance id
+    :return: Response with the shift instances and their layout (see :py:func:`college.schedules.serialize`)
+    """
+    instance = get_object_or_404(college.ClassInstance, id=instance_id)
+    return Response(schedules.serialize(schedules.shifts_instances(instance.shifts.exclude(disappeared=True))))
+
 
-    cache.set(cache_key, schedule_entries, timeout=60 * 60)
-    return Response(schedule_entries)
+@api_view(['GET'])
+def room_schedule_layout(request, room_id):
+    """
+    Exposes the weekly schedule of a room in the current period, in the compact layout format
+    :param room_id: Room id
+    :return: Response with the shift instances and their layout (see :py:func:`college.schedules.serialize`)
+    """
+    room = get_object_or_404(college.Room, id=room_id)
+    shift_instances = room.shift_instances \
+        .filter(shift__class_instance__year=settings.COLLEGE_YEAR,
+                shift__class_instance__period=settings.COLLEGE_PERIOD) \
+        .exclude(disappeared=True) \
+        .select_related('shift__class_instance__parent', 'room__building')
+    return Response(schedules.serialize(shift_instances))
 
 
 @api_view(['GET'])
@@ -161,138 +88,20 @@ def user_calendar(_, nickname):
     :param nickname: User nickname
     :return: Response with the events that compose the user calendar.
     """
-    cache_key = f'user_{nickname}_calendar'
-    user_calendar = cache.get(cache_key)
-    if user_calendar is not None:
-        Response(user_calendar)
-
-    user = get_object_or_404(users.User.objects.prefetch_related('students', 'memberships'), nickname=nickname)
-    user_groups = user.groups_custom.all()
-    primary_students, _ = get_students(user)
-    schedule_entries = []
-
-    today = datetime.date.today()
-    period_instances = college.PeriodInstance.objects.filter(date_from__lte=today, date_to__gte=today)
-    shift_instances = college.ShiftInstance.objects \
-        .select_related('shift__class_instance__parent') \
-        .prefetch_related('room__building') \
-        .filter(shift__student__in=primary_students,
-                shift__class_instance__period_instance__in=period_instances) \
-        .all()
-
-    for instance in shift_instances:
-        schedule_entries.append({
-            'type': instance.shift.type_abbreviation,
-            'title': instance.title,
-            'weekday': instance.weekday,
-            'time': instance.start_str,
-            'duration': instance.duration,
-            'url': instance.shift.get_absolute_url(),
-        })
-    own_once_schedule_entries = users.ScheduleOnce.objects.filter(user=user)
-    for entry in own_once_schedule_entries:
-        schedule_entries.append({
-            'type': 'U',
-            'title': entry.title,
-            'datetime': entry.datetime.isoformat().split('+')[0],
-            'duration': entry.duration,
-        })
-    own_periodic_schedule_entries = users.SchedulePeriodic.objects.filter(user=user)
-    for entry in own_periodic_schedule_entries:
-        schedule_entries.append({
-            'type': 'U',
-            'title': entry.title,
-            'weekday': entry.weekday,
-            'time': entry.time,
-            'duration': entry.duration,
-            'start': entry.start_date,
-            'end': entry.end_date,
-        })
-    group_once_schedule_entries = groups.ScheduleOnce.objects.filter(group__in=user_groups)
-    for entry in group_once_schedule_entries:
-        schedule_entries.append({
-            'type': 'G',
-            'title': entry.title,
-            'datetime': entry.datetime.isoformat().split('+')[0],
-            'duration': entry.duration,
-        })
-    group_periodic_schedule_entries = groups.SchedulePeriodic.objects.filter(group__in=user_groups)
-    for entry in group_periodic_schedule_entries:
-        schedule_entries.append({
-            'type': 'G',
-            'title': entry.title,
-            'weekday': entry.weekday,
-            'time': entry.time,
-            'duration': entry.duration,
-            'start': entry.start_date,
-            'end': entry.end_date,
-        })
-    class_events = college.ClassInstanceEvent.objects \
-        .select_related('class_instance__parent') \
-        .filter(class_instance__enrollments__student__in=primary_students)
-    for event in class_events:
-        schedule_entries.append({
-            'type': 'CE',
-            'title': str(event),
-            'datetime': event.datetime_str,
-            'duration': event.duration if event.duration else 0,
-        })
-
-    cache.set(cache_key, schedule_entries, timeout=60 * 60)
-    return Response(schedule_entries)
+    user = get_object_or_404(users.User, nickname=nickname)
+    return Response(calendars.user_calendar(user))
 
 
 @api_view(['GET'])
 def group_calendar(_, abbr):
     group = get_object_or_404(groups.Group, abbreviation=abbr)
-
-    schedule_entries = []
-
-    group_once_schedule_entries = groups.ScheduleOnce.objects.filter(group=group)
-
-    for entry in group_once_schedule_entries:
-        schedule_entries.append({
-            'type': 'G',
-            'title': entry.title,
-            'datetime': entry.datetime.isoformat().split('+')[0],
-            'duration': entry.duration,
-        })
-    group_periodic_schedule_entries = groups.SchedulePeriodic.objects.filter(group=group)
-    for entry in group_periodic_schedule_entries:
-        schedule_entries.append({
-            'type': 'G',
-            'title': entry.title,
-            'weekday': entry.weekday,
-            'time': entry.time,
-            'duration': entry.duration,
-            'start': entry.start_date,
-            'end': entry.end_date,
-        })
-    return Response(schedule_entries)
+    return Response(calendars.group_calendar(group))
 
 
 @api_view(['GET'])
 def building_schedule_shifts_view(request, building_id):
     building = get_object_or_404(college.Building, id=building_id)
-    today = datetime.date.today()
-    period_instances = college.PeriodInstance.objects.filter(date_from__lte=today, date_to__gte=today)
-    shift_instances = college.ShiftInstance.objects \
-        .select_related('shift__class_instance__parent') \
-        .filter(room__building=building,
-                shift__class_instance__period_instance__in=period_instances) \
-        .exclude(weekday=None) \
-        .all()
-    schedule_entries = []
-    for instance in shift_instances:
-        schedule_entries.append({
-            'resourceId': instance.room_id,
-            'title': instance.short_title,
-            'daysOfWeek': instance.weekday_as_arr,
-            'startTime': instance.start_str,
-            'endTime': instance.end_str,
-            'url': instance.shift.get_absolute_url(),
-        })
-    return Response(schedule_entries)
+    return Response(calendars.building_schedule(building))
 
 
 @api_view(['GET'])
@@ -303,3 +112,88 @@ def building_schedule_rooms_view(request, building_id):
         .exclude()
     serializer = college_serializer.NestedRoomSerializer(rooms, many=True)
     return Response(serializer.data)
+
+
+@api_view(['GET'])
+def building_occupation_view(request, building_id):
+    """
+    Exposes the current period occupation of the rooms of a building, in time slots
+    :param building_id: Building id
+    Query parameters: weekday (0 is Monday, defaults to today) and granularity (slot minutes, defaults to 30)
+    :return: Response with the slot occupation of every room
+    """
+    building = get_object_or_404(college.Building, id=building_id)
+    try:
+        weekday = int(request.GET.get('weekday', datetime.date.today().weekday()))
+        granularity = int(request.GET.get('granularity', occupation.SLOT_MINUTES))
+    except ValueError:
+        raise ValidationError("Invalid weekday or granularity")
+    if not (0 <= weekday <= 6 and 5 <= granularity <= 120):
+        raise ValidationError("Weekday must be in [0, 6] and granularity in [5, 120]")
+
+    index = occupation.index(settings.COLLEGE_PERIOD, settings.COLLEGE_YEAR, weekday, granularity=granularity)
+    rooms = index.table(building).get(building, dict())
+    return Response({
+        'weekday': weekday,
+        'start': occupation.DAY_START,
+        'granularity': granularity,
+        'rooms': [{'id': room.id, 'name': room.name, 'occupied': [state is True for state in states]}
+                  for room, states in rooms.items()],
+    })
+
+
+def _feed_response(request, name, conditions, feed):
+    """
+    Conditional (ETag and Last-Modified) response to a calendar feed request
+    :param name: Feed file name
+    :param conditions: Tuple with the feed ETag and last modification (see :py:func:`supernova.ics.conditions`)
+    :param feed: Function which generates the feed lines given the url base (only called when the feed changed)
+    :return: Response with the feed, or 304 when the client already has it
+    """
+    etag, modified = conditions
+    etag = quote_etag(etag)
+    last_modified = None if modified is None else int(modified.timestamp())
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = StreamingHttpResponse(feed(request.build_absolute_uri('/')[:-1]),
+                                         content_type='text/calendar; charset=utf-8')
+        response['Content-Disposition'] = f'inline; filename="{name}.ics"'
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def user_calendar_feed(request, nickname):
+    """
+    Exposes every event of a user as an iCalendar feed.
+    Accessible by the user or by anyone with the user feed token (calendar clients are not authenticated).
+    :param nickname: User nickname
+    """
+    user = get_object_or_404(users.User, nickname=nickname)
+    if request.user != user and not ics.valid_token(user, request.GET.get('token')):
+        raise Http404()
+    last_save = college.Student.objects.filter(user=user).aggregate(Max('last_save'))['last_save__max']
+    conditions = ics.conditions(last_save=last_save, user_id=user.id,
+                                group_ids=user.groups_custom.values_list('id', flat=True))
+    return _feed_response(request, nickname, conditions, lambda base_url: ics.user_feed(user, base_url))
+
+
+def group_calendar_feed(request, abbr):
+    group = get_object_or_404(groups.Group, abbreviation=abbr)
+    conditions = ics.conditions(group_ids=(group.id,))
+    return _feed_response(request, abbr, conditions, lambda _: ics.group_feed(group))
+
+
+def class_instance_calendar_feed(request, instance_id):
+    instance = get_object_or_404(college.ClassInstance, id=instance_id)
+    conditions = ics.conditions(last_save=instance.last_save)
+    return _feed_response(request, f'class-instance-{instance_id}', conditions,
+                          lambda base_url: ics.class_instance_feed(instance, base_url))
+
+
+def room_calendar_feed(request, room_id):
+    room = get_object_or_404(college.Room.objects.select_related('building'), id=room_id)
+    conditions = ics.conditions(last_save=room.last_save)
+    return _feed_response(request, f'room-{room_id}', conditions, lambda base_url: ics.room_feed(room, base_url))
@@ -1,11 +1,15 @@
+import datetime
+
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from django.conf import settings
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from api.serializers import college as serializers
 
-from college import models as college
+from college import models as college, occupation, conflicts, utilization, schedules, occurrences
 from users import models as users
 from users.utils import get_students
 
@@ -36,6 +40,95 @@ class RoomList(APIView):
         return Response(serializer.data)
 
 
+class RoomOccurrences(APIView):
+    """
+    Shift occurrences of a room in a date range.
+    Query parameters: from and to (YYYY-MM-DD, inclusive, default to today and a week later).
+    """
+
+    def get(self, request, room_id):
+        room = get_object_or_404(college.Room, id=room_id)
+        today = timezone.localdate()
+        try:
+            date_from = datetime.date.fromisoformat(request.GET['from']) if 'from' in request.GET else today
+            date_to = datetime.date.fromisoformat(request.GET['to']) if 'to' in request.GET \
+                else date_from + datetime.timedelta(days=7)
+        except ValueError:
+            raise ValidationError("Malformed dates")
+        if not date_from <= date_to <= date_from + datetime.timedelta(days=366):
+            raise ValidationError("The range must be positive and span at most a year")
+
+        start = timezone.make_aware(datetime.datetime.combine(date_from, datetime.time()))
+        end = timezone.make_aware(datetime.datetime.combine(date_to + datetime.timedelta(days=1), datetime.time()))
+        return Response([{
+            'shift_instance': occurrence.shift_instance_id,
+            'title': occurrence.shift_instance.title,
+            'start': occurrence.start,
+            'end': occurrence.end,
+            'url': occurrence.shift_instance.shift.get_absolute_url(),
+        } for occurrence in occurrences.between(start, end, room=room)])
+
+
+class FreeRoomList(APIView):
+    """
+    Rooms which are free during a time interval of the current period.
+    Query parameters: weekday (0 is Monday, defaults to today), start and end (HH:MM, defaults to the next hour, up to midnight),
+    building (id), type (room type) and unlocked (true/false).
+    """
+
+    def get(self, request):
+        now = timezone.localtime()
+        minutes = now.hour * 60 + now.minute
+        params = request.GET
+        try:
+            weekday = int(params.get('weekday', now.weekday()))
+            start = _parse_time(params['start']) if 'start' in params else minutes
+            end = _parse_time(params['end']) if 'end' in params else min(start + 60, 24 * 60)
+            building = int(params['building']) if 'building' in params else None
+            room_type = int(params['type']) if 'type' in params else None
+        except ValueError:
+            raise ValidationError("Malformed parameters")
+        if not (0 <= weekday <= 6 and 0 <= start < end <= 24 * 60):
+            raise ValidationError("Weekday must be in [0, 6] and the start must precede the end")
+        unlocked = {'true': True, 'false': False}.get(params.get('unlocked'))
+
+        rooms = occupation.free_rooms(
+            settings.COLLEGE_PERIOD, settings.COLLEGE_YEAR, weekday, start, end,
+            building=building, room_type=room_type, unlocked=unlocked)
+        serializer = serializers.SimpleRoomSerializer(rooms, many=True)
+        return Response(serializer.data)
+
+
+class RoomUtilization(APIView):
+    """
+    Room utilization statistics of a period.
+    Query parameters: year and period (default to the current ones), granularity (slot minutes, defaults to 60)
+    and building (id).
+    """
+
+    def get(self, request):
+        params = request.GET
+        try:
+            year = int(params.get('year', settings.COLLEGE_YEAR))
+            period = int(params.get('period', settings.COLLEGE_PERIOD))
+            granularity = int(params.get('granularity', utilization.SLOT_MINUTES))
+            building = int(params['building']) if 'building' in params else None
+        except ValueError:
+            raise ValidationError("Malformed parameters")
+        if not 15 <= granularity <= 240:
+            raise ValidationError("Granularity must be in [15, 240]")
+        return Response(utilization.report(period, year, granularity=granularity, building=building))
+
+
+def _parse_time(value):
+    """
+    :param value: Time as HH:MM
+    :return: Minutes since midnight
+    """
+    hours, minutes = value.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
 class DepartmentList(APIView):
     def get(self, request):
         serializer = serializers.DepartmentSerializer(college.Department.objects.all(), many=True)
@@ -93,6 +186,25 @@ class CourseDetailed(APIView):
         return Response(data)
 
 
+class CourseSchedule(APIView):
+    """
+    Schedule of the classes that the course curriculum suggests for a curricular year and period.
+    Query parameters: curricular_year (defaults to 1), period (defaults to the current one) and year
+    (defaults to the current one).
+    """
+
+    def get(self, request, course_id):
+        course = get_object_or_404(college.Course, id=course_id)
+        params = request.GET
+        try:
+            curricular_year = int(params.get('curricular_year', 1))
+            period = int(params.get('period', settings.COLLEGE_PERIOD))
+            year = int(params.get('year', settings.COLLEGE_YEAR))
+        except ValueError:
+            raise ValidationError("Malformed parameters")
+        return Response(schedules.course_schedule(course.id, curricular_year, period, year))
+
+
 class Class(APIView):
     def get(self, request, class_id):
         klass = get_object_or_404(college.Class, id=class_id)
@@ -201,6 +313,51 @@ class Student(APIView):
         return Response(serializer.data)
 
 
+class StudentConflicts(APIView):
+    """
+    Timetable conflicts (overlapping shift instances) of a student in the current period
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, student_id):
+        student = get_object_or_404(college.Student, id=student_id)
+        report = conflicts.find(settings.COLLEGE_PERIOD, settings.COLLEGE_YEAR, students=[student])
+        student_conflicts = report.for_student(student.id)
+        shifts = _shift_names({shift_id for a, b, _ in student_conflicts for shift_id in (a, b)})
+        return Response([{
+            'shifts': [{'id': a, 'name': shifts[a]}, {'id': b, 'name': shifts[b]}],
+            'instances': instances,
+        } for a, b, instances in student_conflicts])
+
+
+class ClassInstanceConflicts(APIView):
+    """
+    Timetable conflicts of the students of a class instance that involve its shifts
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, instance_id):
+        instance = get_object_or_404(college.ClassInstance, id=instance_id)
+        report = conflicts.find(instance.period, instance.year, class_instance=instance)
+        student_conflicts = report.for_class_instance(instance.id)
+        shifts = _shift_names({shift_id for pairs in student_conflicts.values() for pair in pairs for shift_id in pair})
+        return Response([{
+            'student': student_id,
+            'conflicts': [{
+                'shifts': [{'id': a, 'name': shifts[a]}, {'id': b, 'name': shifts[b]}],
+                'instances': report.overlaps[(a, b)],
+            } for a, b in pairs],
+        } for student_id, pairs in student_conflicts.items()])
+
+
+def _shift_names(shift_ids):
+    """
+    :return: Dictionary of {shift id: shift name}
+    """
+    shifts = college.Shift.objects.select_related('class_instance__parent').filter(id__in=shift_ids)
+    return {shift.id: str(shift) for shift in shifts}
+
+
 class Teacher(APIView):
     permission_classes = (IsAuthenticated,)
 
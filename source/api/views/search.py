@@ -1,13 +1,21 @@
-from elasticsearch_dsl import Q
+from django.urls import reverse
+from elasticsearch_dsl import Q, MultiSearch
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
-from college import documents as college_search
+from college import documents as college_search, models as college
 from learning import documents as learning_search
 from groups import documents as groups_search
 from services import documents as services_search
 from news import documents as news_search
 from api import serializers
 
+#: Results of each type returned by the global search
+GLOBAL_RESULTS = 5
+#: Files returned by each file search
+FILE_RESULTS = 20
+#: Matching pages listed for each file
+FILE_PAGE_HITS = 3
+
 mapping = {
     'teacher': {
         'class': college_search.TeacherDocument,
@@ -43,19 +51,25 @@ mapping = {
         'class': college_search.ClassDocument,
         'serializer': serializers.college.ClassSerializer,
         'fields': ['name', 'abbreviation'],
-        'private': False
+        'private': False,
+        'source': ['name', 'abbreviation', 'credits'],
+        'url': 'college:class'
     },
     'course': {
         'class': college_search.CourseDocument,
         'serializer': serializers.college.CourseSerializer,
         'fields': ['name', 'abbreviation'],
-        'private': False
+        'private': False,
+        'source': ['name', 'abbreviation'],
+        'url': 'college:course'
     },
     'department': {
         'class': college_search.DepartmentDocument,
         'serializer': serializers.college.DepartmentSerializer,
         'fields': ['name', 'description'],
-        'private': False
+        'private': False,
+        'source': ['name'],
+        'url': 'college:department'
     },
     'service': {
         'class': services_search.ServiceDocument,
@@ -67,13 +81,17 @@ mapping = {
         'class': learning_search.SectionDocument,
         'serializer': serializers.learning.SectionPreviewSerializer,
         'fields': ['title', 'content'],
-        'private': False
+        'private': False,
+        'source': ['title'],
+        'url': 'learning:section'
     },
     'exercise': {
         'class': learning_search.ExerciseDocument,
         'serializer': serializers.learning.ExercisePreviewSerializer,
         'fields': ['content'],
-        'private': False
+        'private': False,
+        'source': [],
+        'url': 'learning:exercise'
     },
     'question': {
         'class': learning_search.QuestionDocument,
@@ -94,10 +112,20 @@ mapping = {
 def search_view(request):
     q = request.GET.get('q')
     e = request.GET.get('e')
-    if q is None or (e is not None and e not in mapping):
+    if q is None or (e is not None and e != 'file' and e not in mapping):
         return Response({'results': []})
     private_access = not request.user.is_anonymous and request.user.has_perm('users.student_access')
 
+    if e == 'file':
+        if not private_access:
+            return Response({'error': 'This data class is private'}, status=403)
+        try:
+            offset = max(int(request.GET.get('offset', 0)), 0)
+        except ValueError:
+            offset = 0
+        results = file_search(request.user, q, offset)
+        return Response({'results': {'file': results} if results else {}})
+
     results = dict()
     if e:
         doc_search = mapping[e]
@@ -111,14 +139,136 @@ def search_view(request):
         if len(serialized.data):
             results[e] = serialized.data
     else:
-        for key, doc_search in mapping.items():
-            if doc_search['private'] and not private_access:
-                continue
-            qs = doc_search['class'].search() \
-                .query(Q("multi_match", query=q, fields=doc_search['fields'])) \
-                .to_queryset()
-            serialized = doc_search['serializer'](qs, many=True)
-            if len(serialized.data):
-                results[key] = serialized.data
+        results = global_search(q, private_access)
 
     return Response({'results': results})
+
+
+def global_search(q, private_access, size=GLOBAL_RESULTS):
+    """
+    Searches every accessible type at once, with a single multi-search request.
+    Types whose entries are fully indexed (those with a ``source`` in the mapping) are serialized from the index,
+    the remaining get their (few) hits loaded with one query per type. Types with thumbnails (which are not indexed,
+    as they change along with the pictures, outside the index) are among the latter.
+    :param q: Query
+    :param private_access: Whether the private types can be searched
+    :param size: Maximum number of results of each type
+    :return: Dictionary with the results of each type which had any
+    """
+    keys = [key for key, doc_search in mapping.items() if private_access or not doc_search['private']]
+    multi_search = MultiSearch()
+    for key in keys:
+        doc_search = mapping[key]
+        search = doc_search['class'].search() \
+            .query(Q("multi_match", query=q, fields=doc_search['fields']))
+        # Hits of the types which are not served from the index only need their ids
+        fields = doc_search['source'] + _url_fields(doc_search) if 'source' in doc_search else None
+        search = search.source(fields or False)
+        multi_search = multi_search.add(search[:size])
+
+    results = dict()
+    for key, response in zip(keys, multi_search.execute()):
+        if not response.hits:
+            continue
+        doc_search = mapping[key]
+        if 'source' in doc_search:
+            results[key] = [_source_entry(doc_search, hit) for hit in response.hits]
+        else:
+            ids = [hit.meta.id for hit in response.hits]
+            order = {str(pk): position for position, pk in enumerate(ids)}
+            objects = sorted(doc_search['class']().get_queryset().filter(pk__in=ids),
+                             key=lambda obj: order.get(str(obj.pk), len(order)))
+            serialized = doc_search['serializer'](objects, many=True).data
+            if len(serialized):
+                results[key] = serialized
+    return results
+
+
+def _url_fields(doc_search):
+    url = doc_search['url']
+    return [url[1]] if isinstance(url, tuple) else []
+
+
+def _source_entry(doc_search, hit):
+    """
+    :return: Search result built from an indexed document (a subset of the type serializer fields)
+    """
+    source = hit.to_dict()
+    entry = {'id': int(hit.meta.id)}
+    for field in doc_search['source']:
+        entry[field] = source.get(field)
+    url = doc_search['url']
+    if isinstance(url, tuple):
+        url, url_field = url
+        entry['url'] = reverse(url, args=[source.get(url_field)])
+    else:
+        entry['url'] = reverse(url, args=[entry['id']])
+    return entry
+
+
+def file_search(user, q, offset=0):
+    """
+    Searches the text of the files (and their names), restricted to the files the user can access
+    :param user: User searching
+    :param q: Query
+    :param offset: Number of files to skip
+    :return: List with the matching files, the classes they were shared to and their best matching pages
+    """
+    if user.is_staff or user.is_teacher:
+        public, enrolled = None, None
+    else:
+        if user.is_student:
+            public = (college.ctypes.FileVisibility.PUBLIC, college.ctypes.FileVisibility.STUDENTS)
+        else:
+            public = (college.ctypes.FileVisibility.PUBLIC,)
+        enrolled = set(college.ClassInstance.objects.filter(student__user=user).values_list('id', flat=True))
+
+    pages = Q('nested', path='pages', score_mode='max',
+              query=Q('match', **{'pages.text': q}),
+              inner_hits={'size': FILE_PAGE_HITS,
+                          '_source': ['pages.number'],
+                          'highlight': {'fields': {'pages.text': {'fragment_size': 150, 'number_of_fragments': 3}}}})
+    search = college_search.FileDocument.search() \
+        .query(Q('bool', should=[pages, Q('multi_match', query=q, fields=['name', 'names'])],
+                 minimum_should_match=1)) \
+        .source(['hash', 'name', 'class_files'])
+    if public is not None:
+        search = search.filter(Q('nested', path='class_files', query=Q('bool', should=[
+            Q('terms', **{'class_files.visibility': public}),
+            Q('bool', filter=[
+                Q('term', **{'class_files.visibility': college.ctypes.FileVisibility.ENROLLED}),
+                Q('terms', **{'class_files.class_instance': list(enrolled)})])])))
+
+    hits = [(hit, hit.to_dict()) for hit in search[offset:offset + FILE_RESULTS].execute()]
+    if public is not None:
+        # The index can lag behind visibility changes, so the access is checked against the database
+        class_file_ids = [class_file['id'] for _, source in hits for class_file in source.get('class_files') or []]
+        visibilities = dict(college.ClassFile.objects
+                            .filter(id__in=class_file_ids)
+                            .values_list('id', 'visibility'))
+    results = []
+    for hit, source in hits:
+        class_files = source.get('class_files') or []
+        if public is not None:
+            class_files = [class_file for class_file in class_files
+                           if visibilities.get(class_file['id']) in public
+                           or (visibilities.get(class_file['id']) == college.ctypes.FileVisibility.ENROLLED
+                               and class_file['class_instance'] in enrolled)]
+            if not class_files:
+                continue
+        page_hits = hit.meta.inner_hits['pages'] if 'inner_hits' in hit.meta else []
+        results.append({
+            'hash': source['hash'],
+            'name': source.get('name'),
+            'url': reverse('college:file', args=[source['hash']]),
+            'score': hit.meta.score,
+            'class_files': [{'id': class_file['id'],
+                             'name': class_file['name'],
+                             'class_instance': {'id': class_file['class_instance'],
+                                                'name': class_file['class_instance_name']}}
+                            for class_file in class_files],
+            'pages': [{'number': page.number,
+                       'highlights': list(page.meta.highlight['pages.text']) if 'highlight' in page.meta else []}
+                      for page in page_hits],
+        })
+    return results
@@ -0,0 +1,356 @@
+"""
+Synthetic CLIPy, used to benchmark the synchronization.
+
+:py:class:`Dataset` generates a consistent set of CLIPy resources (classes, instances, shifts, enrollments, ...)
+and :py:class:`FakeClipy` serves them over HTTP with the same paths the real service uses.
+"""
+import hashlib
+import json
+import logging
+import random
+import tracemalloc
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import perf_counter, sleep
+
+from clip.utils import QueryCounter
+from college import choice_types as ctypes
+
+logger = logging.getLogger(__name__)
+
+#: Buildings that get imported by :py:func:`clip.synchronization.assert_buildings_inserted`
+BUILDING_IDS = (1176, 1177, 1178, 1179, 1180, 1181, 1183, 1184, 1185)
+
+FIRST_NAMES = ('Ana', 'Bruno', 'Carla', 'Diogo', 'Eva', 'Filipe', 'Gonçalo', 'Helena', 'Inês', 'João', 'Marta', 'Rui')
+LAST_NAMES = ('Almeida', 'Costa', 'Ferreira', 'Gomes', 'Lopes', 'Martins', 'Pereira', 'Santos', 'Silva', 'Sousa')
+
+
+class Dataset:
+    """
+    A synthetic CLIPy dataset. The same parameters (and seed) always yield the same dataset.
+    """
+
+    def __init__(self, year, classes=500, instances_per_class=2, shifts_per_instance=4, shift_instances_per_shift=2,
+                 enrollments_per_instance=50, events_per_instance=2, files_per_instance=3,
+                 students=5000, teachers=300, departments=10, courses=30, rooms=200, seed=0):
+        self.year = year
+        self.random = random.Random(seed)
+        self.resources = dict()
+        self._next_id = 1
+        self._changed = set()
+
+        self._departments(departments)
+        self._buildings_and_rooms(rooms)
+        self._courses(courses)
+        self._teachers(teachers)
+        self._students(students)
+        self._classes(classes, instances_per_class, shifts_per_instance, shift_instances_per_shift,
+                      enrollments_per_instance, events_per_instance, files_per_instance)
+
+    def _id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def _name(self):
+        return f"{self.random.choice(FIRST_NAMES)} {self.random.choice(LAST_NAMES)} {self.random.choice(LAST_NAMES)}"
+
+    def _departments(self, count):
+        self.departments = [{'id': self._id(), 'name': f"Department {i}", 'institution': 1} for i in range(count)]
+        self.resources['departments/'] = self.departments
+        for department in self.departments:
+            self.resources[f"department/{department['id']}"] = {**department, 'classes': [], 'teachers': []}
+
+    def _buildings_and_rooms(self, count):
+        self.resources['buildings/'] = [{'id': building_id, 'name': f"Edifício {building_id}"}
+                                        for building_id in BUILDING_IDS]
+        self.rooms = [
+            {'id': self._id(),
+             'name': f"Sala {self.random.randint(1, 4)}.{i}",
+             'type': self.random.choice((ctypes.RoomType.CLASSROOM, ctypes.RoomType.LABORATORY)),
+             'building': self.random.choice(BUILDING_IDS)}
+            for i in range(count)]
+        self.resources['rooms/'] = self.rooms
+
+    def _courses(self, count):
+        self.courses = [
+            {'id': self._id(), 'name': f"Course {i}", 'abbr': f"C{i}", 'deg': ctypes.Degree.BACHELORS}
+            for i in range(count)]
+        self.resources['courses/'] = self.courses
+
+    def _teachers(self, count):
+        self.teachers = [
+            {'id': self._id(),
+             'name': self._name(),
+             'first_year': self.year - 10,
+             'last_year': self.year,
+             'depts': [self.random.choice(self.departments)['id']]}
+            for _ in range(count)]
+        self.resources['teachers/'] = self.teachers
+
+    def _students(self, count):
+        self.students = []
+        for i in range(count):
+            student = {
+                'id': self._id(),
+                'name': self._name(),
+                'abbr': f"s.{i}",
+                'course': self.random.choice(self.courses)['id']}
+            self.students.append(student)
+            self.resources[f"student/{student['id']}"] = student
+        self.resources['students/'] = self.students
+
+    def _classes(self, count, instances_per_class, shifts_per_instance, shift_instances_per_shift,
+                 enrollments_per_instance, events_per_instance, files_per_instance):
+        self.classes = []
+        self.class_instances = []
+        for i in range(count):
+            class_id = self._id()
+            department = self.random.choice(self.departments)
+            instances = []
+            for j in range(instances_per_class):
+                instance = self._class_instance(
+                    class_id, department, self.year - j, shifts_per_instance, shift_instances_per_shift,
+                    enrollments_per_instance, events_per_instance, files_per_instance)
+                instances.append(instance['id'])
+            klass = {
+                'id': class_id,
+                'iid': class_id,
+                'name': f"Class {i}",
+                'abbr': f"CL{i}",
+                'ects': self.random.choice((3, 6, 9)),
+                'dept': department['id'],
+                'instances': instances}
+            self.classes.append(klass)
+            self.resources[f"class/{class_id}"] = klass
+        self.resources['classes/'] = self.classes
+
+    def _class_instance(self, class_id, department, year, shifts_count, shift_instances_count,
+                        enrollments_count, events_count, files_count):
+        instance_id = self._id()
+        period = self.random.choice((ctypes.Period.FIRST_SEMESTER, ctypes.Period.SECOND_SEMESTER))
+        students = self.random.sample(self.students, min(enrollments_count, len(self.students)))
+        teachers = self.random.sample(self.teachers, min(2, len(self.teachers)))
+
+        enrollments = [self._enrollment(instance_id, student) for student in students]
+        shifts = []
+        for number in range(1, shifts_count + 1):
+            shift_id = self._id()
+            shift_instances = []
+            for _ in range(shift_instances_count):
+                shift_instance_id = self._id()
+                start = self.random.randrange(8 * 60, 18 * 60, 30)
+                shift_instance = {
+                    'id': shift_instance_id,
+                    'shift': shift_id,
+                    'weekday': self.random.randint(0, 4),
+                    'start': start,
+                    'end': start + self.random.choice((60, 90, 120)),
+                    'room': self.random.choice(self.rooms)['id']}
+                self.resources[f"shift_inst/{shift_instance_id}"] = shift_instance
+                shift_instances.append(shift_instance_id)
+            shift = {
+                'id': shift_id,
+                'class_instance_id': instance_id,
+                'type': ctypes.ShiftType.PRACTICAL,
+                'number': number,
+                'minutes': 120,
+                'restrictions': None,
+                'state': "Aberto",
+                'instances': shift_instances,
+                'students': [student['id'] for student in students[number - 1::shifts_count]],
+                'teachers': [teachers[number % len(teachers)]['id']]}
+            self.resources[f"shift/{shift_id}"] = shift
+            shifts.append(shift)
+
+        events = []
+        for _ in range(events_count):
+            start = self.random.randrange(9, 17)
+            events.append({
+                'id': self._id(),
+                'instance_id': instance_id,
+                'date': (date(year, 1, 1) + timedelta(days=self.random.randint(0, 180))).isoformat(),
+                'from_time': f"{start:02}:00",
+                'to_time': f"{start + 2:02}:00",
+                'type': ctypes.EventType.TEST,
+                'season': ctypes.EventSeason.NORMAL,
+                'info': "Teste",
+                'note': None})
+
+        files = []
+        for _ in range(files_count):
+            file_id = self._id()
+            files.append({
+                'id': file_id,
+                'hash': hashlib.sha1(f"file{file_id}".encode()).hexdigest(),
+                'mime': "application/pdf",
+                'name': f"Slides {file_id}.pdf",
+                'size': self.random.randint(10_000, 5_000_000),
+                'type': ctypes.FileType.SLIDES,
+                'upload_datetime': datetime(year, 2, 1, 10, 0).isoformat(),
+                'uploader': teachers[0]['name']})
+        self.resources[f"files/{instance_id}"] = files
+
+        instance = {
+            'id': instance_id,
+            'class_id': class_id,
+            'department_id': department['id'],
+            'year': year,
+            'period': period,
+            'info': {'description': f"Class instance {instance_id}"},
+            'working_hours': 60,
+            'evaluations': [],
+            'enrollments': enrollments,
+            'events': events,
+            'files': files,
+            'shifts': shifts}
+        self.resources[f"class_inst/{instance_id}"] = instance
+        self.class_instances.append(instance)
+        return instance
+
+    def _enrollment(self, instance_id, student):
+        enrollment = {
+            'id': self._id(),
+            'class_instance_id': instance_id,
+            'student': student['id'],
+            'student_year': self.random.randint(1, 5),
+            'attempt': 1,
+            'statutes': None,
+            'approved': False,
+            'attendance': None,
+            'attendance_date': None,
+            'continuous_grade': None,
+            'continuous_grade_date': None,
+            'exam_grade': None,
+            'exam_grade_date': None,
+            'special_grade': None,
+            'special_grade_date': None,
+            'improvement_grade': None,
+            'improvement_grade_date': None}
+        self.resources[f"enrollment/{enrollment['id']}"] = enrollment
+        return enrollment
+
+    def mutate(self, fraction=0.1):
+        """
+        Emulates upstream activity by grading and enrolling students in a fraction of the class instances
+        :param fraction: Fraction of the class instances that change
+        """
+        changed = self.random.sample(self.class_instances, int(len(self.class_instances) * fraction))
+        for instance in changed:
+            for enrollment in instance['enrollments']:
+                enrollment['continuous_grade'] = self.random.randint(0, 20)
+                enrollment['continuous_grade_date'] = date(instance['year'], 6, 30).isoformat()
+            enrolled = {enrollment['student'] for enrollment in instance['enrollments']}
+            student = self.random.choice(self.students)
+            if student['id'] not in enrolled:
+                instance['enrollments'].append(self._enrollment(instance['id'], student))
+            self._changed.add(instance['id'])
+
+    def changes(self):
+        """
+        :return: External ids of the class instances changed since the last call
+        """
+        changed = list(self._changed)
+        self._changed.clear()
+        return changed
+
+
+class FakeClipy:
+    """
+    HTTP server that serves a dataset as CLIPy would. Update requests always succeed (and do nothing).
+    Meant to be used as a context manager, which runs the server in the background.
+    """
+
+    def __init__(self, dataset, latency=0.0):
+        """
+        :param dataset: Served dataset
+        :param latency: Seconds added to every response, to emulate the actual CLIPy
+        """
+        self.dataset = dataset
+        self.latency = latency
+        self.requests = 0
+        self.server = None
+        self.thread = None
+
+    def __enter__(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.requests += 1
+                if fake.latency:
+                    sleep(fake.latency)
+                path = self.path.lstrip('/').split('?')[0]
+                if path.startswith('update/'):
+                    payload = {}
+                elif path == 'changes/class_inst/':
+                    payload = fake.dataset.changes()
+                elif path in fake.dataset.resources:
+                    payload = fake.dataset.resources[path]
+                else:
+                    self.send_error(404)
+                    return
+                body = json.dumps(payload).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    @property
+    def host(self):
+        """
+        :return: Address of the server, as expected in settings.CLIPY['host']
+        """
+        return f"127.0.0.1:{self.server.server_address[1]}"
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Measurement:
+    """
+    Context manager that measures the wall time, database queries and peak (python) memory of a code block
+    """
+
+    def __init__(self, name, memory=True):
+        self.name = name
+        self.memory = memory
+        self.elapsed = None
+        self.queries = None
+        self.peak_memory = None
+        self._counter = None
+        self._start = None
+
+    def __enter__(self):
+        if self.memory:
+            tracemalloc.start()
+        self._counter = QueryCounter().__enter__()
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.elapsed = perf_counter() - self._start
+        self._counter.__exit__(exc_type, exc_val, exc_tb)
+        self.queries = self._counter.count
+        if self.memory:
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    def as_dict(self):
+        return {
+            'phase': self.name,
+            'elapsed': round(self.elapsed, 3),
+            'queries': self.queries,
+            'peak_memory': self.peak_memory,
+        }
@@ -0,0 +1,578 @@
+"""
+Set-based synchronization of class instances and their derivatives.
+
+The functions in :py:mod:`clip.synchronization` apply the upstream data one object at a time,
+paying a handful of queries for every shift, event and enrollment.
+The ones in here load every known object of a batch of class instances at once, diff them against the upstream data
+and write the differences with bulk statements in chunked transactions.
+"""
+import logging
+from collections import defaultdict
+from datetime import datetime
+from itertools import islice
+
+import reversion
+from django.db import transaction
+from django.db.models import Q, F
+from django.utils import timezone
+from django.utils.timezone import make_aware
+
+from clip import synchronization as sync
+from clip.synchronization import Recursivity, NetworkException
+from college import models as m
+
+logger = logging.getLogger(__name__)
+
+#: Number of class instances synchronized together
+BATCH_SIZE = 20
+#: Maximum number of objects written per statement (and per transaction)
+CHUNK_SIZE = 500
+
+CLASS_INSTANCE_KEYS = ('department_id', 'enrollments', 'events', 'files', 'shifts', 'info', 'period', 'year')
+
+
+def chunks(iterable, size=CHUNK_SIZE):
+    """
+    Splits an iterable in lists of a given size (the last one might be smaller)
+    :param iterable: Iterable being split
+    :param size: Length of the lists
+    """
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def sync_class_instances(class_instances, recurse=Recursivity.CREATION):
+    """
+    Set-based counterpart of :py:func:`clip.synchronization.sync_class_instance`, for several class instances.
+    :param class_instances: Already existing class instances that are being sync'd
+    :param recurse: Whether to create (CREATION) or to create and update (FULL) the derivative entities
+    :raises NetworkException: If some class instance could not be fetched (after synchronizing the others)
+    """
+    upstreams = []
+    failed = []
+    for class_instance in class_instances:
+        try:
+            upstreams.append((class_instance, sync._request_class_instance(class_instance.external_id)))
+        except NetworkException:
+            failed.append(class_instance.external_id)
+
+    _upstream_sync_class_instances(upstreams, recurse)
+
+    if failed:
+        raise NetworkException(f"Unable to fetch class instances {failed}")
+
+
+def _upstream_sync_class_instances(upstreams, recurse):
+    """
+    :param upstreams: List of (class instance, upstream data) pairs
+    :param recurse: Whether to create (CREATION) or to create and update (FULL) the derivative entities
+    """
+    valid_upstreams = []
+    for class_instance, upstream in upstreams:
+        if all(k in upstream for k in CLASS_INSTANCE_KEYS):
+            valid_upstreams.append((class_instance, upstream))
+        else:
+            logger.error(f"Invalid class instance data: {upstream}")
+
+    digests = {class_instance.id: sync.payload_hash(upstream) for class_instance, upstream in valid_upstreams}
+    if recurse != Recursivity.FULL:
+        # Payloads that did not change since the last synchronization have nothing new
+        unchanged = [class_instance.id for class_instance, _ in valid_upstreams
+                     if class_instance.external_hash == digests[class_instance.id]]
+        m.ClassInstance.objects.filter(id__in=unchanged).update(external_update=timezone.now())
+        valid_upstreams = [(class_instance, upstream) for class_instance, upstream in valid_upstreams
+                           if class_instance.external_hash != digests[class_instance.id]]
+    if len(valid_upstreams) == 0:
+        return
+
+    class_instances = [class_instance for class_instance, _ in valid_upstreams]
+    _upstream_sync_class_instance_info(valid_upstreams)
+    _upstream_sync_shifts(class_instances, valid_upstreams, recurse)
+    _upstream_sync_events(class_instances, valid_upstreams, recurse)
+    _upstream_sync_enrollments(class_instances, valid_upstreams, recurse)
+
+    if recurse in (Recursivity.CREATION, Recursivity.FULL):
+        for class_instance, upstream in valid_upstreams:
+            sync._upstream_sync_class_instance_files(
+                upstream['files'], class_instance.external_id, class_inst=class_instance)
+        # Only now is every derivative in sync with the payloads
+        now = timezone.now()
+        for class_instance in class_instances:
+            class_instance.external_hash = digests[class_instance.id]
+            class_instance.external_update = now
+        _bulk_update(m.ClassInstance, class_instances, {'external_hash', 'external_update'})
+
+
+def _upstream_sync_class_instance_info(upstreams):
+    updated = []
+    for obj, upstream in upstreams:
+        if obj.frozen:
+            continue
+
+        if upstream['year'] != obj.year:
+            logger.error(f"Instance {obj.external_id} year remotely changed from {obj.year} to {upstream['year']}")
+        if upstream['period'] != obj.period:
+            logger.error(f"Instance {obj.external_id} period remotely changed "
+                         f"from {obj.period} to {upstream['period']}")
+
+        changed = False
+        if obj.information is None:
+            obj.information = {'upstream': upstream['info']}
+            changed = True
+        if obj.external_data != upstream:
+            obj.external_data = upstream
+            changed = True
+        elif 'upstream' not in obj.information or obj.information['upstream'] != upstream['info']:
+            obj.information['upstream'] = upstream['info']
+            changed = True
+        if changed:
+            updated.append(obj)
+
+    _bulk_update(m.ClassInstance, updated, {'information', 'external_data'})
+
+
+def _upstream_sync_shifts(class_instances, upstreams, recurse):
+    upstream_shifts = {
+        shift['id']: (class_instance, shift)
+        for class_instance, upstream in upstreams
+        for shift in upstream['shifts']}
+    new, mirrored, disappeared = _upstream_diff(m.Shift.objects, 'class_instance', class_instances, upstream_shifts)
+    _refresh(m.Shift, mirrored, disappeared)
+
+    now = make_aware(datetime.now())
+    created = []
+    for external_id, (class_instance, upstream) in new.items():
+        values = sync._parse_shift(upstream)
+        if values is None:
+            continue
+        if class_instance.external_id != upstream['class_instance_id']:
+            logger.critical("Consistency error. Shift upstream parent is not the local parent")
+            continue
+        created.append(m.Shift(
+            class_instance=class_instance,
+            **values,
+            external_id=external_id,
+            frozen=False,
+            external_update=now,
+            external_data={'upstream': upstream},
+            external_hash=sync.payload_hash(upstream)))
+    _bulk_create(m.Shift, created)
+    synced = {shift.external_id: (shift, new[shift.external_id][1]) for shift in created}
+    changed = dict(synced)
+
+    if recurse == Recursivity.FULL:
+        updated = []
+        for external_id, (obj, upstream) in mirrored.items():
+            digest = sync.payload_hash(upstream)
+            if obj.external_hash == digest:
+                continue
+            obj.external_hash = digest
+            upstream_details = {'state': upstream['state'], 'restrictions': upstream['restrictions']}
+            if not obj.frozen and obj.external_data != upstream_details:
+                obj.external_data = upstream_details
+            updated.append(obj)
+            changed[external_id] = (obj, upstream)
+        _bulk_update(m.Shift, updated, {'external_data', 'external_hash'})
+        # Shift instances have payloads of their own, which might have changed regardless
+        synced.update(mirrored)
+
+    _upstream_sync_shift_instances(synced, recurse)
+    _upstream_sync_shift_relations(changed)
+
+
+def _upstream_sync_shift_instances(shifts, recurse):
+    """
+    :param shifts: Dictionary of {external_id: (shift, upstream shift data)}
+    :param recurse: Whether to create (CREATION) or to create and update (FULL) the shift instances
+    """
+    upstream_instances = {
+        instance_id: (shift, None)
+        for shift, upstream in shifts.values()
+        for instance_id in upstream['instances']}
+    new, mirrored, disappeared = _upstream_diff(
+        m.ShiftInstance.objects, 'shift', [shift for shift, _ in shifts.values()], upstream_instances)
+    _refresh(m.ShiftInstance, mirrored, disappeared)
+
+    pending = list(new.keys())
+    if recurse == Recursivity.FULL:
+        pending += list(mirrored.keys())
+
+    # Shift instance data is not a part of the shift data, it has to be requested one by one
+    fetched = dict()
+    for external_id in pending:
+        try:
+            fetched[external_id] = sync._request_shift_instance(external_id)
+        except NetworkException:
+            logger.warning(f"Failed to sync shift instance {external_id}")
+
+    room_ids = {upstream.get('room') for upstream in fetched.values()}
+    room_ids.discard(None)
+    rooms = {room.external_id: room for room in m.Room.objects.filter(external_id__in=room_ids)}
+
+    now = make_aware(datetime.now())
+    created, updated, updated_fields = [], [], set()
+    for external_id, upstream in fetched.items():
+        digest = sync.payload_hash(upstream)
+        if external_id in mirrored and mirrored[external_id][0].external_hash == digest:
+            continue
+        values = sync._parse_shift_instance(upstream, external_id, rooms)
+        if values is None:
+            continue
+        if external_id in new:
+            shift = new[external_id][0]
+            if shift.external_id != upstream['shift']:
+                logger.critical("Consistency error. ShiftInstance upstream parent is not the local parent")
+                continue
+            created.append(m.ShiftInstance(
+                shift=shift,
+                **values,
+                external_id=external_id,
+                frozen=False,
+                external_update=now,
+                external_data={'upstream': upstream},
+                external_hash=digest))
+        else:
+            obj = mirrored[external_id][0]
+            room = values.pop('room')
+            values['room_id'] = None if room is None else room.id
+            values['external_data'] = upstream
+            values['external_hash'] = digest
+            changed = _assign(obj, values)
+            if changed:
+                if set(changed).difference({'external_data', 'external_hash'}):
+                    logger.warning(f"Shift instance {external_id} changed ({', '.join(changed)})")
+                updated.append(obj)
+                updated_fields.update(changed)
+    _bulk_create(m.ShiftInstance, created)
+    _bulk_update(m.ShiftInstance, updated, updated_fields)
+
+
+def _upstream_sync_shift_relations(shifts):
+    """
+    Synchronizes the students and teachers of several shifts
+    :param shifts: Dictionary of {external_id: (shift, upstream shift data)}
+    """
+    shifts = {shift.id: upstream for shift, upstream in shifts.values()}
+    _upstream_sync_m2m(
+        m.ShiftStudents,
+        m.ShiftStudents.objects.exclude(student__disappeared=True),
+        m.Student,
+        'student',
+        {shift_id: set(upstream['students']) for shift_id, upstream in shifts.items()})
+    _upstream_sync_m2m(
+        m.Shift.teachers.through,
+        m.Shift.teachers.through.objects,
+        m.Teacher,
+        'teacher',
+        {shift_id: set(upstream['teachers']) for shift_id, upstream in shifts.items()})
+
+
+def _upstream_sync_m2m(through, queryset, model, field, upstream):
+    """
+    Synchronizes a many-to-many relation between shifts and another importable model.
+    :param through: Relation model
+    :param queryset: Relation queryset with the links being considered
+    :param model: The related model
+    :param field: Name of the relation field that points to the related model
+    :param upstream: Dictionary of {shift id: set of related external ids}
+    """
+    current = defaultdict(dict)
+    links = queryset \
+        .filter(shift_id__in=upstream.keys()) \
+        .values_list('id', 'shift_id', f'{field}__external_id')
+    for link_id, shift_id, external_id in links:
+        current[shift_id][external_id] = link_id
+
+    removed = []
+    added = []
+    for shift_id, upstream_ids in upstream.items():
+        current_ids = current[shift_id]
+        removed.extend(link_id for external_id, link_id in current_ids.items() if external_id not in upstream_ids)
+        added.extend((shift_id, external_id) for external_id in upstream_ids.difference(current_ids))
+
+    for chunk in chunks(removed):
+        through.objects.filter(id__in=chunk).delete()
+
+    related = dict(model.objects
+                   .filter(external_id__in={external_id for _, external_id in added})
+                   .values_list('external_id', 'id'))
+    through.objects.bulk_create(
+        (through(shift_id=shift_id, **{f'{field}_id': related[external_id]})
+         for shift_id, external_id in added if external_id in related),
+        batch_size=CHUNK_SIZE)
+
+
+def _upstream_sync_events(class_instances, upstreams, recurse):
+    upstream_events = {
+        event['id']: (class_instance, event)
+        for class_instance, upstream in upstreams
+        for event in upstream['events']}
+    new, mirrored, disappeared = _upstream_diff(
+        m.ClassInstanceEvent.objects, 'class_instance', class_instances, upstream_events)
+    _refresh(m.ClassInstanceEvent, mirrored, disappeared)
+
+    now = make_aware(datetime.now())
+    created = []
+    for external_id, (class_instance, upstream) in new.items():
+        values = sync._parse_event(upstream, external_id)
+        if values is None:
+            continue
+        created.append(m.ClassInstanceEvent(
+            class_instance=class_instance,
+            **values,
+            external_id=external_id,
+            frozen=False,
+            external_update=now,
+            external_data={'upstream': upstream},
+            external_hash=sync.payload_hash(upstream)))
+    _bulk_create(m.ClassInstanceEvent, created)
+
+    if recurse == Recursivity.FULL:
+        updated, updated_fields = [], set()
+        for external_id, (obj, upstream) in mirrored.items():
+            digest = sync.payload_hash(upstream)
+            if obj.external_hash == digest:
+                continue
+            values = sync._parse_event(upstream, external_id)
+            if values is None:
+                continue
+            # Known dates are kept and times are only changed towards a known value
+            values.pop('date')
+            if values['time'] is None:
+                values.pop('time')
+                values.pop('duration')
+            elif values['duration'] is None:
+                values.pop('duration')
+            values['external_data'] = upstream
+            values['external_hash'] = digest
+            if changed := _assign(obj, values):
+                updated.append(obj)
+                updated_fields.update(changed)
+        _bulk_update(m.ClassInstanceEvent, updated, updated_fields)
+
+
+def _upstream_sync_enrollments(class_instances, upstreams, recurse):
+    upstream_enrollments = {
+        enrollment['id']: (class_instance, enrollment)
+        for class_instance, upstream in upstreams
+        for enrollment in upstream['enrollments']}
+    new, mirrored, disappeared = _upstream_diff(
+        m.Enrollment.objects.annotate(student_external_id=F('student__external_id')),
+        'class_instance', class_instances, upstream_enrollments)
+
+    # A student has a single enrollment per class instance, which gets reassigned when it is replaced upstream,
+    # be it between syncs (eg. enroll (id A) - sync - un-enroll - enroll (id B) - sync)
+    # or after it disappeared (eg. enroll (id A) - sync - un-enroll - sync - enroll (id B) - sync)
+    replaced = _replaced_enrollments(new, mirrored)
+    disappeared_ids = {obj.id for obj in disappeared}
+    reassigned = dict()
+    for external_id, (class_instance, upstream) in list(new.items()):
+        obj = replaced.pop((upstream['student'], class_instance.id), None)
+        if obj is not None:
+            obj.external_id = external_id
+            obj.disappeared = False
+            disappeared_ids.discard(obj.id)
+            reassigned[external_id] = (obj, new.pop(external_id)[1])
+    disappeared = [obj for obj in disappeared if obj.id in disappeared_ids]
+    _bulk_update(m.Enrollment, [obj for obj, _ in reassigned.values()], {'external_id', 'disappeared'})
+    mirrored.update(reassigned)
+    _refresh(m.Enrollment, mirrored, disappeared)
+    if recurse == Recursivity.NONE:
+        return
+
+    # Reassigned enrollments are updated even without a FULL recursion, as if they were new
+    pending = mirrored if recurse == Recursivity.FULL else reassigned
+    pending = {external_id: (obj, upstream) for external_id, (obj, upstream) in pending.items()
+               if obj.external_hash != sync.payload_hash(upstream)}
+    parsed = dict()
+    for external_id, (_, upstream) in list(new.items()) + list(pending.items()):
+        if (values := sync._parse_enrollment(upstream)) is not None:
+            parsed[external_id] = values
+    students = sync.students_by_external_id(
+        {upstream['student'] for external_id, (_, upstream) in new.items() if external_id in parsed}
+        | {obj.student_external_id for obj, _ in pending.values()})
+
+    now = make_aware(datetime.now())
+    student_years = dict()
+    created = []
+    for external_id, (class_instance, upstream) in new.items():
+        if (values := parsed.get(external_id)) is None:
+            continue
+        if (student := students.get(upstream['student'])) is None:
+            logger.error(f"Unable to sync enrollment {external_id}, student {upstream['student']} unavailable")
+            continue
+        created.append(m.Enrollment(
+            student=student,
+            class_instance=class_instance,
+            **values,
+            external_id=external_id,
+            frozen=False,
+            external_update=now,
+            external_data={'upstream': upstream},
+            external_hash=sync.payload_hash(upstream)))
+        _max_student_year(student_years, student, upstream)
+    _bulk_create(m.Enrollment, created)
+
+    updated, updated_fields = [], set()
+    for external_id, (obj, upstream) in pending.items():
+        if (values := parsed.get(external_id)) is None:
+            continue
+        if (student := students.get(obj.student_external_id)) is not None:
+            _max_student_year(student_years, student, upstream)
+        values['external_data'] = upstream
+        values['external_hash'] = sync.payload_hash(upstream)
+        if changed := _assign(obj, values):
+            for attr in sync.ENROLLMENT_GRADE_FIELDS:
+                if attr in changed:
+                    logger.warning(f"{attr} changed to {values[attr]} in enrollment {external_id}.")
+            updated.append(obj)
+            updated_fields.update(changed)
+    _bulk_update(m.Enrollment, updated, updated_fields)
+
+    _update_student_years(student_years)
+
+
+def _replaced_enrollments(new, mirrored):
+    """
+    Finds the stored enrollments (disappeared or not) which the new upstream enrollments might replace
+    :param new: Dictionary of {external_id: (class instance, upstream enrollment data)} of the new enrollments
+    :param mirrored: Dictionary of {external_id: (enrollment, upstream data)} of the enrollments still upstream
+    :return: Dictionary of {(student external id, class instance id): enrollment}
+    """
+    if not new:
+        return dict()
+    candidates = m.Enrollment.objects \
+        .annotate(student_external_id=F('student__external_id')) \
+        .filter(class_instance__in={class_instance.id for class_instance, _ in new.values()},
+                student__external_id__in={upstream['student'] for _, upstream in new.values()}) \
+        .exclude(external_id__in=list(mirrored.keys()))
+    return {(obj.student_external_id, obj.class_instance_id): obj for obj in candidates}
+
+
+def _max_student_year(student_years, student, upstream):
+    """
+    Keeps the greatest upstream year of each student
+    :param student_years: Dictionary of {student: year} being filled
+    :param student: Enrolled student
+    :param upstream: Upstream enrollment data
+    """
+    if (student_year := upstream['student_year']) is not None:
+        student_years[student] = max(student_year, student_years.get(student, student_year))
+
+
+def _update_student_years(student_years):
+    """
+    :param student_years: Dictionary of {student: upstream year}, which is applied when greater than the known one
+    """
+    updated = []
+    for student, student_year in student_years.items():
+        if student.year is None or student_year > student.year:
+            logger.info(f"Updated student {student.external_id} year ({student.year} to {student_year})")
+            student.year = student_year
+            updated.append(student)
+    _bulk_update(m.Student, updated, {'year'})
+
+
+def _upstream_diff(queryset, parent_field, parents, upstream):
+    """
+    Set-based generalization of :py:func:`clip.synchronization._upstream_diff`,
+    which diffs the objects of several parents with a single query.
+    :param queryset: Queryset of the objects being diff'd
+    :param parent_field: Name of the foreign key that links the objects to their parents
+    :param parents: Parents whose objects are being diff'd
+    :param upstream: Dictionary of {external_id: (parent, upstream data)} with the upstream objects of every parent
+    :return: New ({external_id: (parent, upstream data)}), mirrored ({external_id: (object, upstream data)})
+        and disappeared (list of objects) objects
+    """
+    parent_ids = {parent.id for parent in parents}
+    parent_id_attr = f'{parent_field}_id'
+    known = queryset \
+        .filter(Q(external_id__in=list(upstream.keys())) | Q(**{f'{parent_field}__in': parent_ids})) \
+        .exclude(external_id=None)
+
+    new = dict(upstream)
+    mirrored = dict()
+    disappeared = []
+    for obj in known:
+        external_id = obj.external_id
+        parent_id = getattr(obj, parent_id_attr)
+        if external_id in new:
+            parent, upstream_data = new.pop(external_id)
+            if parent_id == parent.id:
+                mirrored[external_id] = (obj, upstream_data)
+            else:
+                logger.critical(f"{queryset.model.__name__} {external_id} belongs to {parent_field} {parent_id}, "
+                                f"yet upstream it belongs to {parent.id}")
+        elif parent_id in parent_ids and not obj.disappeared:
+            disappeared.append(obj)
+    return new, mirrored, disappeared
+
+
+def _refresh(model, mirrored, disappeared):
+    """
+    Flags mirrored objects as updated and disappeared objects as disappeared.
+    :param model: Model of the objects
+    :param mirrored: Dictionary of {external_id: (object, upstream data)}
+    :param disappeared: List of objects
+    """
+    now = make_aware(datetime.now())
+    for chunk in chunks(obj.id for obj, _ in mirrored.values()):
+        model.objects.filter(id__in=chunk).update(disappeared=False, external_update=now)
+    for obj in disappeared:
+        logger.warning(f"{model.__name__} {obj.external_id} disappeared.")
+    for chunk in chunks(obj.id for obj in disappeared):
+        model.objects.filter(id__in=chunk).update(disappeared=True)
+
+
+def _assign(obj, values):
+    """
+    Sets the attributes of an object which differ from a set of values
+    :param obj: Object being changed
+    :param values: Dictionary of {attribute: value}
+    :return: List with the changed attributes
+    """
+    changed = []
+    for attr, value in values.items():
+        if getattr(obj, attr) != value:
+            setattr(obj, attr, value)
+            changed.append(attr)
+    return changed
+
+
+def _revision(model):
+    """
+    :return: A context for the writes to a model, with revisions when the model is versioned.
+    """
+    return reversion.create_revision() if reversion.is_registered(model) else transaction.atomic()
+
+
+def _add_to_revision(model, objs):
+    if reversion.is_registered(model):
+        for obj in objs:
+            reversion.add_to_revision(obj)
+
+
+def _bulk_create(model, objs):
+    for chunk in chunks(objs):
+        with _revision(model):
+            model.objects.bulk_create(chunk)
+            _add_to_revision(model, chunk)
+    for obj in objs:
+        logger.info(f"{model.__name__} {obj.external_id} created")
+
+
+def _bulk_update(model, objs, fields):
+    if len(objs) == 0 or len(fields) == 0:
+        return
+    fields = set(fields)
+    if issubclass(model, m.CachedEntity):
+        # Bulk updates skip the auto_now timestamp
+        now = timezone.now()
+        for obj in objs:
+            obj.last_save = now
+        fields.add('last_save')
+    for chunk in chunks(objs):
+        with _revision(model):
+            model.objects.bulk_update(chunk, fields)
+            _add_to_revision(model, chunk)
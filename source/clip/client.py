@@ -0,0 +1,150 @@
+"""
+HTTP client for the CLIPy service.
+
+Every request goes through a single keep-alive session with a connection pool, so that the thousands of requests of a
+synchronization reuse a few TCP connections. Failed requests are retried with an exponential backoff.
+The :py:func:`get_many` variant fans out requests concurrently through asyncio.
+"""
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import sleep
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+#: Defaults for the optional settings.CLIPY keys
+DEFAULTS = {
+    'timeout': 60,  # Seconds
+    'retries': 3,
+    'backoff': 1,  # Seconds, doubled after each attempt
+    'pool_size': 20,  # Kept alive connections
+    'concurrency': 10,  # Simultaneous requests in get_many
+}
+
+#: Marks the request options which default to the settings
+_DEFAULT = object()
+
+_lock = Lock()
+_session = None
+_executor = None
+
+
+class NetworkException(Exception):
+    pass
+
+
+def _setting(key):
+    return settings.CLIPY.get(key, DEFAULTS[key])
+
+
+def session():
+    """
+    :return: The shared CLIPy session
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=_setting('pool_size'))
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=_setting('concurrency'), thread_name_prefix='clipy')
+        return _executor
+
+
+def url(path):
+    """
+    :param path: Resource path (eg. 'class_inst/123')
+    :return: The resource URL
+    """
+    return f"http://{settings.CLIPY['host']}/{path}"
+
+
+def get(path, timeout=_DEFAULT, retries=_DEFAULT):
+    """
+    Requests a CLIPy resource, retrying connection failures and server errors with an exponential backoff
+    :param path: Resource path (eg. 'class_inst/123')
+    :param timeout: Seconds to wait for the response, None to wait indefinitely (defaults to the settings)
+    :param retries: Number of retries (defaults to the settings)
+    :return: The (successful) response
+    :raises NetworkException: If the resource could not be obtained
+    """
+    if timeout is _DEFAULT:
+        timeout = _setting('timeout')
+    if retries is _DEFAULT:
+        retries = _setting('retries')
+    backoff = _setting('backoff')
+    for attempt in range(retries + 1):
+        try:
+            response = session().get(url(path), timeout=timeout)
+        except requests.RequestException as e:
+            failure = str(e)
+        else:
+            if response.status_code == 200:
+                return response
+            failure = f"status code {response.status_code}"
+            if response.status_code < 500:
+                break
+        if attempt < retries:
+            logger.debug(f"Request to {path} failed ({failure}). Retrying.")
+            sleep(backoff * 2 ** attempt)
+    raise NetworkException(f"Unable to fetch {path} ({failure})")
+
+
+def request_update(path):
+    """
+    Requests an upstream update (eg. 'update/courses/').
+    Updates make CLIPy crawl CLIP, which can take long, so they are neither timed out nor retried
+    (a retry would trigger yet another crawl).
+    :param path: Update path
+    :return: The (successful) response
+    :raises NetworkException: If the update request failed
+    """
+    return get(path, timeout=None, retries=0)
+
+
+def get_json(path):
+    """
+    :param path: Resource path (eg. 'class_inst/123')
+    :return: The deserialized resource
+    :raises NetworkException: If the resource could not be obtained
+    """
+    return get(path).json()
+
+
+async def async_get(path, request=get):
+    """
+    Asyncio variant of :py:func:`get`. The requests run in a bounded thread pool, sharing the session pool.
+    :param request: Blocking request function (:py:func:`get` or :py:func:`request_update`)
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), request, path)
+
+
+def get_many(paths, request=get):
+    """
+    Requests several CLIPy resources concurrently
+    :param paths: Resource paths
+    :param request: Blocking request function (:py:func:`get` or :py:func:`request_update`)
+    :return: List with either the response or the raised NetworkException of each path, in order
+    """
+    async def gather():
+        return await asyncio.gather(*(async_get(path, request) for path in paths), return_exceptions=True)
+
+    results = asyncio.run(gather())
+    for result in results:
+        if isinstance(result, Exception) and not isinstance(result, NetworkException):
+            raise result
+    return results
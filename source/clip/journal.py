@@ -0,0 +1,163 @@
+"""
+Journal of the synchronization runs.
+
+The phases of a run and the items processed in them get recorded along with their durations and query counts.
+An interrupted run can then be resumed, skipping the phases it completed and the items it already synchronized.
+The records also tell which class instances, departments, ... are slow to synchronize.
+"""
+import logging
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+from django.utils import timezone
+
+from clip.models import SyncRun, SyncPhase, SyncRecord
+from clip.utils import QueryCounter
+
+logger = logging.getLogger(__name__)
+
+#: Number of records kept in memory before they get written
+FLUSH_SIZE = 200
+#: Number of finished runs of each type which are kept (along with any newer run)
+RUNS_KEPT = 20
+
+
+class Journal:
+    """
+    Journal of a synchronization run
+    """
+
+    def __init__(self, run):
+        self.run = run
+        self._phases = {phase.name: phase for phase in run.phases.all()}
+        self._records = []
+        self._failed = dict()
+        self._lock = Lock()
+
+    @classmethod
+    def start(cls, sync_type, arguments=None):
+        """
+        :param sync_type: Type of synchronization
+        :param arguments: Options of the synchronization
+        :return: Journal of a new run
+        """
+        return cls(SyncRun.objects.create(sync_type=sync_type, arguments=arguments or dict()))
+
+    @classmethod
+    def resume(cls, sync_type):
+        """
+        :param sync_type: Type of synchronization
+        :return: Journal of the last run of a type if it did not finish, None otherwise
+        """
+        run = SyncRun.objects.filter(sync_type=sync_type).order_by('-start').first()
+        if run is None or run.finished:
+            return None
+        return cls(run)
+
+    def completed(self, name):
+        """
+        :param name: Name of a phase
+        :return: Whether the phase was completed (without failures) by this run
+        """
+        phase = self._phases.get(name)
+        return phase is not None and phase.completed
+
+    def succeeded(self, name):
+        """
+        :param name: Name of a phase
+        :return: Set with the identification of the items which succeeded in the phase
+        """
+        self.flush()
+        return set(SyncRecord.objects
+                   .filter(phase__run=self.run, phase__name=name, success=True)
+                   .values_list('item', flat=True))
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Context of a phase, which gets timed and has its queries counted.
+        The phase is completed if the context exits normally and none of its items failed.
+        :param name: Name of the phase
+        """
+        with self._lock:
+            phase = self._phases.get(name)
+            if phase is None:
+                phase = self._phases[name] = SyncPhase.objects.create(run=self.run, name=name, start=timezone.now())
+            self._failed[name] = set()
+        start = perf_counter()
+        try:
+            with QueryCounter() as counter:
+                yield phase
+        finally:
+            self.flush()
+            phase.end = timezone.now()
+            phase.duration = (phase.duration or 0) + perf_counter() - start
+            phase.queries = (phase.queries or 0) + counter.count
+            phase.save(update_fields=['end', 'duration', 'queries'])
+        phase.completed = len(self._failed[name]) == 0
+        phase.save(update_fields=['completed'])
+
+    def record(self, name, item, duration, success, queries=None, flush=True):
+        """
+        Records the outcome of an item in an ongoing phase
+        :param name: Name of the phase
+        :param item: Identification of the item
+        :param duration: Time the item took (seconds)
+        :param success: Whether the item succeeded
+        :param queries: Number of queries done for the item
+        :param flush: Whether to write the pending records once there are enough of them. Callers which must not
+            touch the database leave them to be written by others (or once the phase ends).
+        """
+        item = str(item)
+        with self._lock:
+            self._records.append(SyncRecord(
+                phase=self._phases[name], item=item, duration=duration, success=success, queries=queries))
+            if success:
+                self._failed[name].discard(item)
+            else:
+                self._failed[name].add(item)
+            flush = flush and len(self._records) >= FLUSH_SIZE
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the pending records
+        """
+        with self._lock:
+            records, self._records = self._records, []
+        SyncRecord.objects.bulk_create(records)
+
+    def finish(self, success):
+        """
+        Ends the run
+        :param success: Whether the run finished without failures. Runs with failures can be resumed.
+        """
+        self.flush()
+        self.run.end = timezone.now()
+        self.run.finished = success
+        self.run.save(update_fields=['end', 'finished'])
+        pruned = self.prune(self.run.sync_type)
+        if pruned:
+            logger.info(f"Pruned {pruned} old {self.run.sync_type} runs")
+
+    @staticmethod
+    def prune(sync_type, keep=RUNS_KEPT):
+        """
+        Deletes the runs of a type which are older than the last finished ones
+        :param sync_type: Type of synchronization
+        :param keep: Number of finished runs which are kept
+        :return: Number of deleted runs
+        """
+        oldest_kept = SyncRun.objects \
+            .filter(sync_type=sync_type, finished=True) \
+            .order_by('-start') \
+            .values_list('start', flat=True)[keep - 1:keep]
+        if not oldest_kept:
+            return 0
+        old = SyncRun.objects.filter(sync_type=sync_type, start__lt=oldest_kept[0])
+        # The records are deleted first, with a single query, rather than collected by the cascade
+        SyncRecord.objects.filter(phase__run__in=old).delete()
+        SyncPhase.objects.filter(run__in=old).delete()
+        return old.delete()[0]
@@ -0,0 +1,99 @@
+import json
+import logging
+import shlex
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from clip.benchmark import Dataset, FakeClipy, Measurement
+from college import models as m
+
+COUNTED_MODELS = (m.Class, m.ClassInstance, m.Shift, m.ShiftInstance, m.Enrollment, m.Student, m.ClassFile)
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the CLIPy synchronization against a synthetic CLIPy, using a throwaway database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('phases', nargs='*', default=['full', 'fast', 'slow', 'incremental'],
+                            help="sync_clip types to run, in order. The first populates the database.")
+        parser.add_argument('--classes', type=int, default=500, help='Number of classes')
+        parser.add_argument('--instances_per_class', type=int, default=2, help='Instances per class')
+        parser.add_argument('--shifts', type=int, default=4, help='Shifts per class instance')
+        parser.add_argument('--enrollments', type=int, default=50, help='Enrollments per class instance')
+        parser.add_argument('--files', type=int, default=3, help='Files per class instance')
+        parser.add_argument('--students', type=int, default=5000, help='Number of students')
+        parser.add_argument('--teachers', type=int, default=300, help='Number of teachers')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data')
+        parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every CLIPy response')
+        parser.add_argument('--mutate', type=float, default=0.1,
+                            help='Fraction of the class instances which change upstream between phases')
+        parser.add_argument('--sync_args', default='', help='Additional sync_clip arguments (eg. "--bulk")')
+        parser.add_argument('--no_memory', action='store_true', help='Do not trace the memory (tracing is slow)')
+        parser.add_argument('--output', help='JSON file where the results get written')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the benchmark database')
+        parser.add_argument('--verbose', action='store_true', help='Show the synchronization logs')
+
+    def handle(self, *args, **options):
+        if not options['verbose']:
+            logging.disable(logging.INFO)
+
+        self.stdout.write("Generating the synthetic dataset")
+        dataset = Dataset(
+            settings.COLLEGE_YEAR,
+            classes=options['classes'],
+            instances_per_class=options['instances_per_class'],
+            shifts_per_instance=options['shifts'],
+            enrollments_per_instance=options['enrollments'],
+            files_per_instance=options['files'],
+            students=options['students'],
+            teachers=options['teachers'],
+            seed=options['seed'])
+
+        old_database_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        results = []
+        try:
+            with FakeClipy(dataset, latency=options['latency']) as server, \
+                    override_settings(CLIPY={**settings.CLIPY, 'host': server.host},
+                                      ELASTICSEARCH_DSL_AUTOSYNC=False):
+                for i, phase in enumerate(options['phases']):
+                    if i > 0 and options['mutate']:
+                        dataset.mutate(options['mutate'])
+                    sync_args = [phase, '--no_optimize', *shlex.split(options['sync_args'])]
+                    if i == 0:
+                        sync_args.append('--assert_buildings')
+
+                    self.stdout.write(f"Running sync_clip {' '.join(sync_args)}")
+                    requests = server.requests
+                    with Measurement(phase, memory=not options['no_memory']) as measurement:
+                        call_command('sync_clip', *sync_args)
+                    result = measurement.as_dict()
+                    result['requests'] = server.requests - requests
+                    result['rows'] = {model.__name__: model.objects.count() for model in COUNTED_MODELS}
+                    results.append(result)
+
+                    if i == 0:
+                        # Let the fast synchronization find ongoing class instances
+                        today = date.today()
+                        m.PeriodInstance.objects \
+                            .filter(year=dataset.year) \
+                            .update(date_from=today - timedelta(days=60), date_to=today + timedelta(days=60))
+        finally:
+            connection.creation.destroy_test_db(old_database_name, verbosity=0, keepdb=options['keepdb'])
+            logging.disable(logging.NOTSET)
+
+        self.stdout.write(f"{'Phase':<12}{'Time (s)':>10}{'Queries':>10}{'Requests':>10}{'Peak (MiB)':>12}")
+        for result in results:
+            peak = f"{result['peak_memory'] / 2 ** 20:.1f}" if result['peak_memory'] is not None else '-'
+            self.stdout.write(f"{result['phase']:<12}{result['elapsed']:>10.1f}{result['queries']:>10}"
+                              f"{result['requests']:>10}{peak:>12}")
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump({'options': {k: v for k, v in options.items() if k in (
+                    'phases', 'classes', 'instances_per_class', 'shifts', 'enrollments', 'files', 'students',
+                    'teachers', 'seed', 'latency', 'mutate', 'sync_args')}, 'results': results}, file, indent=2)
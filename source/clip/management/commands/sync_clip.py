@@ -1,30 +1,37 @@
 import logging
 from datetime import timedelta, datetime
-from queue import Queue
-from threading import Lock, Thread
-from time import sleep
+from functools import partial
+from time import perf_counter
 
 from django.core.management.base import BaseCommand
 from django.db.models import Q, Count
 from django.utils import timezone
 from django.conf import settings
 
-from clip import synchronization as sync
-from college import models as m
+from clip import synchronization as sync, bulk, pipeline, workers
+from clip.journal import Journal
+from clip.models import SyncCheckpoint
+from clip.utils import QueryCounter
+from college import models as m, occupation, occurrences, schedules
+from supernova import calendars
 
 logging.basicConfig(level=logging.INFO)
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
-THREADS = 10
+#: Overlap between incremental synchronizations, against clock differences
+CHECKPOINT_MARGIN = timedelta(minutes=5)
+#: Options which get stored in the run journal
+JOURNALED_OPTIONS = ('type', 'no_update', 'no_optimize', 'rooms', 'departments', 'courses', 'force_class_info',
+                     'bulk', 'workers', 'retries', 'pipeline', 'database_workers')
 
 
 class Command(BaseCommand):
     help = 'Update the service entities with the clip crawled entities.'
 
     def add_arguments(self, parser):
-        parser.add_argument('type', nargs='+', type=str)
+        parser.add_argument('type', nargs='+', type=str, help="One of 'fast', 'slow', 'full' or 'incremental'")
         parser.add_argument('--no_update', action='store_true',
                             help='Do not request CLIPy to update itself when prompting for data')
         parser.add_argument('--no_optimize', action='store_true',
@@ -34,11 +41,27 @@ class Command(BaseCommand):
         parser.add_argument('--departments', action='store_true', help='Synchronize departments')
         parser.add_argument('--courses', action='store_true', help='Synchronize courses')
         parser.add_argument('--force_class_info', action='store_true', help='Enforces that the class info is sync\'d')
+        parser.add_argument('--bulk', action='store_true',
+                            help='Synchronize class instances in batches, with set-based writes')
+        parser.add_argument('--workers', type=int, default=workers.WORKERS,
+                            help='Number of simultaneous synchronization tasks')
+        parser.add_argument('--retries', type=int, default=1, help='Number of times that failed tasks are retried')
+        parser.add_argument('--pipeline', action='store_true',
+                            help='Refresh, fetch and apply class instances as overlapping stages')
+        parser.add_argument('--database_workers', type=int, default=4,
+                            help='Number of simultaneous database writers in the pipeline')
+        parser.add_argument('--resume', action='store_true',
+                            help='Resume the last run of this type if it was interrupted or had failures')
 
     def handle(self, *args, **options):
+        # Occurrences are materialized once at the end instead of on every saved shift instance
+        with occurrences.deferred():
+            self.sync(options)
+
+    def sync(self, options):
         sync_type = options['type'][0]
-        if sync_type not in ("fast", "slow", "full"):
-            print("Bad type. Available types are: 'fast', 'slow' and 'full'.")
+        if sync_type not in ("fast", "slow", "full", "incremental"):
+            print("Bad type. Available types are: 'fast', 'slow', 'full' and 'incremental'.")
             exit(-1)
 
         update = not options['no_update']
@@ -48,74 +71,102 @@ class Command(BaseCommand):
         department_sync = options['departments']
         course_sync = options['courses']
         force_class_info = options['force_class_info']
+        bulk_sync = options['bulk']
+        failures = dict()
+
+        journal = Journal.resume(sync_type) if options['resume'] else None
+        if journal is not None:
+            log.info(f"Resuming the {journal.run}")
+        else:
+            if options['resume']:
+                log.info(f"There is no {sync_type} sync to resume")
+            journal = Journal.start(sync_type, {k: v for k, v in options.items() if k in JOURNALED_OPTIONS})
+
+        parallel_run = partial(
+            run, failures,
+            worker_count=options['workers'],
+            retries=options['retries'],
+            journal=journal)
+        pipelined = options['pipeline']
+        pipelined_sync = partial(
+            pipeline_run, failures,
+            network_workers=options['workers'],
+            database_workers=options['database_workers'],
+            journal=journal)
 
         # Very fast
         if assert_buildings:
             sync.assert_buildings_inserted()
-        if room_sync or sync_type == "full":
-            if update:
-                sync.request_rooms_update()
-            log.info("Syncing rooms")
-            sync.sync_rooms()
-        if course_sync or sync_type == "full":
-            if update:
-                sync.request_courses_update()
-            log.info("Syncing courses")
-            sync.sync_courses()
-        if department_sync or sync_type == "full":
-            log.info("Syncing departments")
-            sync.sync_departments()
+        if (room_sync or sync_type == "full") and not journal.completed("Rooms"):
+            with journal.phase("Rooms"):
+                if update:
+                    sync.request_rooms_update()
+                log.info("Syncing rooms")
+                sync.sync_rooms()
+        if (course_sync or sync_type == "full") and not journal.completed("Courses"):
+            with journal.phase("Courses"):
+                if update:
+                    sync.request_courses_update()
+                log.info("Syncing courses")
+                sync.sync_courses()
+        if (department_sync or sync_type == "full") and not journal.completed("Departments"):
+            with journal.phase("Departments"):
+                log.info("Syncing departments")
+                sync.sync_departments()
 
         today = datetime.today()
+        # Resumed runs also touched entities before the interruption
+        sync_start = journal.run.start
 
         if sync_type == "fast":
             # Update (upstream) particularly relevant class instances
             logging.info("Syncing class instances")
-            period_instances = m.PeriodInstance.objects.filter(date_from__lte=today, date_to__gte=today)
-            class_instances = m.ClassInstance.objects \
-                .select_related('parent') \
-                .annotate(enrollment_count=Count('enrollments')) \
-                .annotate(shift_count=Count('shifts')) \
-                .filter(Q(enrollment_count__gt=0) | Q(shift_count__gt=0),
-                        period_instance__in=period_instances,
-                        external_update__lt=timezone.now() - timedelta(hours=4 if optimize else 0)) \
-                .exclude(Q(disappeared=True) | Q(external_id=None)) \
-                .all()
-            if update:
-                parallel_run(
-                    class_instances,
-                    lambda i: sync.request_class_instance_update(
-                        external_id=i.external_id,
-                        update_info=force_class_info,
-                        update_enrollments=True,
-                        update_shifts=True,
-                        update_files=True))
-            # Synchronize them
-            parallel_run(class_instances, fast_instance_update)
+            class_instances = active_class_instances(today, optimize)
+            refresh = partial(
+                sync.request_class_instance_update,
+                update_info=force_class_info,
+                update_enrollments=True,
+                update_shifts=True,
+                update_files=True)
+            if pipelined:
+                pipelined_sync(class_instances, sync.Recursivity.CREATION, refresh if update else None)
+            else:
+                if update:
+                    parallel_run(
+                        class_instances,
+                        lambda i: refresh(i.external_id),
+                        label="Class instance upstream updates")
+                # Synchronize them
+                sync_class_instances(class_instances, sync.Recursivity.CREATION, bulk_sync, parallel_run)
 
             propagate_disappearances()
 
         elif sync_type == "slow":
             # Update upstream class data, will create related data but it wont update existing data
+            if update and not journal.completed("Upstream classes"):
+                with journal.phase("Upstream classes"):
+                    log.info("Updating upstream classes")
+                    sync.request_classes_update()
             if update:
-                log.info("Updating upstream classes")
-                sync.request_classes_update()
+                # Journaled on its own, resumed runs only request the departments which did not succeed
                 log.info("Requesting teachers update")
-
                 parallel_run(
-                    m.Department.objects.values_list('external_id', flat=True)[3:],
-                    lambda d: sync.request_teachers_update(d))
-                for department in m.Department.objects.values_list('external_id', flat=True):
-                    sync.request_teachers_update(department)
+                    m.Department.objects.values_list('external_id', flat=True),
+                    lambda d: sync.request_teachers_update(d),
+                    label="Teacher upstream updates")
 
-            sync.sync_classes(sync.Recursivity.CREATION)
+            if not journal.completed("Class list"):
+                with journal.phase("Class list"):
+                    sync.sync_classes(sync.Recursivity.CREATION)
 
             # Sync classes with recursive creation
             log.info("Synchronizing classes")
-            for klass in m.Class.objects \
-                    .exclude(Q(disappeared=True) | Q(external_id=None),
-                             external_update__lt=timezone.now() - timedelta(days=1 if optimize else 0)):
-                sync.sync_class(klass.external_id, recurse=sync.Recursivity.CREATION)
+            parallel_run(
+                m.Class.objects.exclude(
+                    Q(disappeared=True) | Q(external_id=None),
+                    external_update__lt=timezone.now() - timedelta(days=1 if optimize else 0)),
+                lambda klass: sync.sync_class(klass.external_id, recurse=sync.Recursivity.CREATION),
+                label="Classes")
 
             # Update class instances upstream data and synchronize
             # the updated data with every class instance derivative
@@ -126,44 +177,53 @@ class Command(BaseCommand):
                 .exclude(Q(disappeared=True) | Q(external_id=None)) \
                 .all()
 
-            if update:
-                log.info("Updating class instances")
-                parallel_run(
-                    class_instances,
-                    lambda i: sync.request_class_instance_update(
-                        external_id=i.external_id,
-                        update_info=force_class_info,
-                        update_enrollments=True,
-                        update_shifts=True,
-                        update_events=True,
-                        update_grades=True,
-                        update_files=True))
-
-            # Synchronize found students
-            log.info("Syncing students")
-            sync.sync_students()
-
-            logging.info("Syncing class instances")
-            parallel_run(class_instances, slow_instance_update)
+            refresh = partial(
+                sync.request_class_instance_update,
+                update_info=force_class_info,
+                update_enrollments=True,
+                update_shifts=True,
+                update_events=True,
+                update_grades=True,
+                update_files=True)
+            if pipelined:
+                # Students found during the refresh are synchronized as their enrollments get applied
+                sync_students(journal)
+                logging.info("Updating and syncing class instances")
+                pipelined_sync(class_instances, sync.Recursivity.FULL, refresh if update else None)
+            else:
+                if update:
+                    log.info("Updating class instances")
+                    parallel_run(
+                        class_instances,
+                        lambda i: refresh(i.external_id),
+                        label="Class instance upstream updates")
+
+                # Synchronize found students
+                sync_students(journal)
+
+                logging.info("Syncing class instances")
+                sync_class_instances(class_instances, sync.Recursivity.FULL, bulk_sync, parallel_run)
             propagate_disappearances()
 
-            if update or not optimize:
-                log.info("Syncing teachers")
-                sync.sync_teachers()
+            if (update or not optimize) and not journal.completed("Teachers"):
+                with journal.phase("Teachers"):
+                    log.info("Syncing teachers")
+                    sync.sync_teachers()
 
         elif sync_type == "full":
-            if update:
-                # Update the National access contest, no dependencies
-                log.info("Updating upstream admission data")
-                sync.request_admissions_update()
+            if update and not journal.completed("Upstream classes"):
+                with journal.phase("Upstream classes"):
+                    # Update the National access contest, no dependencies
+                    log.info("Updating upstream admission data")
+                    sync.request_admissions_update()
 
-                # Update upstream class data, will create related data but it wont update existing data
-                log.info("Updating upstream classes")
-                sync.request_classes_update()
+                    # Update upstream class data, will create related data but it wont update existing data
+                    log.info("Updating upstream classes")
+                    sync.request_classes_update()
 
-                log.info("Requesting teachers update")
-                for department in m.Department.objects.values_list('external_id', flat=True):
-                    sync.request_teachers_update(department)
+                    log.info("Requesting teachers update")
+                    for department in m.Department.objects.values_list('external_id', flat=True):
+                        sync.request_teachers_update(department)
 
             # Store the current class instance data to request eventual update after the classes are updated
             # (to avoid duplicated updates)
@@ -171,15 +231,18 @@ class Command(BaseCommand):
                 .exclude(Q(disappeared=True) | Q(external_id=None)) \
                 .values_list('id', flat=True)
 
-            log.info("Synchronizing classes")
-            sync.sync_classes(sync.Recursivity.FULL)
+            if not journal.completed("Class list"):
+                with journal.phase("Class list"):
+                    log.info("Synchronizing classes")
+                    sync.sync_classes(sync.Recursivity.FULL)
 
             log.info("Synchronizing leftover class instances")
             # Sync classes with recursive creation
             parallel_run(
                 m.Class.objects.exclude(Q(disappeared=True) | Q(external_id=None) | Q(
                     external_update__gt=timezone.now() - timedelta(days=5 if optimize else 0))),
-                lambda klass: sync.sync_class(klass.external_id, recurse=sync.Recursivity.CREATION))
+                lambda klass: sync.sync_class(klass.external_id, recurse=sync.Recursivity.CREATION),
+                label="Classes")
 
             # Propagate disappearances here to ensure that disappeared class derivatives are synchronized
             propagate_disappearances()
@@ -192,46 +255,169 @@ class Command(BaseCommand):
                 .select_related('parent') \
                 .exclude(disappeared=True) \
                 .all()
-            if update:
-                parallel_run(
-                    previous_class_instances,
-                    lambda i: sync.request_class_instance_update(
-                        external_id=i.external_id,
-                        update_info=True,
-                        update_enrollments=True,
-                        update_shifts=True,
-                        update_events=True,
-                        update_grades=True,
-                        update_files=True))
-
-            # Synchronize leftover students
-            log.info("Syncing students")
-            sync.sync_students()
+            refresh = partial(
+                sync.request_class_instance_update,
+                update_info=True,
+                update_enrollments=True,
+                update_shifts=True,
+                update_events=True,
+                update_grades=True,
+                update_files=True)
+            if pipelined:
+                sync_students(journal)
+                pipelined_sync(previous_class_instances, sync.Recursivity.FULL, refresh if update else None)
+            else:
+                if update:
+                    parallel_run(
+                        previous_class_instances,
+                        lambda i: refresh(i.external_id),
+                        label="Class instance upstream updates")
 
-            logging.info("Syncing class instances")
-            parallel_run(
-                previous_class_instances,
-                lambda i: sync.sync_class_instance(i.external_id, recurse=sync.Recursivity.FULL))
+                # Synchronize leftover students
+                sync_students(journal)
+
+                logging.info("Syncing class instances")
+                sync_class_instances(previous_class_instances, sync.Recursivity.FULL, bulk_sync, parallel_run)
 
             # By now every shift is known
-            log.info("Syncing teachers")
-            if update:
-                for department in m.Department.objects.values_list('external_id', flat=True):
-                    sync.request_teachers_update(department)
-            sync.sync_teachers()
+            if not journal.completed("Teachers"):
+                with journal.phase("Teachers"):
+                    log.info("Syncing teachers")
+                    if update:
+                        for department in m.Department.objects.values_list('external_id', flat=True):
+                            sync.request_teachers_update(department)
+                    sync.sync_teachers()
+
+        elif sync_type == "incremental":
+            # Synchronize only the class instances that CLIPy reports as changed since the last checkpoint.
+            # CLIPy is expected to be crawling on its own, so no updates are requested.
+            start = timezone.now()
+            checkpoint = SyncCheckpoint.objects.filter(name='class_instance').first()
+            changed_ids = None
+            if checkpoint is not None:
+                changed_ids = sync.request_changed_class_instances(checkpoint.timestamp - CHECKPOINT_MARGIN)
+
+            if changed_ids is None:
+                log.info("Upstream changes are unknown. Syncing every active class instance.")
+                class_instances = active_class_instances(today, optimize)
+                recurse = sync.Recursivity.CREATION
+            else:
+                log.info(f"{len(changed_ids)} class instances changed since {checkpoint.timestamp}")
+                class_instances = m.ClassInstance.objects \
+                    .select_related('parent') \
+                    .filter(external_id__in=changed_ids) \
+                    .exclude(disappeared=True)
+                recurse = sync.Recursivity.FULL
+
+            if pipelined:
+                pipelined_sync(class_instances, recurse, None)
+            else:
+                sync_class_instances(class_instances, recurse, bulk_sync, parallel_run)
+            propagate_disappearances()
+            if len(failures) == 0:
+                SyncCheckpoint.objects.update_or_create(name='class_instance', defaults={'timestamp': start})
         else:
             raise Exception("Invalid option")
 
-        update_cached()
+        # Partial synchronizations only affect the cached data of the entities they touched
+        with journal.phase("Cached data"):
+            update_cached(sync_start if sync_type in ("fast", "incremental") and optimize else None)
+        with journal.phase("Course schedules"):
+            schedules.precompute_course_schedules()
+        with journal.phase("Occurrences"):
+            occurrences.materialize()
+        # Bulk writes skip the signals which keep the room occupation and schedules up to date
+        occupation.invalidate()
+        calendars.invalidate_shifts()
+
+        for label, failed in failures.items():
+            log.error(f"{label} failed for {[workers.identify(item) for item in failed]}")
+        journal.finish(len(failures) == 0)
+
+
+def sync_students(journal):
+    if not journal.completed("Students"):
+        with journal.phase("Students"):
+            log.info("Syncing students")
+            sync.sync_students()
 
 
-def update_cached():
+def update_cached(since=None):
+    """
+    Recalculates the data derived from the synchronized entities
+    :param since: Only recalculate the data of entities synchronized since this moment (optional)
+    """
     log.info("Updating cached data")
-    sync.calculate_active_classes()
-    for student in m.Student.objects.all():
-        student.update_progress_info()
-    for teacher in m.Teacher.objects.all():
-        teacher.update_yearspan()
+    start = perf_counter()
+    with QueryCounter() as counter:
+        sync.calculate_active_classes(since)
+        sync.calculate_student_progress(since)
+        sync.calculate_teacher_yearspans(since)
+    log.info(f"Updated cached data in {perf_counter() - start:.1f}s with {counter.count} queries")
+
+
+def active_class_instances(today, optimize):
+    """
+    :return: Class instances of the ongoing periods that have either enrollments or shifts
+    """
+    period_instances = m.PeriodInstance.objects.filter(date_from__lte=today, date_to__gte=today)
+    return m.ClassInstance.objects \
+        .select_related('parent') \
+        .annotate(enrollment_count=Count('enrollments')) \
+        .annotate(shift_count=Count('shifts')) \
+        .filter(Q(enrollment_count__gt=0) | Q(shift_count__gt=0),
+                period_instance__in=period_instances,
+                external_update__lt=timezone.now() - timedelta(hours=4 if optimize else 0)) \
+        .exclude(Q(disappeared=True) | Q(external_id=None)) \
+        .all()
+
+
+def sync_class_instances(class_instances, recurse, bulk_sync, parallel_run):
+    """
+    Synchronizes class instances (and their derivatives), logging the time and queries it took
+    :param class_instances: Class instances being synchronized
+    :param recurse: Recursivity of the synchronization (either CREATION or FULL)
+    :param bulk_sync: Whether to use the set-based synchronization
+    :param parallel_run: Parallel runner of the synchronization tasks
+    """
+    class_instances = list(class_instances)
+    start = perf_counter()
+    with QueryCounter() as counter:
+        if bulk_sync:
+            parallel_run(
+                bulk.chunks(class_instances, bulk.BATCH_SIZE),
+                lambda batch: bulk.sync_class_instances(batch, recurse=recurse),
+                label="Class instance batches")
+        elif recurse == sync.Recursivity.CREATION:
+            parallel_run(class_instances, fast_instance_update, label="Class instances")
+        else:
+            parallel_run(class_instances, slow_instance_update, label="Class instances")
+    log.info(f"Synchronized {len(class_instances)} class instances "
+             f"in {perf_counter() - start:.1f}s with {counter.count} queries")
+
+
+def pipeline_run(failures, class_instances, recurse, refresh, network_workers, database_workers, journal=None):
+    """
+    Synchronizes class instances with the streaming pipeline, logging the time and queries it took
+    :param failures: Dictionary of {label: failed items} that is extended with the run failures
+    :param class_instances: Class instances being synchronized
+    :param recurse: Recursivity of the synchronization (either CREATION or FULL)
+    :param refresh: Function that requests CLIPy to refresh a class instance (None to skip the refresh)
+    :param network_workers: Number of workers in each of the network stages
+    :param database_workers: Number of workers in the database stage
+    :param journal: Journal of the synchronization run (optional)
+    """
+    start = perf_counter()
+    with QueryCounter() as counter:
+        failed = pipeline.sync_class_instances(
+            class_instances, recurse,
+            refresh=refresh,
+            network_workers=network_workers,
+            database_workers=database_workers,
+            journal=journal)
+    for stage, external_ids in failed.items():
+        failures.setdefault(f"Class instance {stage.lower()}", []).extend(external_ids)
+    log.info(f"Pipeline finished in {perf_counter() - start:.1f}s with {counter.count} queries")
 
 
 def fast_instance_update(instance):
@@ -248,36 +434,6 @@ def slow_instance_update(instance):
         recurse=sync.Recursivity.FULL)
 
 
-class ParallelQueueProcessor(Thread):
-    def __init__(self, queue, lock, function):
-        Thread.__init__(self)
-        self.queue = queue
-        self.lock = lock
-        self.function = function
-
-    def run(self):
-        failures = 0
-        while True:
-            self.lock.acquire()
-            remaining = self.queue.qsize()
-            if remaining:
-                object = self.queue.get()
-                self.lock.release()
-                try:
-                    log.debug(f'Synchronizing {object}')
-                    print(f"{remaining} objects remaining")
-                    self.function(object)
-                except sync.NetworkException:
-                    log.error(f'Failed to sync {object}')
-                    failures += 1
-                    if failures > 5:
-                        log.error(f"Failed to synchronize {object} for more than 5 times")
-                        sleep(5)
-            else:
-                self.lock.release()
-                break
-
-
 def propagate_disappearances():
     m.ClassInstance.objects.filter(disappeared=False, parent__disappeared=True).update(disappeared=True)
     m.Shift.objects.filter(disappeared=False, class_instance__disappeared=True).update(disappeared=True)
@@ -286,14 +442,11 @@ def propagate_disappearances():
     m.ClassFile.objects.filter(disappeared=False, class_instance__disappeared=True).update(disappeared=True)
 
 
-def parallel_run(iterable, function):
-    lock = Lock()
-    item_queue = Queue()
-    [item_queue.put(obj) for obj in iterable]
-    threads = []
-    for thread in range(0, THREADS):
-        synchronizer = ParallelQueueProcessor(item_queue, lock, function)
-        threads.append(synchronizer)
-        synchronizer.start()
-    for thread in threads:
-        thread.join()
+def run(failures, iterable, function, worker_count=workers.WORKERS, retries=0, label="Tasks", journal=None):
+    """
+    Runs a function over an iterable with a pool of workers, keeping the items which failed
+    :param failures: Dictionary of {label: failed items} that is extended with the run failures
+    """
+    failed = workers.run(iterable, function, workers=worker_count, retries=retries, label=label, journal=journal)
+    if failed:
+        failures.setdefault(label, []).extend(failed)
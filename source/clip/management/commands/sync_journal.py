@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from clip.models import SyncRun, SyncRecord
+
+
+class Command(BaseCommand):
+    help = 'Reports the phases and the slowest items of a synchronization run.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('run', nargs='?', type=int, help='Run id (defaults to the last run)')
+        parser.add_argument('--slowest', type=int, default=10, help='Number of slowest items listed')
+
+    def handle(self, *args, **options):
+        runs = SyncRun.objects.order_by('-start')
+        run = runs.filter(id=options['run']).first() if options['run'] else runs.first()
+        if run is None:
+            self.stderr.write("No such run")
+            return
+
+        state = 'finished' if run.finished else ('interrupted' if run.end is None else 'with failures')
+        self.stdout.write(f"Run {run.id}: {run} ({state})")
+        self.stdout.write(f"{'Phase':<36}{'Time (s)':>10}{'Queries':>10}{'Items':>8}{'Failed':>8}")
+        for phase in run.phases.order_by('start'):
+            records = phase.records
+            duration = f"{phase.duration:.1f}" if phase.duration is not None else '-'
+            self.stdout.write(f"{phase.name:<36}{duration:>10}{phase.queries or '-':>10}"
+                              f"{records.count():>8}{records.filter(success=False).count():>8}")
+
+        slowest = SyncRecord.objects \
+            .filter(phase__run=run) \
+            .select_related('phase') \
+            .order_by('-duration')[:options['slowest']]
+        if slowest:
+            self.stdout.write(f"\n{'Slowest items':<36}{'Time (s)':>10}{'Queries':>10}")
+            for record in slowest:
+                self.stdout.write(f"{f'{record.phase.name} {record.item}'[:35]:<36}{record.duration:>10.2f}"
+                                  f"{record.queries if record.queries is not None else '-':>10}")
@@ -0,0 +1,55 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clip', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sync_type', models.CharField(max_length=16)),
+                ('arguments', models.JSONField(blank=True, default=dict)),
+                ('start', models.DateTimeField(auto_now_add=True)),
+                ('end', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SyncPhase',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64)),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField(blank=True, null=True)),
+                ('duration', models.FloatField(blank=True, null=True)),
+                ('queries', models.IntegerField(blank=True, null=True)),
+                ('completed', models.BooleanField(default=False)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='phases',
+                                          to='clip.syncrun')),
+            ],
+            options={
+                'unique_together': {('run', 'name')},
+            },
+        ),
+        migrations.CreateModel(
+            name='SyncRecord',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('item', models.CharField(max_length=256)),
+                ('success', models.BooleanField()),
+                ('duration', models.FloatField()),
+                ('queries', models.IntegerField(blank=True, null=True)),
+                ('phase', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='records',
+                                            to='clip.syncphase')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['phase', 'item'], name='clip_syncre_phase_i_0c6d2e_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,68 @@
+from django.db import models as djm
+
+
+class SyncCheckpoint(djm.Model):
+    """Moment up to which the upstream changes of a kind of entity are known to be synchronized"""
+    #: Name of the synchronized entity kind (eg. 'class_instance')
+    name = djm.CharField(max_length=32, unique=True)
+    #: Moment at which the last successful synchronization started
+    timestamp = djm.DateTimeField()
+
+    def __str__(self):
+        return f"{self.name} ({self.timestamp})"
+
+
+class SyncRun(djm.Model):
+    """Execution of the synchronization command, whose progress is journaled so that it can be resumed"""
+    #: Type of synchronization (eg. 'full')
+    sync_type = djm.CharField(max_length=16)
+    #: Command options
+    arguments = djm.JSONField(default=dict, blank=True)
+    #: Moment at which the run started
+    start = djm.DateTimeField(auto_now_add=True)
+    #: Moment at which the run ended (or was last resumed and ended)
+    end = djm.DateTimeField(null=True, blank=True)
+    #: Whether the run reached the end
+    finished = djm.BooleanField(default=False)
+
+    def __str__(self):
+        return f"{self.sync_type} sync of {self.start}"
+
+
+class SyncPhase(djm.Model):
+    """Step of a synchronization run"""
+    run = djm.ForeignKey(SyncRun, on_delete=djm.CASCADE, related_name='phases')
+    #: Name of the phase (eg. 'Class instances')
+    name = djm.CharField(max_length=64)
+    start = djm.DateTimeField()
+    end = djm.DateTimeField(null=True, blank=True)
+    #: Time the phase took (seconds)
+    duration = djm.FloatField(null=True, blank=True)
+    #: Number of database queries done during the phase
+    queries = djm.IntegerField(null=True, blank=True)
+    #: Whether every item of the phase succeeded
+    completed = djm.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ['run', 'name']
+
+    def __str__(self):
+        return f"{self.name} ({self.run})"
+
+
+class SyncRecord(djm.Model):
+    """Outcome of synchronizing an item (usually an external id) in a phase of a synchronization run"""
+    phase = djm.ForeignKey(SyncPhase, on_delete=djm.CASCADE, related_name='records')
+    #: Item identification, as given by :py:func:`clip.workers.identify`
+    item = djm.CharField(max_length=256)
+    success = djm.BooleanField()
+    #: Time the item took (seconds)
+    duration = djm.FloatField()
+    #: Number of database queries done for the item
+    queries = djm.IntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [djm.Index(fields=['phase', 'item'])]
+
+    def __str__(self):
+        return f"{self.item} ({self.phase})"
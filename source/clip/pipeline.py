@@ -0,0 +1,222 @@
+"""
+Streaming synchronization of class instances.
+
+The synchronization of a class instance has three steps: requesting CLIPy to refresh it from CLIP,
+fetching its data from CLIPy and applying that data to the database.
+Instead of doing every refresh, then every fetch, then every apply, the steps run as stages connected by bounded queues,
+so that the database writes of a class instance overlap with the network requests of the next ones.
+"""
+import logging
+from contextlib import ExitStack
+from queue import Queue
+from threading import Thread, Lock
+from time import perf_counter
+
+from django.db import close_old_connections
+
+from clip import synchronization as sync
+from clip.client import NetworkException
+from clip.utils import ThreadQueryCounter
+from clip.workers import identify
+
+logger = logging.getLogger(__name__)
+
+#: Number of items that each queue holds before blocking the stage that feeds it
+QUEUE_SIZE = 50
+
+_DONE = object()
+
+
+class Stage:
+    """
+    Step of a pipeline, which applies a function to its input items with a number of worker threads.
+    The function result is passed to the next stage, unless it is None.
+    """
+
+    def __init__(self, name, function, workers, database=False, key=identify):
+        """
+        :param name: Name of the stage, used in the logs
+        :param function: Function applied to each item
+        :param workers: Number of worker threads
+        :param database: Whether the function uses the database
+        :param key: Function that identifies the items in the logs and failures
+        """
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.database = database
+        self.key = key
+        self.input = Queue(maxsize=QUEUE_SIZE)
+        self.output = None
+        self.journal = None
+        self.processed = 0
+        self.failed = []
+        self.busy = 0.0  # Time spent in the function
+        self.starved = 0.0  # Time spent waiting for input
+        self.blocked = 0.0  # Time spent waiting for the next stage to accept output
+        self.start = None
+        self.end = None
+        self._remaining_workers = workers
+        self._lock = Lock()
+
+    def work(self):
+        with self._lock:
+            if self.start is None:
+                self.start = perf_counter()
+        try:
+            while True:
+                wait_start = perf_counter()
+                item = self.input.get()
+                task_start = perf_counter()
+                if item is _DONE:
+                    break
+                result = None
+                success = False
+                counter = ThreadQueryCounter()
+                if self.database:
+                    close_old_connections()
+                try:
+                    with counter:
+                        result = self.function(item)
+                    success = True
+                except NetworkException as e:
+                    logger.error(f"{self.name} failed for {self.key(item)}: {e}")
+                except Exception:
+                    logger.exception(f"{self.name} failed unexpectedly for {self.key(item)}")
+                finally:
+                    if self.database:
+                        close_old_connections()
+                task_end = perf_counter()
+                if self.journal is not None:
+                    # Only database stages write the pending records, the others leave them for later
+                    try:
+                        self.journal.record(self.name, self.key(item), task_end - task_start, success, counter.count,
+                                            flush=self.database)
+                    except Exception:
+                        logger.exception(f"{self.name} failed to journal {self.key(item)}")
+                if success and result is not None and self.output is not None:
+                    self.output.put(result)
+                with self._lock:
+                    self.starved += task_start - wait_start
+                    self.busy += task_end - task_start
+                    self.blocked += perf_counter() - task_end
+                    self.processed += 1
+                    if not success:
+                        self.failed.append(self.key(item))
+        finally:
+            # The next stage must always be ended, or the pipeline would never finish
+            with self._lock:
+                self._remaining_workers -= 1
+                last = self._remaining_workers == 0
+                if last:
+                    self.end = perf_counter()
+            if last and self.output is not None:
+                self.output.put(_DONE)
+
+    def summary(self):
+        elapsed = (self.end or perf_counter()) - (self.start or perf_counter())
+        throughput = self.processed / elapsed if elapsed else 0
+        capacity = elapsed * self.workers
+        return f"{self.name}: {self.processed} items ({len(self.failed)} failed) in {elapsed:.1f}s, " \
+               f"{throughput:.1f}/s. " \
+               f"Workers were busy {100 * self.busy / capacity if capacity else 0:.0f}%, " \
+               f"starved {100 * self.starved / capacity if capacity else 0:.0f}% " \
+               f"and blocked {100 * self.blocked / capacity if capacity else 0:.0f}% of the time."
+
+
+class Pipeline:
+    """
+    Sequence of stages connected by bounded queues
+    """
+
+    def __init__(self, stages, journal=None):
+        """
+        :param stages: Stages, in order
+        :param journal: :py:class:`clip.journal.Journal` where each stage is recorded as a phase (optional)
+        """
+        self.stages = stages
+        self.journal = journal
+        for stage in stages:
+            stage.journal = journal
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.output = _Broadcast(next_stage.input, next_stage.workers)
+
+    def run(self, items):
+        """
+        Processes items through every stage
+        :param items: Items fed to the first stage
+        :return: The identifiers of the items that failed in each of the stages, by stage name
+        """
+        with ExitStack() as phases:
+            if self.journal is not None:
+                for stage in self.stages:
+                    phases.enter_context(self.journal.phase(stage.name))
+            threads = [Thread(target=stage.work, name=f"{stage.name}-{i}")
+                       for stage in self.stages for i in range(stage.workers)]
+            for thread in threads:
+                thread.start()
+            first = self.stages[0]
+            for item in items:
+                first.input.put(item)
+            for _ in range(first.workers):
+                first.input.put(_DONE)
+            for thread in threads:
+                thread.join()
+
+        for stage in self.stages:
+            logger.info(stage.summary())
+        return {stage.name: stage.failed for stage in self.stages if stage.failed}
+
+
+class _Broadcast:
+    """
+    Output of a stage, which ends the next stage once every worker of the former is done.
+    """
+
+    def __init__(self, queue, consumers):
+        self.queue = queue
+        self.consumers = consumers
+
+    def put(self, item):
+        if item is _DONE:
+            for _ in range(self.consumers):
+                self.queue.put(_DONE)
+        else:
+            self.queue.put(item)
+
+
+def sync_class_instances(class_instances, recurse, refresh=None, network_workers=10, database_workers=4,
+                         journal=None):
+    """
+    Synchronizes class instances with a refresh -> fetch -> apply pipeline
+    :param class_instances: Class instances being synchronized (with their parent class)
+    :param recurse: Recursivity of the synchronization
+    :param refresh: Function that requests CLIPy to refresh a class instance, given its external id (optional)
+    :param network_workers: Number of workers in the network stages
+    :param database_workers: Number of workers in the database stage
+    :param journal: :py:class:`clip.journal.Journal` of the synchronization (optional).
+        Class instances which were already applied are skipped.
+    :return: The external ids of the class instances that failed in each of the stages, by stage name
+    """
+    if journal is not None and (applied := journal.succeeded("Apply")):
+        class_instances = [class_instance for class_instance in class_instances
+                           if str(class_instance.external_id) not in applied]
+
+    def refresh_stage(class_instance):
+        refresh(class_instance.external_id)
+        return class_instance
+
+    def fetch_stage(class_instance):
+        return class_instance, sync._request_class_instance(class_instance.external_id)
+
+    def apply_stage(fetched):
+        class_instance, upstream = fetched
+        sync._upstream_sync_class_instance(upstream, class_instance.external_id, class_instance.parent, recurse)
+
+    stages = []
+    if refresh is not None:
+        stages.append(Stage("Refresh", refresh_stage, network_workers))
+    stages.append(Stage("Fetch", fetch_stage, network_workers))
+    stages.append(Stage("Apply", apply_stage, database_workers, database=True,
+                        key=lambda fetched: identify(fetched[0])))
+    return Pipeline(stages, journal=journal).run(class_instances)
@@ -1,29 +1,30 @@
+import hashlib
+import json
 import re
 from datetime import date, datetime
 from functools import reduce
 from itertools import chain
+from urllib.parse import quote
 import logging
 
+from django.conf import settings
+from django.contrib.postgres.search import TrigramSimilarity
 from django.db import IntegrityError
-from django.db.models import Q, Max, Sum
+from django.db.models import Q, F, Max, Min, Sum, Exists, OuterRef
 from django.utils import timezone
 from django.utils.timezone import make_aware
 from django.core.exceptions import ObjectDoesNotExist
-from django.conf import settings
 
-import requests
 import reversion
 
+from clip import client
+from clip.client import NetworkException
 from college import models as m, choice_types as ctypes
-from supernova.utils import correlation
+from supernova.utils import NameIndex
 
 logger = logging.getLogger(__name__)
 
 
-class NetworkException(Exception):
-    pass
-
-
 class Recursivity:
     NONE = 0
     CREATION = 1
@@ -38,9 +39,7 @@ def assert_buildings_inserted():
     whitelisted = {
         1176, 1177, 1178, 1179, 1180, 1181, 1183, 1184, 1185,
         1186, 1188, 1189, 1190, 1238, 1395, 1561, 1564, 1663}
-    r = requests.get("http://%s/buildings/" % settings.CLIPY['host'])
-    if r.status_code != 200:
-        raise Exception("Unable to fetch buildings")
+    r = client.get("buildings/")
     clip_buildings = r.json()
     ids = set(map(lambda item: item['id'], clip_buildings))
     missing = ids.difference(set(m.Building.objects.values_list('external_id', flat=True)))
@@ -70,9 +69,7 @@ def sync_rooms():
     Fetches the most recent available info about rooms.
     Creates missing rooms.
     """
-    r = requests.get("http://%s/rooms/" % settings.CLIPY['host'])
-    if r.status_code != 200:
-        raise Exception("Unable to fetch rooms")
+    r = client.get("rooms/")
 
     existing = {room.external_id: room for room in m.Room.objects.all()}
     for clip_room in r.json():
@@ -136,9 +133,7 @@ def sync_courses():
     Fetches the most recent available info about courses.
     Creates missing courses.
     """
-    r = requests.get("http://%s/courses/" % settings.CLIPY['host'])
-    if r.status_code != 200:
-        raise Exception("Unable to fetch courses")
+    r = client.get("courses/")
 
     existing = {course.external_id: course for course in m.Course.objects.all()}
     for upstream_course in r.json():
@@ -189,10 +184,7 @@ def sync_departments():
 
 
 def _request_departments():
-    r = requests.get("http://%s/departments/" % settings.CLIPY['host'])
-    if r.status_code != 200:
-        raise Exception("Unable to fetch departments")
-    return r.json()
+    return client.get_json("departments/")
 
 
 def _upstream_sync_departments(upstream):
@@ -230,10 +222,7 @@ def sync_department(department, recurse=Recursivity.NONE):
 
 
 def _request_department(department):
-    r = requests.get(f"http://{settings.CLIPY['host']}/department/{department.external_id}")
-    if r.status_code != 200:
-        raise Exception(f"Unable to fetch department {department.external_id}")
-    return r.json()
+    return client.get_json(f"department/{department.external_id}")
 
 
 def _upstream_sync_department(upstream, department, recurse=Recursivity.NONE):
@@ -264,10 +253,7 @@ def sync_classes(recurse=Recursivity.NONE):
 
 
 def _request_classes():
-    r = requests.get("http://%s/classes/" % settings.CLIPY['host'])
-    if r.status_code != 200:
-        raise Exception("Unable to fetch classes")
-    return r.json()
+    return client.get_json("classes/")
 
 
 def _upstream_sync_classes(upstream, recurse):
@@ -304,10 +290,7 @@ def sync_class(external_id, recurse=Recursivity.NONE):
 
 
 def _request_class(external_id):
-    r = requests.get(f"http://{settings.CLIPY['host']}/class/{external_id}")
-    if r.status_code != 200:
-        raise Exception("Unable to fetch class")
-    return r.json()
+    return client.get_json(f"class/{external_id}")
 
 
 def _upstream_sync_class(upstream, external_id, recurse):
@@ -394,10 +377,7 @@ def sync_class_instance(external_id, klass=None, recurse=Recursivity.NONE):
 
 
 def _request_class_instance(external_id):
-    r = requests.get(f"http://{settings.CLIPY['host']}/class_inst/{external_id}")
-    if r.status_code != 200:
-        raise NetworkException(f"Unable to fetch class instance {external_id}")
-    return r.json()
+    return client.get_json(f"class_inst/{external_id}")
 
 
 def _upstream_sync_class_instance(upstream, external_id, klass, recurse):
@@ -408,7 +388,6 @@ def _upstream_sync_class_instance(upstream, external_id, klass, recurse):
         return
 
     upstream_department = upstream['department_id']
-    upstream_enrollments = upstream['enrollments']
     upstream_events = upstream['events']
     upstream_files = upstream['files']
     upstream_shifts = upstream['shifts']
@@ -430,8 +409,13 @@ def _upstream_sync_class_instance(upstream, external_id, klass, recurse):
     else:
         department = None
 
+    digest = payload_hash(upstream)
     try:
         obj = m.ClassInstance.objects.get(parent=klass, external_id=external_id)
+        if obj.external_hash == digest and recurse != Recursivity.FULL:
+            # Nothing changed since the last synchronization
+            m.ClassInstance.objects.filter(id=obj.id).update(external_update=timezone.now())
+            return
         if not obj.frozen:
             with reversion.create_revision():
                 changed = False
@@ -535,32 +519,15 @@ def _upstream_sync_class_instance(upstream, external_id, klass, recurse):
             _upstream_sync_event(upstream_data, ext_id, class_inst=obj)
 
     # ---------  Related enrollments ---------
-    enrollments = obj.enrollments.exclude(external_id=None).all()
-    upstream_enrollments = {enrollment['id']: enrollment for enrollment in upstream_enrollments}
-    new, disappeared, mirrored = _upstream_diff(set(enrollments), set(upstream_enrollments))
-
-    if m.Enrollment.objects.filter(external_id__in=new).exists():
-        logger.critical(f"Some enrollments of class instance {obj} belong to another instance: {new}")
-
-    m.Enrollment.objects.filter(external_id__in=mirrored). \
-        update(disappeared=False, external_update=make_aware(datetime.now()))
-    m.Enrollment.objects.filter(external_id__in=disappeared).update(disappeared=True)
-    disappeared = m.Enrollment.objects.filter(external_id__in=disappeared)
-    for enrollment in disappeared.all():
-        logger.warning(f"{enrollment} removed from {obj}.")
-
-    if recurse == Recursivity.CREATION:
-        for ext_id in new:
-            upstream_data = upstream_enrollments[ext_id]
-            _upstream_sync_enrollment(upstream_data, ext_id, class_inst=obj)
-    elif recurse == Recursivity.FULL:
-        for ext_id in chain(new, mirrored):
-            upstream_data = upstream_enrollments[ext_id]
-            _upstream_sync_enrollment(upstream_data, ext_id, class_inst=obj)
+    # Large classes have hundreds of enrollments, which are synchronized as a set
+    from clip import bulk  # Circular import
+    bulk._upstream_sync_enrollments([obj], [(obj, upstream)], recurse)
 
     # ---------  Related files ---------
     if recurse in (Recursivity.CREATION, Recursivity.FULL):
         _upstream_sync_class_instance_files(upstream_files, external_id, class_inst=obj)
+        # Only now is every derivative in sync with this payload
+        m.ClassInstance.objects.filter(id=obj.id).update(external_hash=digest, external_update=timezone.now())
 
 
 def sync_class_instance_files(external_id, class_inst):
@@ -574,10 +541,7 @@ def sync_class_instance_files(external_id, class_inst):
 
 
 def _request_class_instance_files(external_id):
-    r = requests.get(f"http://{settings.CLIPY['host']}/files/{external_id}")
-    if r.status_code != 200:
-        raise NetworkException("Unable to fetch class instance files")
-    return r.json()
+    return client.get_json(f"files/{external_id}")
 
 
 def _upstream_sync_class_instance_files(upstream, external_id, class_inst):
@@ -608,7 +572,10 @@ def _upstream_sync_class_instance_files(upstream, external_id, class_inst):
     new = upstream_ids.difference(downstream_ids)
     removed = downstream_ids.difference(upstream_ids)
     mirrored = downstream_ids.intersection(upstream_ids)
-    teachers = {teacher.name: teacher for teacher in m.Teacher.objects.filter(shifts__class_instance=class_inst).all()}
+    teachers = NameIndex(
+        (teacher.name, teacher)
+        for teacher in m.Teacher.objects.filter(shifts__class_instance=class_inst).exclude(name=None).distinct())
+    uploaders = _closest_teachers(teachers, {entry['uploader'] for entry in upstream.values()})
 
     for hash in mirrored:
         upsteam_info = upstream[hash]
@@ -637,7 +604,7 @@ def _upstream_sync_class_instance_files(upstream, external_id, class_inst):
                     downstream_file.upload_datetime = upstream_date
                     changed = True
 
-                uploader_teacher = _closest_teacher(teachers, upsteam_info['uploader'])
+                uploader_teacher = uploaders.get(upsteam_info['uploader'])
                 if downstream_file.uploader_teacher != uploader_teacher:
                     logger.warning(f"{downstream_file} uploader changed "
                                    f"from {downstream_file.uploader_teacher} to {uploader_teacher}")
@@ -660,7 +627,7 @@ def _upstream_sync_class_instance_files(upstream, external_id, class_inst):
 
     for hash in new:
         upsteam_info = upstream[hash]
-        uploader_teacher = _closest_teacher(teachers, upsteam_info['uploader'])
+        uploader_teacher = uploaders.get(upsteam_info['uploader'])
 
         try:
             file = m.File.objects.get(hash=upsteam_info['hash'])
@@ -710,15 +677,15 @@ def sync_enrollment(external_id, class_inst=None):
 
 
 def _request_enrollment(external_id):
-    r = requests.get(f"http://{settings.CLIPY['host']}/enrollment/{external_id}")
-    if r.status_code != 200:
-        raise NetworkException(f"Unable to fetch enrollment {external_id}")
-    return r.json()
+    return client.get_json(f"enrollment/{external_id}")
 
 
-def _upstream_sync_enrollment(upstream, external_id, class_inst):
-    if class_inst is None:
-        class_inst = m.ClassInstance.objects.get(external_id=upstream['class_instance_id'])
+def _parse_enrollment(upstream):
+    """
+    Validates upstream enrollment data and converts it into enrollment field values
+    :param upstream: Upstream enrollment data
+    :return: Dictionary with the enrollment values (except the student) or None if the data is invalid
+    """
     if not all(
             k in upstream
             for k in ('id',
@@ -754,17 +721,6 @@ def _upstream_sync_enrollment(upstream, external_id, class_inst):
         logger.error(f"Invalid upstream enrollment data: {upstream}")
         return
 
-    try:
-        student = m.Student.objects.get(external_id=student_ext_id)
-    except ObjectDoesNotExist:
-        student = sync_student(student_ext_id)
-
-    if (student_year := upstream['student_year']) is not None:
-        if student.year is None or student_year > student.year:
-            logger.info(f"Updated student {student} year ({student.year} to {student_year})")
-            student.year = student_year
-            student.save(update_fields=['year'])
-
     grade = 0
     if attendance_date:
         attendance_date = make_aware(datetime.fromisoformat(attendance_date), is_dst=True)
@@ -787,7 +743,46 @@ def _upstream_sync_enrollment(upstream, external_id, class_inst):
 
     approved = grade >= 10
     if approved != upstream['approved']:
-        logger.debug(f'Upstream enrollment approval does not match the calculated one (enrollment {external_id}).')
+        logger.debug(f'Upstream enrollment approval does not match the calculated one (enrollment {upstream["id"]}).')
+
+    return {
+        'attendance': attendance,
+        'attendance_date': attendance_date,
+        'normal_grade': normal_grade,
+        'normal_grade_date': normal_grade_date,
+        'recourse_grade': recourse_grade,
+        'recourse_grade_date': recourse_grade_date,
+        'special_grade': special_grade,
+        'special_grade_date': special_grade_date,
+        'improvement_grade': improvement_grade,
+        'improvement_grade_date': improvement_grade_date,
+        'approved': approved,
+        'grade': grade,
+    }
+
+
+#: Enrollment fields whose changes are worth a warning
+ENROLLMENT_GRADE_FIELDS = ('normal_grade', 'recourse_grade', 'special_grade', 'improvement_grade', 'grade')
+
+
+def _upstream_sync_enrollment(upstream, external_id, class_inst):
+    if class_inst is None:
+        class_inst = m.ClassInstance.objects.get(external_id=upstream['class_instance_id'])
+    values = _parse_enrollment(upstream)
+    if values is None:
+        return
+
+    student_ext_id = upstream['student']
+    try:
+        student = m.Student.objects.get(external_id=student_ext_id)
+    except ObjectDoesNotExist:
+        student = sync_student(student_ext_id)
+
+    if (student_year := upstream['student_year']) is not None:
+        if student.year is None or student_year > student.year:
+            logger.info(f"Updated student {student} year ({student.year} to {student_year})")
+            student.year = student_year
+            student.save(update_fields=['year'])
 
     try:
         # Necessary against enrollments which changed twice upstream between syncs
@@ -800,20 +795,11 @@ def _upstream_sync_enrollment(upstream, external_id, class_inst):
         obj = m.Enrollment.objects.get(external_id=external_id)
         changed = False
         with reversion.create_revision():
-            for attr in ('normal_grade_date', 'recourse_grade_date', 'special_grade_date',
-                         'improvement_grade_date', 'attendance', 'approved'):
+            for attr, new in values.items():
                 current = getattr(obj, attr)
-                new = locals()[attr]
                 if current != new:
-                    setattr(obj, attr, new)
-                    changed = True
-            grades_changed = False
-            for attr in ('normal_grade', 'recourse_grade', 'special_grade', 'improvement_grade', 'grade'):
-                current = getattr(obj, attr)
-                new = locals()[attr]
-
-                if current != new:
-                    logger.warning(f"{attr} from {current} to {new} in {obj}.")
+                    if attr in ENROLLMENT_GRADE_FIELDS:
+                        logger.warning(f"{attr} from {current} to {new} in {obj}.")
                     setattr(obj, attr, new)
                     changed = True
 
@@ -830,18 +816,7 @@ def _upstream_sync_enrollment(upstream, external_id, class_inst):
                 obj = m.Enrollment.objects.create(
                     student=student,
                     class_instance=class_inst,
-                    attendance=attendance,
-                    attendance_date=attendance_date,
-                    normal_grade=normal_grade,
-                    normal_grade_date=normal_grade_date,
-                    recourse_grade=recourse_grade,
-                    recourse_grade_date=recourse_grade_date,
-                    special_grade=special_grade,
-                    special_grade_date=special_grade_date,
-                    improvement_grade=improvement_grade,
-                    improvement_grade_date=improvement_grade_date,
-                    approved=approved,
-                    grade=grade,
+                    **values,
                     external_id=external_id,
                     frozen=False,
                     external_update=make_aware(datetime.now()),
@@ -865,13 +840,15 @@ def sync_shift(external_id, class_inst=None, recurse=Recursivity.NONE):
 
 
 def _request_shift_info(external_id):
-    r = requests.get(f"http://{settings.CLIPY['host']}/shift/{external_id}")
-    if r.status_code != 200:
-        raise NetworkException(f"Unable to fetch shift {external_id}")
-    return r.json()
+    return client.get_json(f"shift/{external_id}")
 
 
-def _upstream_sync_shift_info(upstream, external_id, class_inst, recurse):
+def _parse_shift(upstream):
+    """
+    Validates upstream shift data and converts it into shift field values
+    :param upstream: Upstream shift data
+    :return: Dictionary with the shift values (except the class instance) or None if the data is invalid
+    """
     invalid = not all(
         k in upstream
         for k in (
@@ -882,20 +859,37 @@ def _upstream_sync_shift_info(upstream, external_id, class_inst, recurse):
         logger.error(f"Invalid upstream shift instance data: {upstream}")
         return
 
-    if class_inst.external_id != upstream['class_instance_id']:
-        logger.critical("Consistency error. Shift upstream parent is not the local parent")
-        return
-
     shift_type = upstream['type']
     if not (isinstance(shift_type, int) or shift_type < ctypes.ShiftType.min() or shift_type > ctypes.ShiftType.max()):
         logger.error("Unknown shift type: %s" % shift_type)
 
+    return {
+        'shift_type': shift_type,
+        'number': upstream['number'],
+    }
+
+
+def _upstream_sync_shift_info(upstream, external_id, class_inst, recurse):
+    values = _parse_shift(upstream)
+    if values is None:
+        return
+
+    if class_inst.external_id != upstream['class_instance_id']:
+        logger.critical("Consistency error. Shift upstream parent is not the local parent")
+        return
+
+    shift_type = values['shift_type']
     upstream_details = {'state': upstream['state'], 'restrictions': upstream['restrictions']}
+    digest = payload_hash(upstream)
+    unchanged = False
     try:
         obj = m.Shift.objects.get(class_instance=class_inst, external_id=external_id)
-        if not obj.frozen and obj.external_data != upstream:
+        unchanged = obj.external_hash == digest
+        if not unchanged:
             with reversion.create_revision():
-                obj.external_data = upstream_details
+                if not obj.frozen:
+                    obj.external_data = upstream_details
+                obj.external_hash = digest
                 obj.save()
     except ObjectDoesNotExist:
         with reversion.create_revision():
@@ -906,7 +900,8 @@ def _upstream_sync_shift_info(upstream, external_id, class_inst, recurse):
                 external_id=external_id,
                 frozen=False,
                 external_update=make_aware(datetime.now()),
-                external_data={'upstream': upstream})
+                external_data={'upstream': upstream},
+                external_hash=digest)
             logger.info(f"Shift {obj} created in {class_inst}")
 
     # ---------  Related shift instances ---------
@@ -932,6 +927,9 @@ def _upstream_sync_shift_info(upstream, external_id, class_inst, recurse):
     for instances in disappeared.all():
         logger.warning(f"{instances} removed from {obj}.")
 
+    if unchanged:
+        return  # Shift instances have payloads of their own, but the students and teachers are part of this one
+
     # ---------  Related M2M ---------
     current_students = m.Student.objects.filter(shift=obj).exclude(disappeared=True)
     new, disappeared, _ = _upstream_diff(current_students, set(upstream['students']))
@@ -948,7 +946,13 @@ def _upstream_sync_shift_info(upstream, external_id, class_inst, recurse):
             m.Teacher.objects.filter(external_id__in=new).values_list('id', flat=True)))
 
 
-def _upstream_sync_event(upstream, external_id, class_inst):
+def _parse_event(upstream, external_id):
+    """
+    Validates upstream event data and converts it into class instance event field values
+    :param upstream: Upstream event data
+    :param external_id: The foreign id of the event
+    :return: Dictionary with the event values (except the class instance) or None if the data is invalid
+    """
     invalid = not all(
         k in upstream
         for k in ('id', 'instance_id', 'date', 'from_time', 'to_time', 'type', 'season', 'info', 'note'))
@@ -982,15 +986,37 @@ def _upstream_sync_event(upstream, external_id, class_inst):
     else:
         info = None
 
+    return {
+        'date': date,
+        'time': from_time,
+        'duration': duration,
+        'type': upstream['type'],
+        'season': upstream['season'],
+        'info': info,
+    }
+
+
+def _upstream_sync_event(upstream, external_id, class_inst):
+    values = _parse_event(upstream, external_id)
+    if values is None:
+        return
+
+    from_time = values['time']
+    duration = values['duration']
+    info = values['info']
+    digest = payload_hash(upstream)
+
     try:
         class_event = m.ClassInstanceEvent.objects.get(external_id=external_id)
+        if class_event.external_hash == digest:
+            return  # Unchanged
         changed = False
         with reversion.create_revision():
             if from_time is not None and (class_event.time is None or class_event.time != from_time):
                 logger.info(f"Event {class_event} time changed")
 
                 class_event.time = from_time
-                if to_time is not None:
+                if duration is not None:
                     class_event.duration = duration
                 # TODO notify users
                 changed = True
@@ -1005,7 +1031,7 @@ def _upstream_sync_event(upstream, external_id, class_inst):
                 class_event.type = upstream['type']
                 changed = True
 
-            if class_event.type != upstream['season']:
+            if class_event.season != upstream['season']:
                 logger.info(f"Event {class_event} season changed")
                 class_event.season = upstream['season']
                 changed = True
@@ -1014,6 +1040,10 @@ def _upstream_sync_event(upstream, external_id, class_inst):
                 class_event.external_data = upstream
                 changed = True
 
+            if class_event.external_hash != digest:
+                class_event.external_hash = digest
+                changed = True
+
             if changed:
                 class_event.save()
 
@@ -1021,16 +1051,12 @@ def _upstream_sync_event(upstream, external_id, class_inst):
         with reversion.create_revision():
             obj = m.ClassInstanceEvent.objects.create(
                 class_instance=class_inst,
-                duration=duration,
-                date=date,
-                time=from_time,
-                type=upstream['type'],
-                season=upstream['season'],
-                info=info,
+                **values,
                 external_id=external_id,
                 frozen=False,
                 external_update=make_aware(datetime.now()),
-                external_data={'upstream': upstream})
+                external_data={'upstream': upstream},
+                external_hash=digest)
             logger.info(f"Inserted new class event {obj}")
 
 
@@ -1048,32 +1074,27 @@ def sync_shift_instance(external_id, shift):
 
 
 def _request_shift_instance(external_id):
-    r = requests.get(f"http://{settings.CLIPY['host']}/shift_inst/{external_id}")
-    if r.status_code != 200:
-        raise NetworkException(f"Unable to fetch shift instance {external_id}")
-    return r.json()
+    return client.get_json(f"shift_inst/{external_id}")
 
 
-def _upstream_sync_shift_instance(upstream, external_id, shift):
+def _parse_shift_instance(upstream, external_id, rooms):
+    """
+    Validates upstream shift instance data and converts it into shift instance field values
+    :param upstream: Upstream shift instance data
+    :param external_id: The foreign id of the shift instance
+    :param rooms: Dictionary of {external_id: room} with (at least) the room referred by the upstream data
+    :return: Dictionary with the shift instance values (except the shift) or None if the data is invalid
+    """
     if not all(k in upstream for k in ('shift', 'start', 'end', 'weekday', 'room')):
         logger.error(f"Invalid upstream shift instance data: {upstream}")
         return
 
-    if shift.external_id != upstream['shift']:
-        logger.critical("Consistency error. ShiftInstance upstream parent is not the local parent")
-        return
-
     upstream_room = None
-    online = False
     if (upstream_room_id := upstream['room']) is not None:
-        try:
-            upstream_room = m.Room.objects.get(external_id=upstream_room_id)
-        except m.Room.DoesNotExist:
-            if int(upstream_room_id) in (1665, 1666):
-                # TODO use "online" & rm ^ this ^ awful hardcoding
-                online = True
-            else:
-                logger.warning(f"Room {upstream['room']} is missing (shift instance {external_id})")
+        upstream_room = rooms.get(upstream_room_id)
+        if upstream_room is None and int(upstream_room_id) not in (1665, 1666):
+            # TODO use "online" & rm ^ this ^ awful hardcoding
+            logger.warning(f"Room {upstream['room']} is missing (shift instance {external_id})")
 
     upstream_start = upstream['start']
     upstream_end = upstream['end']
@@ -1088,6 +1109,35 @@ def _upstream_sync_shift_instance(upstream, external_id, shift):
         if upstream_end is not None and upstream_start is not None \
         else None
 
+    return {
+        'weekday': upstream_weekday,
+        'start': upstream_start,
+        'duration': upstream_duration,
+        'room': upstream_room,
+    }
+
+
+def _upstream_sync_shift_instance(upstream, external_id, shift):
+    if 'shift' in upstream and shift.external_id != upstream['shift']:
+        logger.critical("Consistency error. ShiftInstance upstream parent is not the local parent")
+        return
+
+    digest = payload_hash(upstream)
+    if m.ShiftInstance.objects.filter(shift=shift, external_id=external_id, external_hash=digest).exists():
+        return  # Unchanged
+
+    rooms = dict()
+    if (upstream_room_id := upstream.get('room')) is not None:
+        rooms = {room.external_id: room for room in m.Room.objects.filter(external_id=upstream_room_id)}
+    values = _parse_shift_instance(upstream, external_id, rooms)
+    if values is None:
+        return
+
+    upstream_start = values['start']
+    upstream_duration = values['duration']
+    upstream_weekday = values['weekday']
+    upstream_room = values['room']
+
     try:
         shift_instance = m.ShiftInstance.objects.get(shift=shift, external_id=external_id)
         changed = False
@@ -1131,20 +1181,22 @@ def _upstream_sync_shift_instance(upstream, external_id, shift):
                 shift_instance.external_data = upstream
                 changed = True
 
+            if shift_instance.external_hash != digest:
+                shift_instance.external_hash = digest
+                changed = True
+
             if changed:
                 shift_instance.save()
     except m.ShiftInstance.DoesNotExist:
         with reversion.create_revision():
             shift_instance = m.ShiftInstance.objects.create(
                 shift=shift,
-                weekday=upstream_weekday,
-                start=upstream_start,
-                duration=upstream_duration,
-                room=upstream_room,
+                **values,
                 external_id=external_id,
                 frozen=False,
                 external_update=make_aware(datetime.now()),
-                external_data={'upstream': upstream})
+                external_data={'upstream': upstream},
+                external_hash=digest)
             logger.info(f"Shift instance {shift_instance} created.")
 
 
@@ -1170,10 +1222,7 @@ def sync_students():
 
 
 def _request_students():
-    r = requests.get("http://%s/students/" % settings.CLIPY['host'])
-    if r.status_code != 200:
-        raise NetworkException("Unable to fetch students")
-    return r.json()
+    return client.get_json("students/")
 
 
 def _upstream_sync_students(upstream_list):
@@ -1196,10 +1245,7 @@ def sync_student(external_id):
 
 
 def _request_student(external_id):
-    r = requests.get(f"http://{settings.CLIPY['host']}/student/{external_id}")
-    if r.status_code != 200:
-        raise NetworkException("Unable to fetch students")
-    return r.json()
+    return client.get_json(f"student/{external_id}")
 
 
 def _upstream_sync_student(upstream, student=None):
@@ -1252,6 +1298,70 @@ def _upstream_sync_student(upstream, student=None):
         return student
 
 
+def students_by_external_id(external_ids):
+    """
+    Resolves several students with a single query. Unknown students are synchronized together.
+    :param external_ids: Student external ids
+    :return: Dictionary of {external_id: student} with the students that could be resolved
+    """
+    students = {student.external_id: student for student in m.Student.objects.filter(external_id__in=external_ids)}
+    if missing := set(external_ids).difference(students):
+        students.update(sync_student_list(missing))
+    return students
+
+
+def sync_student_list(external_ids):
+    """
+    Synchronizes several new students, whose data is requested concurrently
+    :param external_ids: External ids of the students
+    :return: Dictionary of {external_id: student} with the students that could be synchronized
+    """
+    external_ids = list(external_ids)
+    upstreams = []
+    for external_id, result in zip(external_ids, client.get_many([f"student/{i}" for i in external_ids])):
+        if isinstance(result, NetworkException):
+            logger.error(f"Unable to fetch student {external_id}. {result}")
+        else:
+            upstreams.append(result.json())
+    return _upstream_create_students(upstreams)
+
+
+def _upstream_create_students(upstreams):
+    """
+    Inserts several students with a single statement
+    :param upstreams: Upstream data of the students
+    :return: Dictionary of {external_id: student} with the inserted students
+    """
+    if len(upstreams) == 0:
+        return dict()
+    course_ids = {upstream['course'] for upstream in upstreams if upstream['course']}
+    courses = {course.external_id: course for course in m.Course.objects.filter(external_id__in=course_ids)}
+    for course_id in course_ids.difference(courses):
+        logger.error(f'Upstream course {course_id} is not imported')
+
+    now = make_aware(datetime.now())
+    external_ids = [upstream['id'] for upstream in upstreams]
+    with reversion.create_revision():
+        # Conflicting students were inserted meanwhile by a concurrent synchronization
+        m.Student.objects.bulk_create(
+            [m.Student(
+                name=upstream['name'],
+                abbreviation=upstream['abbr'],
+                iid=upstream['id'],
+                number=upstream['id'],
+                course=courses.get(upstream['course']),
+                external_id=upstream['id'],
+                external_update=now,
+                external_data={'upstream': upstream})
+                for upstream in upstreams],
+            ignore_conflicts=True)
+        students = list(m.Student.objects.filter(external_id__in=external_ids))
+        for student in students:
+            reversion.add_to_revision(student)
+            logger.info(f'Created student {student}.')
+    return {student.external_id: student for student in students}
+
+
 def sync_teachers():
     """
     Synchronizes teachers to the current upstream
@@ -1262,10 +1372,7 @@ def sync_teachers():
 
 
 def _request_teachers():
-    r = requests.get("http://%s/teachers/" % settings.CLIPY['host'])
-    if r.status_code != 200:
-        raise NetworkException("Unable to fetch teachers")
-    return r.json()
+    return client.get_json("teachers/")
 
 
 def _upstream_sync_teachers(upstream_list):
@@ -1320,43 +1427,138 @@ def _upstream_sync_teachers(upstream_list):
                 m.Department.objects.filter(external_id__in=new).values_list('id', flat=True)))
 
 
-def calculate_active_classes():
+#: Number of objects written per cached data update statement
+CACHED_BATCH_SIZE = 500
+
+
+def _synced_class_instances(since):
+    """
+    :return: Queryset of the class instances synchronized since a given moment
+    """
+    return m.ClassInstance.objects.filter(external_update__gte=since)
+
+
+def calculate_active_classes(since=None):
+    """
+    Flags classes as extinguished when they have no instance this year nor enrollments in the recent years.
+    :param since: Only recalculate the classes with instances synchronized since this moment (optional)
+    """
     today = date.today()
     current_year = today.year + (today.month > 8)
-    for klass in m.Class.objects.all():
-        class_meta = klass.instances.aggregate(max_year=Max('year'))  # , max_date=Max('period_instance__date_to'))
-        last_year = class_meta['max_year']
-        # TODO get rid of magic number
-        has_recent_enrollments = klass.instances \
-            .filter(year__gte=current_year - 2) \
-            .order_by('year') \
-            .annotate(enrollment_count=Sum('enrollments')) \
-            .exclude(enrollment_count=0) \
-            .exists()
-        extinguished = not (last_year == current_year or has_recent_enrollments)
+    classes = m.Class.objects
+    if since is not None:
+        classes = classes.filter(id__in=_synced_class_instances(since).values('parent_id'))
+    # TODO get rid of magic number
+    recent_enrollments = m.Enrollment.objects.filter(
+        class_instance__parent=OuterRef('pk'),
+        class_instance__year__gte=current_year - 2)
+    classes = classes \
+        .annotate(last_year=Max('instances__year'), has_recent_enrollments=Exists(recent_enrollments)) \
+        .only('id', 'extinguished')
+
+    changed = []
+    for klass in classes:
+        extinguished = not (klass.last_year == current_year or klass.has_recent_enrollments)
         if extinguished != klass.extinguished:
             klass.extinguished = extinguished
-            klass.save(update_fields=['extinguished'])
+            changed.append(klass)
+    m.Class.objects.bulk_update(changed, ['extinguished'], batch_size=CACHED_BATCH_SIZE)
+
+
+def calculate_student_progress(since=None):
+    """
+    Set-based :py:meth:`college.models.Student.update_progress_info`, aggregating every student in a single query.
+    :param since: Only recalculate the students enrolled in class instances synchronized since this moment (optional)
+    """
+    students = m.Student.objects
+    if since is not None:
+        students = students.filter(
+            id__in=m.Enrollment.objects
+                .filter(class_instance__in=_synced_class_instances(since))
+                .values('student_id'))
+    approved = Q(enrollments__approved=True)
+    students = students \
+        .annotate(
+            min_year=Min('enrollments__class_instance__year'),
+            max_year=Max('enrollments__class_instance__year'),
+            credit_grade=Sum(F('enrollments__grade') * F('enrollments__class_instance__parent__credits'),
+                             filter=approved),
+            credit_count=Sum('enrollments__class_instance__parent__credits', filter=approved)) \
+        .filter(min_year__isnull=False) \
+        .only('id', 'first_year', 'last_year', 'credits', 'avg_grade')
+
+    changed = []
+    for student in students:
+        values = {'first_year': student.min_year, 'last_year': student.max_year}
+        if student.credit_grade and student.credit_count:
+            values['credits'] = student.credit_count
+            values['avg_grade'] = student.credit_grade / student.credit_count
+        if _set_changed(student, values):
+            changed.append(student)
+    m.Student.objects.bulk_update(
+        changed, ['first_year', 'last_year', 'credits', 'avg_grade'], batch_size=CACHED_BATCH_SIZE)
+    logger.info(f"Updated the progress of {len(changed)} students")
+
+
+def calculate_teacher_yearspans(since=None):
+    """
+    Set-based :py:meth:`college.models.Teacher.update_yearspan`, aggregating every teacher in a single query.
+    :param since: Only recalculate the teachers of class instances synchronized since this moment (optional)
+    """
+    teachers = m.Teacher.objects
+    if since is not None:
+        teachers = teachers.filter(
+            id__in=m.Shift.objects
+                .filter(class_instance__in=_synced_class_instances(since))
+                .values('teachers'))
+    teachers = teachers \
+        .annotate(min_year=Min('shifts__class_instance__year'), max_year=Max('shifts__class_instance__year')) \
+        .filter(min_year__isnull=False) \
+        .only('id', 'first_year', 'last_year')
+
+    changed = []
+    for teacher in teachers:
+        if _set_changed(teacher, {'first_year': teacher.min_year, 'last_year': teacher.max_year}):
+            changed.append(teacher)
+    m.Teacher.objects.bulk_update(changed, ['first_year', 'last_year'], batch_size=CACHED_BATCH_SIZE)
+    logger.info(f"Updated the yearspan of {len(changed)} teachers")
+
+
+def _set_changed(obj, values):
+    """
+    Sets the attributes of an object which differ from a set of values
+    :param obj: Object being changed
+    :param values: Dictionary of {attribute: value}
+    :return: Whether something changed
+    """
+    changed = False
+    for attr, value in values.items():
+        if getattr(obj, attr) != value:
+            if attr in ('first_year', 'last_year'):
+                logger.debug(f'{type(obj).__name__} {obj.id} {attr} changed from {getattr(obj, attr)} to {value}')
+            setattr(obj, attr, value)
+            changed = True
+    return changed
 
 
 def request_courses_update():
-    _update(f"http://{settings.CLIPY['host']}/update/courses/")
+    _update("update/courses/")
 
 
 def request_rooms_update():
-    _update(f"http://{settings.CLIPY['host']}/update/rooms/")
+    _update("update/rooms/")
 
 
 def request_admissions_update():
-    _update(f"http://{settings.CLIPY['host']}/update/admissions/")
+    _update("update/admissions/")
 
 
 def request_teachers_update(department):
-    _update(f"http://{settings.CLIPY['host']}/update/teachers/{department}")
+    _update(f"update/teachers/{department}")
 
 
 def request_classes_update():
-    _update(f"http://{settings.CLIPY['host']}/update/classes/")
+    _update("update/classes/")
 
 
 def request_class_instance_update(external_id, update_info=False, update_enrollments=False, update_shifts=False,
@@ -1368,26 +1570,53 @@ def request_class_instance_update(external_id, update_info=False, update_enrollm
     :param update_shifts: Whether to request CLIPy to update the class shifts from CLIP before updating Supernova's
     :param update_events: Whether to request CLIPy to update the class events from CLIP before updating Supernova's
     :param update_files: Whether to request CLIPy to update this information from CLIP before updating Supernova's
+    :param update_grades: Whether to request CLIPy to update the class grades from CLIP before updating Supernova's
     """
 
+    paths = []
     if update_info:
-        _update(f"http://{settings.CLIPY['host']}/update/class_info/{external_id}")
+        paths.append(f"update/class_info/{external_id}")
     if update_enrollments:
-        _update(f"http://{settings.CLIPY['host']}/update/class_enrollments/{external_id}")
+        paths.append(f"update/class_enrollments/{external_id}")
     if update_shifts:
-        _update(f"http://{settings.CLIPY['host']}/update/shifts/{external_id}")
+        paths.append(f"update/shifts/{external_id}")
     if update_events:
-        _update(f"http://{settings.CLIPY['host']}/update/events/{external_id}")
+        paths.append(f"update/events/{external_id}")
     if update_grades:
-        _update(f"http://{settings.CLIPY['host']}/update/class_grades/{external_id}")
+        paths.append(f"update/class_grades/{external_id}")
     if update_files:
-        _update(f"http://{settings.CLIPY['host']}/update/class_files/{external_id}")
+        paths.append(f"update/class_files/{external_id}")
+    # The updates are independent of each other, so they are requested concurrently
+    for path, result in zip(paths, client.get_many(paths, request=client.request_update)):
+        if isinstance(result, NetworkException):
+            logger.error(f"Endpoint {path} failed to update. {result}")
+
+
+def _update(path):
+    try:
+        client.request_update(path)
+    except NetworkException as e:
+        logger.error(f"Endpoint {path} failed to update. {e}")
+
+
+def request_changed_class_instances(since):
+    """
+    Requests the class instances which changed upstream since a given moment
+    :param since: Datetime since which the changes are wanted
+    :return: External ids of the changed class instances, or None if CLIPy is unable to tell
+    """
+    try:
+        return client.get_json(f"changes/class_inst/?since={quote(since.isoformat())}")
+    except NetworkException:
+        logger.warning("CLIPy did not provide the changed class instances")
 
 
-def _update(url):
-    status_code = requests.get(url).status_code
-    if status_code != 200:
-        logger.error(f"Endpoint {url} failed to update. Status code {status_code}")
+def payload_hash(upstream):
+    """
+    :param upstream: Upstream data
+    :return: A digest of the upstream data, which allows to detect changes without comparing the whole data
+    """
+    return hashlib.sha1(json.dumps(upstream, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
 
 
 def _upstream_diff(current_objs, clip_ids):
@@ -1406,24 +1635,37 @@ def _upstream_diff(current_objs, clip_ids):
     return new, disappeared, mirrored
 
 
-def _closest_teacher(teachers, name):
+#: Similarity above which a teacher which is not associated with a class is accepted as a name match
+TEACHER_SIMILARITY_THRESHOLD = 0.5
+
+
+def _closest_teachers(teachers, names):
+    """
+    Finds the teachers whose names are the closest to the provided names
+    :param teachers: :py:class:`supernova.utils.NameIndex` of the most likely teachers
+    :param names: Names to find
+    :return: Dictionary of {name: closest teacher or None}
+    """
+    matches = teachers.match_many(name for name in names if name)
+    for name, teacher in matches.items():
+        if teacher is None:
+            matches[name] = _teacher_by_name(name)
+    return matches
+
+
+def _teacher_by_name(name):
     """
-    Finds the teacher in a dict {name: teacher} whose the name is the closest to the provided parameter
-    :param teachers: Teacher dict
+    Finds the teacher whose name matches the provided name, among every teacher
     :param name: Name to find
-    :return: Closest match
+    :return: The matching teacher or None if there is no (unambiguous) match
     """
-    uploader_teacher = None
-    max_correlation = 0
-    for teacher_name, teacher in teachers.items():
-        c = correlation(name, teacher_name)
-        if c > max_correlation:
-            uploader_teacher = teacher
-            max_correlation = c
-    if uploader_teacher is None:
-        name_filter = reduce(lambda x, y: x & y, [Q(name__contains=word) for word in name.split(' ')])
-        matches = m.Teacher.objects.filter(name_filter).all()
-        if len(matches) == 1:
-            uploader_teacher = matches[0]
-
-    return uploader_teacher
+    if settings.TRIGRAM_SEARCH:
+        return m.Teacher.objects \
+            .annotate(similarity=TrigramSimilarity('name', name)) \
+            .filter(similarity__gt=TEACHER_SIMILARITY_THRESHOLD) \
+            .order_by('-similarity') \
+            .first()
+    name_filter = reduce(lambda x, y: x & y, [Q(name__contains=word) for word in name.split(' ')])
+    matches = m.Teacher.objects.filter(name_filter)[:2]
+    if len(matches) == 1:
+        return matches[0]
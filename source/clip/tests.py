@@ -1,8 +1,35 @@
-from django.test import TestCase
+from contextlib import contextmanager
+from threading import Thread
+
+from django.test import TestCase, SimpleTestCase
 
 from college import models as college
 from college import choice_types as ctypes
-from clip import synchronization as sync
+from clip import synchronization as sync, bulk, workers, pipeline
+from clip.journal import Journal
+from clip.models import SyncRun, SyncRecord
+
+
+def enrollment_upstream(external_id, class_instance, student):
+    return {
+        "approved": False,
+        "attempt": 1,
+        "attendance": None,
+        "attendance_date": None,
+        "class_instance_id": class_instance.external_id,
+        "continuous_grade": None,
+        "continuous_grade_date": None,
+        "exam_grade": None,
+        "exam_grade_date": None,
+        "id": external_id,
+        "improvement_grade": None,
+        "improvement_grade_date": None,
+        "special_grade": None,
+        "special_grade_date": None,
+        "statutes": None,
+        "student": student.external_id,
+        "student_year": 3,
+    }
 
 
 class SyncTest(TestCase):
@@ -320,6 +347,202 @@ class SyncTest(TestCase):
         self.assertEquals(instance_deleted.shift, new_shift)
         self.assertTrue(instance_deleted.disappeared)
 
+        # An unchanged payload is skipped
+        college.ShiftStudents.objects.filter(shift=new_shift, student=student_stay).delete()
+        sync._upstream_sync_shift_info(upstream, 200, self.class_instance, sync.Recursivity.NONE)
+        self.assertFalse(college.ShiftStudents.objects.filter(shift=new_shift, student=student_stay).exists())
+
+    def test_bulk_class_instance_sync(self):
+        other_instance = college.ClassInstance.objects.create(
+            parent=self.class_,
+            year=2020,
+            period=1,
+            department=self.department,
+            external_id=200,
+            information=dict())
+        shift_deleted = college.Shift.objects.create(
+            class_instance=self.class_instance,
+            number=2,
+            shift_type=1,
+            external_id=101)
+        enrollment_replaced = college.Enrollment.objects.create(
+            student=college.Student.objects.create(external_id=300),
+            class_instance=other_instance,
+            external_id=300)
+
+        def class_instance_upstream(class_instance, shifts, enrollments):
+            return {
+                "class_id": self.class_.external_id,
+                "department_id": self.department.external_id,
+                "enrollments": enrollments,
+                "events": [],
+                "files": [],
+                "id": class_instance.external_id,
+                "info": {'foo': 'bar'},
+                "period": class_instance.period,
+                "shifts": shifts,
+                "year": class_instance.year
+            }
+
+        def shift_upstream(external_id, class_instance, number, instances, students):
+            return {
+                "class_instance_id": class_instance.external_id,
+                "id": external_id,
+                "instances": instances,
+                "number": number,
+                "restrictions": "Foo Bar",
+                "state": "Aberto",
+                "students": students,
+                "teachers": [self.teacher.external_id],
+                "type": 1,
+            }
+
+        upstreams = [
+            (self.class_instance, class_instance_upstream(
+                self.class_instance,
+                [shift_upstream(self.shift.external_id, self.class_instance, 1, [100], [])],
+                [enrollment_upstream(self.enrollment.external_id, self.class_instance, self.student)])),
+            (other_instance, class_instance_upstream(
+                other_instance,
+                [shift_upstream(201, other_instance, 1, [], [self.student.external_id])],
+                [enrollment_upstream(301, other_instance, enrollment_replaced.student)])),
+        ]
+        bulk._upstream_sync_class_instances(upstreams, sync.Recursivity.CREATION)
+
+        shift_deleted.refresh_from_db()
+        enrollment_replaced.refresh_from_db()
+        other_instance.refresh_from_db()
+        new_shift = college.Shift.objects.get(external_id=201)
+
+        self.assertEquals(other_instance.information, {'upstream': {'foo': 'bar'}})
+        self.assertTrue(shift_deleted.disappeared)
+        self.assertFalse(college.Shift.objects.get(id=self.shift.id).disappeared)
+        self.assertEquals(new_shift.class_instance, other_instance)
+        self.assertTrue(college.ShiftStudents.objects.filter(shift=new_shift, student=self.student).exists())
+        self.assertTrue(new_shift.teachers.filter(id=self.teacher.id).exists())
+        self.assertEquals(enrollment_replaced.external_id, 301)
+        self.assertFalse(enrollment_replaced.disappeared)
+        self.assertEquals(enrollment_replaced.student.year, 3)
+
+    def test_enrollment_replaced_after_disappearing(self):
+        # Enroll (id 100) - sync - un-enroll - sync - re-enroll (id 101) - sync
+        def sync_enrollments(*enrollments):
+            bulk._upstream_sync_enrollments(
+                [self.class_instance],
+                [(self.class_instance, {'enrollments': list(enrollments)})],
+                sync.Recursivity.CREATION)
+
+        sync_enrollments(enrollment_upstream(100, self.class_instance, self.student))
+        sync_enrollments()
+        self.enrollment.refresh_from_db()
+        self.assertTrue(self.enrollment.disappeared)
+
+        sync_enrollments(enrollment_upstream(101, self.class_instance, self.student))
+        self.enrollment.refresh_from_db()
+        self.assertEquals(self.enrollment.external_id, 101)
+        self.assertFalse(self.enrollment.disappeared)
+        self.assertEquals(
+            college.Enrollment.objects.filter(student=self.student, class_instance=self.class_instance).count(), 1)
+
+    def test_student_batch_creation(self):
+        upstreams = [
+            {"id": 500, "name": "Foo Bar", "abbr": "f.bar", "course": None},
+            # Inserted meanwhile (eg. by a concurrent sync)
+            {"id": self.student.external_id, "name": "Bar Foo", "abbr": "b.foo", "course": None},
+        ]
+        students = sync._upstream_create_students(upstreams)
+
+        self.assertEquals(set(students), {500, self.student.external_id})
+        self.assertEquals(students[500].abbreviation, "f.bar")
+        self.assertEquals(students[self.student.external_id].id, self.student.id)
+        self.assertEquals(sync.students_by_external_id([500])[500], students[500])
+
+    def test_cached_data_calculation(self):
+        self.shift.teachers.add(self.teacher)
+        previous_instance = college.ClassInstance.objects.create(
+            parent=self.class_,
+            year=2018,
+            period=2,
+            department=self.department,
+            external_id=101)
+        college.Enrollment.objects.create(
+            student=self.student,
+            class_instance=previous_instance,
+            approved=True,
+            grade=15,
+            external_id=101)
+        self.class_.credits = 12
+        self.class_.save()
+
+        sync.calculate_student_progress()
+        sync.calculate_teacher_yearspans()
+        self.student.refresh_from_db()
+        self.teacher.refresh_from_db()
+
+        self.assertEquals((self.student.first_year, self.student.last_year), (2018, 2020))
+        self.assertEquals(self.student.credits, 12)
+        self.assertEquals(self.student.avg_grade, 15)
+        self.assertEquals((self.teacher.first_year, self.teacher.last_year), (2020, 2020))
+
+    def test_sync_journal(self):
+        journal = Journal.start('fast')
+        processed = []
+
+        def process(item):
+            processed.append(item)
+            if item == 3:
+                raise Exception("Failure")
+
+        failed = workers.run([1, 2, 3], process, workers=1, label="Items", journal=journal)
+        journal.finish(success=False)
+        self.assertEquals(failed, [3])
+        self.assertFalse(journal.completed("Items"))
+
+        journal = Journal.resume('fast')
+        processed.clear()
+        workers.run([1, 2, 3], lambda item: processed.append(item), workers=1, label="Items", journal=journal)
+        journal.finish(success=True)
+        self.assertEquals(processed, [3])
+        self.assertTrue(journal.completed("Items"))
+        self.assertIsNone(Journal.resume('fast'))
+
+    def test_sync_journal_batches(self):
+        journal = Journal.start('fast')
+        processed = []
+
+        def process(batch):
+            processed.append(batch)
+            if 3 in batch:
+                raise Exception("Failure")
+
+        workers.run([[1, 2], [3, 4]], process, workers=1, label="Batches", journal=journal)
+        journal.finish(success=False)
+
+        # Batches resume item by item, even if they are formed differently
+        journal = Journal.resume('fast')
+        processed.clear()
+        workers.run([[1], [2, 3], [4]], lambda batch: processed.append(batch), workers=1, label="Batches",
+                    journal=journal)
+        journal.finish(success=True)
+        self.assertEquals(processed, [[3], [4]])
+
+    def test_sync_journal_pruning(self):
+        for _ in range(3):
+            journal = Journal.start('fast')
+            workers.run([1, 2], lambda item: None, workers=1, label="Items", journal=journal)
+            journal.finish(success=True)
+        other = Journal.start('full')
+        other.finish(success=True)
+        interrupted = Journal.start('fast')
+
+        self.assertEquals(Journal.prune('fast', keep=2), 1)
+        runs = SyncRun.objects.filter(sync_type='fast')
+        self.assertEquals(runs.count(), 3)
+        self.assertTrue(runs.filter(id=interrupted.run.id).exists())
+        self.assertEquals(SyncRecord.objects.filter(phase__run__sync_type='fast').count(), 4)
+        self.assertTrue(SyncRun.objects.filter(sync_type='full').exists())
+        self.assertEquals(Journal.prune('fast', keep=2), 0)
+
     # def test_disappearances(self):
     #     pass
     #
@@ -331,3 +554,25 @@ class SyncTest(TestCase):
     #
     # def test_constraints(self):
     #     pass
+
+
+class PipelineTest(SimpleTestCase):
+    def test_failing_journal(self):
+        class FailingJournal:
+            @contextmanager
+            def phase(self, name):
+                yield
+
+            def record(self, *args, **kwargs):
+                raise Exception("Failure")
+
+        stages = [pipeline.Stage("Double", lambda item: item * 2, 2, key=str),
+                  pipeline.Stage("Collect", lambda item: None, 2, key=str)]
+        results = []
+        run = Thread(target=lambda: results.append(
+            pipeline.Pipeline(stages, journal=FailingJournal()).run(range(pipeline.QUEUE_SIZE * 3))))
+        run.start()
+        run.join(timeout=10)
+        self.assertFalse(run.is_alive())
+        self.assertEqual(results, [{}])
+        self.assertEqual(stages[1].processed, pipeline.QUEUE_SIZE * 3)
@@ -0,0 +1,65 @@
+from threading import Lock
+
+from django.db import connection as default_connection
+from django.db.backends.signals import connection_created
+
+
+class QueryCounter:
+    """
+    Context manager which counts the database queries done while it is active, in any thread.
+    Threads have their own connections, so the counter attaches itself to every connection that gets opened.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = Lock()
+        self._connections = []
+
+    def __enter__(self):
+        self._attach(default_connection)
+        connection_created.connect(self._connection_created)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        connection_created.disconnect(self._connection_created)
+        with self._lock:
+            for connection in self._connections:
+                if self in connection.execute_wrappers:
+                    connection.execute_wrappers.remove(self)
+            self._connections.clear()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def _connection_created(self, sender, connection, **kwargs):
+        self._attach(connection)
+
+    def _attach(self, connection):
+        with self._lock:
+            if self not in connection.execute_wrappers:
+                connection.execute_wrappers.append(self)
+                self._connections.append(connection)
+
+
+class ThreadQueryCounter:
+    """
+    Context manager which counts the database queries done by the current thread while it is active.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._context = None
+
+    def __enter__(self):
+        self._context = default_connection.execute_wrapper(self)
+        self._context.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._context.__exit__(exc_type, exc_val, exc_tb)
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
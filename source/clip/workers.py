@@ -0,0 +1,153 @@
+"""
+Bounded pool of workers for the synchronization tasks.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from threading import Lock
+from time import perf_counter, sleep
+
+from django.db import close_old_connections
+
+from clip.client import NetworkException
+from clip.utils import ThreadQueryCounter
+
+logger = logging.getLogger(__name__)
+
+#: Default number of simultaneous tasks
+WORKERS = 10
+#: Minimum interval between progress reports (seconds)
+PROGRESS_INTERVAL = 10
+
+
+class Report:
+    """
+    Outcome of a run
+    """
+
+    def __init__(self, label, total):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.failed = []
+        self.timings = []
+        self.start = perf_counter()
+        self._lock = Lock()
+        self._last_progress = self.start
+
+    def add(self, item, elapsed, success):
+        with self._lock:
+            self.done += 1
+            self.timings.append((elapsed, item))
+            if not success:
+                self.failed.append(item)
+            now = perf_counter()
+            if now - self._last_progress >= PROGRESS_INTERVAL:
+                self._last_progress = now
+                logger.info(f"{self.label}: {self.done}/{self.total} done, {len(self.failed)} failed")
+
+    @property
+    def elapsed(self):
+        return perf_counter() - self.start
+
+    def summary(self):
+        if len(self.timings) == 0:
+            return f"{self.label}: nothing to do"
+        slowest_time, slowest = max(self.timings, key=lambda timing: timing[0])
+        mean_time = sum(elapsed for elapsed, _ in self.timings) / len(self.timings)
+        return f"{self.label}: {self.done - len(self.failed)}/{self.total} succeeded in {self.elapsed:.1f}s " \
+               f"(mean {mean_time:.2f}s, slowest {slowest_time:.2f}s for {identify(slowest)})"
+
+
+def identify(item):
+    """
+    :return: A representation of an item (or a batch of items) that can be used to retry it, usually the external ids
+    """
+    if isinstance(item, (list, tuple)):
+        return [identify(i) for i in item]
+    return getattr(item, 'external_id', item)
+
+
+def run(items, function, workers=WORKERS, retries=0, label="Tasks", journal=None):
+    """
+    Applies a function to every item using a pool of threads.
+    Each task runs with a usable database connection, which is released (according to CONN_MAX_AGE) once it ends.
+    Failed tasks are retried after every other task is done.
+    :param items: Items to process
+    :param function: Function applied to each item
+    :param workers: Number of simultaneous tasks
+    :param retries: Number of times that the failed items are retried
+    :param label: Name of the run, used in the logs and as the journal phase
+    :param journal: :py:class:`clip.journal.Journal` where the outcome of each item is recorded (optional).
+        Items which already succeeded in the journaled phase are skipped.
+    :return: The items that still failed after the retries
+    """
+    items = list(items)
+    if journal is not None:
+        succeeded = journal.succeeded(label)
+        if succeeded:
+            items = _pending(items, succeeded)
+            logger.info(f"{label}: {len(succeeded)} items were already done, {len(items)} remain")
+    with journal.phase(label) if journal is not None else nullcontext():
+        for attempt in range(retries + 1):
+            report = Report(label if attempt == 0 else f"{label} (retry {attempt})", len(items))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_task, function, item, report, journal, label) for item in items]
+                for future in as_completed(futures):
+                    future.result()
+            logger.info(report.summary())
+            items = report.failed
+            if len(items) == 0:
+                break
+            if attempt < retries:
+                sleep(2 ** attempt)
+
+    if items:
+        logger.error(f"{label}: {len(items)} failed ({[identify(item) for item in items]})")
+    return items
+
+
+def _pending(items, succeeded):
+    """
+    :param items: Items (or batches of items) to process
+    :param succeeded: Set with the identification of the items which already succeeded
+    :return: The items which did not succeed yet. Batches are stripped of their succeeded items (and dropped once
+        empty), as they are recorded item by item, regardless of how they were batched.
+    """
+    pending = []
+    for item in items:
+        if isinstance(item, (list, tuple)):
+            item = type(item)(i for i in item if str(identify(i)) not in succeeded)
+            if item:
+                pending.append(item)
+        elif str(identify(item)) not in succeeded:
+            pending.append(item)
+    return pending
+
+
+def _task(function, item, report, journal=None, phase=None):
+    close_old_connections()
+    start = perf_counter()
+    success = False
+    counter = ThreadQueryCounter()
+    try:
+        with counter:
+            function(item)
+        success = True
+    except NetworkException as e:
+        logger.error(f"Failed to sync {identify(item)}: {e}")
+    except Exception:
+        logger.exception(f"Unexpected failure processing {identify(item)}")
+    finally:
+        elapsed = perf_counter() - start
+        logger.debug(f"Processed {identify(item)} in {elapsed:.2f}s with {counter.count} queries")
+        report.add(item, elapsed, success)
+        if journal is not None:
+            if isinstance(item, (list, tuple)):
+                # Batch items are recorded one by one, sharing the batch costs
+                for batch_item in item:
+                    journal.record(phase, identify(batch_item), elapsed / len(item), success,
+                                   counter.count // len(item))
+            else:
+                journal.record(phase, identify(item), elapsed, success, counter.count)
+        close_old_connections()
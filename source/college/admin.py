@@ -36,6 +36,7 @@ admin.site.register(m.Room, LeafletGeoAdmin)
 admin.site.register(m.Department)
 admin.site.register(m.Enrollment)
 admin.site.register(m.PeriodInstance)
+admin.site.register(m.Holiday)
 admin.site.register(m.PlaceFeature)
 admin.site.register(m.Place)
 admin.site.register(m.Student)
@@ -0,0 +1,267 @@
+"""
+Parallel analysis of the external files.
+
+Files are parsed by a pool of processes (parsing is CPU bound), each process being capped in memory and each file
+in time. Workers which die (e.g. segfaulting parsers) or which overrun the deadline of their file (e.g. stuck in
+native code, which alarms do not interrupt) are replaced, their file failing.
+Results are written in batches and the outcome of every file is recorded in a journal (see :py:mod:`clip.journal`),
+so that files which fail are not retried by later runs, unless asked to.
+An interrupted analysis resumes naturally, as only the files without a process date are picked.
+"""
+import logging
+import os
+import resource
+import signal
+from collections import deque
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+from time import perf_counter
+
+from django.db import connections, transaction
+from django.utils import timezone
+
+from clip.journal import Journal
+from clip.models import SyncRecord
+from college import models as m, documents
+from scrapper import files
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_TYPE = 'file_analysis'
+PHASE = 'Files'
+#: Default number of worker processes
+WORKERS = os.cpu_count() or 1
+#: Default time a file can take (seconds)
+TIMEOUT = 120
+#: Default address space of each worker (MiB)
+MEMORY_LIMIT = 2048
+#: Default number of results written at once
+BATCH_SIZE = 50
+#: Files a worker analyses before being replaced (which releases the memory that the parsers fragment)
+TASKS_PER_WORKER = 100
+#: Time the parent gives a worker past the file timeout before killing it (seconds)
+DEADLINE_GRACE = 10
+
+
+class AnalysisTimeout(Exception):
+    pass
+
+
+def pending(retry_failed=False, limit=None, hashes=None):
+    """
+    :param retry_failed: Whether to include the files that failed in previous analyses
+        (failures are only remembered for as long as their runs are kept, see :py:meth:`Journal.prune`)
+    :param limit: Maximum number of files (optional)
+    :param hashes: Hashes of the files of interest (optional, defaults to every file)
+    :return: List with the hashes of the external files which were not analysed yet
+    """
+    unanalysed = m.File.objects.filter(external=True, process_date=None)
+    if hashes is not None:
+        unanalysed = unanalysed.filter(hash__in=hashes)
+    if not retry_failed:
+        failed = SyncRecord.objects \
+            .filter(phase__run__sync_type=JOURNAL_TYPE, phase__name=PHASE, success=False) \
+            .values('item')
+        unanalysed = unanalysed.exclude(hash__in=failed)
+    hashes = unanalysed.order_by('hash').values_list('hash', flat=True)
+    return list(hashes if limit is None else hashes[:limit])
+
+
+def run(workers=WORKERS, timeout=TIMEOUT, memory_limit=MEMORY_LIMIT, batch_size=BATCH_SIZE,
+        retry_failed=False, limit=None, hashes=None):
+    """
+    Analyses the pending external files
+    :param workers: Number of worker processes
+    :param timeout: Time a file can take (seconds)
+    :param memory_limit: Address space of each worker (MiB), or None for no limit
+    :param batch_size: Number of results written at once
+    :param retry_failed: Whether to retry the files that failed in previous analyses
+    :param limit: Maximum number of files (optional)
+    :param hashes: Hashes of the files of interest (optional, defaults to every file)
+    :return: Tuple with the number of analysed and failed files
+    """
+    hashes = pending(retry_failed=retry_failed, limit=limit, hashes=hashes)
+    if not hashes:
+        return 0, 0
+    journal = Journal.start(JOURNAL_TYPE, {
+        'workers': workers, 'timeout': timeout, 'memory_limit': memory_limit, 'retry_failed': retry_failed})
+    logger.info(f"Analysing {len(hashes)} files with {workers} workers")
+
+    analysed, failed, batch = 0, 0, []
+    with journal.phase(PHASE):
+        for file_hash, data, error, duration in parse_all(hashes, workers, timeout, memory_limit):
+            journal.record(PHASE, file_hash, duration, error is None)
+            if error is not None:
+                failed += 1
+                logger.warning(f"Failed to analyse {file_hash} ({error})")
+                continue
+            batch.append((file_hash, data))
+            if len(batch) >= batch_size:
+                analysed += _save(batch)
+                batch = []
+                logger.info(f"{analysed + failed}/{len(hashes)} files processed, {failed} failed")
+        if batch:
+            analysed += _save(batch)
+    journal.finish(failed == 0)
+    return analysed, failed
+
+
+def parse_all(hashes, workers=WORKERS, timeout=TIMEOUT, memory_limit=MEMORY_LIMIT):
+    """
+    Parses external files with a pool of processes
+    :param hashes: Hashes of the files
+    :param workers: Number of worker processes
+    :param timeout: Time a file can take (seconds)
+    :param memory_limit: Address space of each worker (MiB), or None for no limit
+    :return: Generator of (file hash, parsed data or None, error or None, duration), in completion order
+    """
+    tasks = deque((file_hash, m.File.external_path_for(file_hash), timeout) for file_hash in hashes)
+    context = get_context('fork')
+    pool = [_Worker(context, memory_limit) for _ in range(min(workers, len(tasks)))]
+    try:
+        while True:
+            for index, worker in enumerate(pool):
+                if worker.task is None and (worker.tasks >= TASKS_PER_WORKER or not worker.process.is_alive()):
+                    worker.stop()
+                    pool[index] = worker = _Worker(context, memory_limit)
+                if worker.task is None and tasks:
+                    worker.submit(tasks.popleft(), timeout + DEADLINE_GRACE)
+            busy = [worker for worker in pool if worker.task is not None]
+            if not busy:
+                break
+            next_deadline = min(worker.deadline for worker in busy)
+            wait([worker.connection for worker in busy] + [worker.process.sentinel for worker in busy],
+                 timeout=max(0, next_deadline - perf_counter()))
+            for worker in busy:
+                result = worker.poll()
+                if result is not None:
+                    yield result
+    finally:
+        for worker in pool:
+            worker.stop()
+
+
+class _Worker:
+    """
+    Worker process, analysing one file at a time, which the parent kills if it overruns its deadline
+    """
+
+    def __init__(self, context, memory_limit):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_work, args=(child_connection, memory_limit), daemon=True)
+        # Workers are forked (also as replacements, once the parent wrote results) and must not share its connections
+        connections.close_all()
+        self.process.start()
+        child_connection.close()
+        self.task, self.start, self.deadline = None, None, None
+        self.tasks = 0
+
+    def submit(self, task, allowance):
+        """
+        :param task: Tuple with the file hash, path and timeout
+        :param allowance: Time the task can take before the worker is killed (seconds)
+        """
+        self.connection.send(task)
+        self.task, self.start = task, perf_counter()
+        self.deadline = self.start + allowance
+        self.tasks += 1
+
+    def poll(self):
+        """
+        :return: Result of the current task (see :py:func:`_analyse`), or None if it is still running
+        """
+        if self.connection.poll():
+            try:
+                result = self.connection.recv()
+            except EOFError:
+                pass  # The worker died, which is handled below
+            else:
+                self.task = None
+                return result
+        if not self.process.is_alive():
+            error = f"worker died (exit code {self.process.exitcode})"
+        elif perf_counter() > self.deadline:
+            error = f"killed after {self.deadline - self.start:.0f}s"
+            self.stop()
+        else:
+            return None
+        file_hash = self.task[0]
+        self.task = None
+        return file_hash, None, error, perf_counter() - self.start
+
+    def stop(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+def _save(batch):
+    """
+    Writes the analysis results of a batch of files and indexes their text
+    :param batch: List of (file hash, parsed data)
+    :return: Number of written files
+    """
+    now = timezone.now()
+    analysed = []
+    for file_hash, data in batch:
+        file = m.File(hash=file_hash)
+        file.apply_analysis(data, now)
+        analysed.append(file)
+    with transaction.atomic():
+        m.File.objects.bulk_update(analysed, ['links', 'pages', 'meta', 'process_date'])
+    documents.index_files([file.hash for file in analysed])
+    return len(analysed)
+
+
+def _init_worker(memory_limit):
+    if memory_limit:
+        limit = memory_limit * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Interruptions are handled by the parent, which stops the pool
+
+
+def _work(connection, memory_limit):
+    """
+    Worker process loop, analysing the files sent by the parent until the connection is closed
+    :param connection: Connection to the parent
+    :param memory_limit: Address space of the worker (MiB), or None for no limit
+    """
+    _init_worker(memory_limit)
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            return
+        connection.send(_analyse(task))
+
+
+def _raise_timeout(*_):
+    raise AnalysisTimeout()
+
+
+def _analyse(task):
+    """
+    Parses a file (in a worker process)
+    :param task: Tuple with the file hash, path and timeout
+    :return: Tuple with the file hash, the parsed data (or None), the error (or None) and the duration
+    """
+    file_hash, file_path, timeout = task
+    start = perf_counter()
+    data, error = None, None
+    try:
+        signal.alarm(timeout)
+        try:
+            data = files.parse(file_path, file_hash)
+        finally:
+            signal.alarm(0)
+        if not data:
+            data, error = None, "unparseable"
+    except AnalysisTimeout:
+        error = f"timed out after {timeout}s"
+    except MemoryError:
+        error = "exceeded the memory limit"
+    except Exception as e:
+        error = str(e) or type(e).__name__
+    return file_hash, data, error, perf_counter() - start
@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class CollegeConfig(AppConfig):
     name = 'college'
+
+    def ready(self):
+        from college import occupation, occurrences, documents
+        occupation.connect_signals()
+        occurrences.connect_signals()
+        documents.connect_signals()
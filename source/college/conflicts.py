@@ -0,0 +1,128 @@
+"""
+Detection of timetable conflicts, students enrolled to shifts whose instances overlap.
+
+Rather than intersecting the instances of every student pairwise, the overlapping instances are found once,
+with a sweep over the instances of each weekday (sorted by their start), and grouped by the pair of shifts they
+belong to. The conflicts of a student are then the pairs of their shifts which are known to overlap.
+"""
+import heapq
+import logging
+from collections import defaultdict
+
+from django.db.models import Q
+
+from college import models as m
+
+logger = logging.getLogger(__name__)
+
+
+class ConflictReport:
+    """
+    Overlapping shift instances of a period and the students affected by them.
+    """
+
+    def __init__(self, overlaps, student_shifts, shift_class_instances):
+        """
+        :param overlaps: Dictionary of {(shift id, shift id): [(shift instance id, shift instance id)]},
+            with the lowest shift id first
+        :param student_shifts: Dictionary of {student id: shift ids}
+        :param shift_class_instances: Dictionary of {shift id: class instance id}
+        """
+        self.overlaps = overlaps
+        self.shift_class_instances = shift_class_instances
+        self.student_conflicts = dict()  # {student id: [(shift id, shift id)]}
+        for student_id, shift_ids in student_shifts.items():
+            shift_ids = sorted(shift_ids)
+            conflicts = [(a, b) for i, a in enumerate(shift_ids) for b in shift_ids[i + 1:] if (a, b) in overlaps]
+            if conflicts:
+                self.student_conflicts[student_id] = conflicts
+
+    def for_student(self, student_id):
+        """
+        :param student_id: Student id
+        :return: List of (shift id, shift id, [(shift instance id, shift instance id)]) with the conflicts of a student
+        """
+        return [(a, b, self.overlaps[(a, b)]) for a, b in self.student_conflicts.get(student_id, [])]
+
+    def for_class_instance(self, class_instance_id):
+        """
+        :param class_instance_id: Class instance id
+        :return: Dictionary of {student id: [(shift id, shift id)]} with the conflicts that involve a class instance
+        """
+        class_instances = self.shift_class_instances
+        report = dict()
+        for student_id, conflicts in self.student_conflicts.items():
+            conflicts = [(a, b) for a, b in conflicts
+                         if class_instances[a] == class_instance_id or class_instances[b] == class_instance_id]
+            if conflicts:
+                report[student_id] = conflicts
+        return report
+
+
+def overlapping_instances(instances):
+    """
+    Sweeps the shift instances of each weekday, keeping the instances which are yet to end in a heap
+    :param instances: Iterable of (shift instance id, shift id, weekday, start, duration)
+    :return: Dictionary of {(shift id, shift id): [(shift instance id, shift instance id)]} with the instances of
+        distinct shifts that overlap, the lowest shift id first
+    """
+    weekdays = defaultdict(list)
+    for instance_id, shift_id, weekday, start, duration in instances:
+        weekdays[weekday].append((start, start + duration, instance_id, shift_id))
+
+    overlaps = defaultdict(list)
+    for day_instances in weekdays.values():
+        day_instances.sort()
+        ongoing = []  # Heap of (end, instance id, shift id)
+        for start, end, instance_id, shift_id in day_instances:
+            while ongoing and ongoing[0][0] <= start:
+                heapq.heappop(ongoing)
+            for _, other_instance_id, other_shift_id in ongoing:
+                if other_shift_id == shift_id:
+                    continue
+                if other_shift_id < shift_id:
+                    overlaps[(other_shift_id, shift_id)].append((other_instance_id, instance_id))
+                else:
+                    overlaps[(shift_id, other_shift_id)].append((instance_id, other_instance_id))
+            heapq.heappush(ongoing, (end, instance_id, shift_id))
+    return dict(overlaps)
+
+
+def find(period, year, students=None, class_instance=None):
+    """
+    Finds the timetable conflicts of the students of a period
+    :param period: Period of the class instances
+    :param year: Year of the class instances
+    :param students: Students (or student queryset) to restrict the search to (optional)
+    :param class_instance: Class instance whose students the search is restricted to (optional)
+    :return: :py:class:`ConflictReport`
+    """
+    enrollments = m.ShiftStudents.objects \
+        .filter(shift__class_instance__period=period, shift__class_instance__year=year) \
+        .exclude(shift__disappeared=True)
+    if students is not None:
+        enrollments = enrollments.filter(student__in=students)
+    if class_instance is not None:
+        enrollments = enrollments.filter(
+            student__in=m.ShiftStudents.objects.filter(shift__class_instance=class_instance).values('student'))
+
+    student_shifts = defaultdict(set)
+    shift_ids = set()
+    for student_id, shift_id in enrollments.values_list('student_id', 'shift_id').iterator():
+        student_shifts[student_id].add(shift_id)
+        shift_ids.add(shift_id)
+
+    # Avoid a huge IN clause on full scans, where every shift of the period is involved anyway
+    instances = m.ShiftInstance.objects \
+        .filter(shift__class_instance__period=period, shift__class_instance__year=year) \
+        .exclude(Q(weekday=None) | Q(start=None) | Q(duration=None) | Q(disappeared=True))
+    if students is not None or class_instance is not None:
+        instances = instances.filter(shift__in=shift_ids)
+    instances = list(instances.values_list('id', 'shift_id', 'weekday', 'start', 'duration', 'shift__class_instance'))
+
+    shift_class_instances = {shift_id: class_instance_id for _, shift_id, _, _, _, class_instance_id in instances}
+    overlaps = overlapping_instances(row[:5] for row in instances)
+    report = ConflictReport(overlaps, student_shifts, shift_class_instances)
+    logger.debug(f"Found {len(overlaps)} overlapping shift pairs in {len(instances)} instances "
+                 f"and {len(report.student_conflicts)} students with conflicts")
+    return report
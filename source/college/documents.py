@@ -1,8 +1,14 @@
+import logging
+
 from django.conf import settings
-from django_elasticsearch_dsl import Document, TextField
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django_elasticsearch_dsl import Document, TextField, IntegerField, NestedField
 from django_elasticsearch_dsl.registries import registry
 from college import models as m
 
+logger = logging.getLogger(__name__)
+
 
 @registry.register_document
 class StudentDocument(Document):
@@ -122,15 +128,44 @@ class ClassDocument(Document):
 
 @registry.register_document
 class FileDocument(Document):
+    """
+    A file, along with the text of each of its pages (as nested documents, so that hits point to pages)
+    and the classes it was shared to (with their visibility, so that searches can be filtered by access)
+    """
     names = TextField()
+    pages = NestedField(properties={
+        'number': IntegerField(),
+        'text': TextField(),
+    })
+    class_files = NestedField(properties={
+        'id': IntegerField(),
+        'name': TextField(),
+        'class_instance': IntegerField(),
+        'class_instance_name': TextField(),
+        'visibility': IntegerField(),
+    })
 
     def prepare_names(self, instance):
-        if instance.meta is None:
-            instance.analyse()
-        names = set(filter(lambda n: n, instance.class_files.values_list('name', flat=True)))
+        names = set(filter(lambda n: n, (class_file.name for class_file in instance.class_files.all())))
         if len(names):
             return " ".join(names)
 
+    def prepare_pages(self, instance):
+        if instance.pages is None:
+            return []
+        return [{'number': number, 'text': text} for number, text in enumerate(instance.pages, start=1)]
+
+    def prepare_class_files(self, instance):
+        return [{'id': class_file.id,
+                 'name': class_file.name,
+                 'class_instance': class_file.class_instance_id,
+                 'class_instance_name': str(class_file.class_instance),
+                 'visibility': class_file.visibility}
+                for class_file in instance.class_files.all()]
+
+    def get_queryset(self):
+        return super().get_queryset().prefetch_related('class_files__class_instance__parent')
+
     class Index:
         name = 'files'
         settings = settings.ELASTIC_INDEX_SETTINGS
@@ -141,3 +176,37 @@ class FileDocument(Document):
         ignore_signals = settings.ELASTIC_IGNORE_SIGNALS
         auto_refresh = settings.ELASTIC_AUTO_REFRESH
         queryset_pagination = settings.ELASTIC_QUERYSET_PAGINATION
+
+
+def index_files(hashes):
+    """
+    Indexes (or reindexes) a set of files, such as those which were just analysed.
+    Failures are logged, as the index can always be rebuilt.
+    :param hashes: Hashes of the files
+    """
+    files = FileDocument().get_queryset().filter(hash__in=hashes)
+    try:
+        FileDocument().update(files)
+    except Exception:
+        logger.exception(f"Failed to index {len(hashes)} files")
+
+
+def connect_signals():
+    """
+    Reindexes the files whose class files change (such as when they are shared or their visibility changes),
+    as their documents carry the class files. Files which were not analysed yet are indexed once they are.
+    """
+
+    def class_file_changed(instance, raw=False, **_):
+        if raw:
+            return
+        file_hash = instance.file_id
+
+        def reindex():
+            if m.File.objects.filter(hash=file_hash, process_date__isnull=False).exists():
+                index_files([file_hash])
+
+        transaction.on_commit(reindex)
+
+    post_save.connect(class_file_changed, sender=m.ClassFile, weak=False, dispatch_uid='documents_class_file_save')
+    post_delete.connect(class_file_changed, sender=m.ClassFile, weak=False, dispatch_uid='documents_class_file_delete')
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from college import analysis
+
+
+class Command(BaseCommand):
+    help = 'Analyses (parses) the external files which were not analysed yet, using a pool of processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=analysis.WORKERS, help='Number of worker processes')
+        parser.add_argument('--timeout', type=int, default=analysis.TIMEOUT, help='Seconds a file can take')
+        parser.add_argument('--memory', type=int, default=analysis.MEMORY_LIMIT,
+                            help='Memory limit of each worker (MiB, 0 for no limit)')
+        parser.add_argument('--batch', type=int, default=analysis.BATCH_SIZE, help='Results written at once')
+        parser.add_argument('--limit', type=int, default=None, help='Maximum number of files')
+        parser.add_argument('--retry-failed', action='store_true', help='Retry the files that failed before')
+
+    def handle(self, *args, **options):
+        analysed, failed = analysis.run(
+            workers=options['workers'],
+            timeout=options['timeout'],
+            memory_limit=options['memory'] or None,
+            batch_size=options['batch'],
+            retry_failed=options['retry_failed'],
+            limit=options['limit'])
+        self.stdout.write(f"{analysed} files analysed, {failed} failed")
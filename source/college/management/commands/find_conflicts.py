@@ -0,0 +1,28 @@
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from college import models as m, conflicts
+
+
+class Command(BaseCommand):
+    help = 'Finds the students with overlapping shifts in a period.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--period', type=int, default=settings.COLLEGE_PERIOD, help='Period of the classes')
+        parser.add_argument('--year', type=int, default=settings.COLLEGE_YEAR, help='Year of the classes')
+        parser.add_argument('--top', type=int, default=20, help='Number of shift pairs to list')
+
+    def handle(self, *args, **options):
+        report = conflicts.find(options['period'], options['year'])
+        affected = Counter(pair for pairs in report.student_conflicts.values() for pair in pairs)
+        self.stdout.write(f"{len(report.overlaps)} pairs of overlapping shifts, "
+                          f"{len(report.student_conflicts)} students with conflicts")
+
+        top = affected.most_common(options['top'])
+        shifts = m.Shift.objects \
+            .select_related('class_instance__parent') \
+            .in_bulk({shift_id for pair, _ in top for shift_id in pair})
+        for (a, b), count in top:
+            self.stdout.write(f"{count} students: {shifts[a]} / {shifts[b]}")
@@ -1,82 +1,99 @@
 import logging
-import queue
-import datetime
-import traceback
-from io import StringIO
-from multiprocessing import Process
-from multiprocessing import Queue
-
-
-from elasticsearch import Elasticsearch
+from time import perf_counter
 
 from django.core.management.base import BaseCommand
-from django.conf import settings
+from elasticsearch import helpers
+from elasticsearch_dsl.connections import connections
 
-from college import models as college
-from scrapper.files import pdfplumber_parse
+from college import models as college, analysis
+from college.documents import FileDocument
 
-logging.basicConfig()
-logging.getLogger("pdfminer").setLevel(logging.WARNING)
 es_logger = logging.getLogger('elasticsearch')
 es_logger.propagate = False
 es_logger.setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
 
-PROCESS_COUNT = 4
+#: Default number of documents sent in each bulk request
+BATCH_SIZE = 100
 
 
 class Command(BaseCommand):
+    help = 'Indexes the external PDF files which are not indexed yet. ' \
+           'Files which were analysed are indexed from their stored analysis, the others are analysed first ' \
+           '(using a pool of processes).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=analysis.WORKERS, help='Number of worker processes')
+        parser.add_argument('--timeout', type=int, default=analysis.TIMEOUT, help='Seconds a file can take')
+        parser.add_argument('--memory', type=int, default=analysis.MEMORY_LIMIT,
+                            help='Memory limit of each worker (MiB, 0 for no limit)')
+        parser.add_argument('--batch', type=int, default=BATCH_SIZE, help='Documents sent in each bulk request')
+        parser.add_argument('--limit', type=int, default=None, help='Maximum number of files')
+        parser.add_argument('--reindex', action='store_true', help='Index the files which are already indexed')
+        parser.add_argument('--retry-failed', action='store_true', help='Retry the files that failed to be analysed')
 
     def handle(self, *args, **options):
-        input_queue = Queue()  # File hashes
-        elastic = Elasticsearch()
-        elastic.indices.create(index='document_data', ignore=400)
-        for file in college.File.objects.filter(external=True, mime='application/pdf').all():
-            results = elastic.search(
-                index='document_data',
-                body={
-                    "query": {
-                        "bool": {
-                            "must": [
-                                {"match": {"hash": file.hash}},
-                                # More deduplication criteria, perhaps?
-                            ]
-                        }
-                    }
-                }, ignore=400)
-            hits = results['hits']['hits']
-
-            if 'error' in results or len(hits) == 0:
-                input_queue.put(file.hash)
-
-        i = 1
-        processes = []
-        output_queue = Queue()
-
-        for _ in range(PROCESS_COUNT):
-            p = Process(target=process_exec, args=(input_queue, output_queue))
-            p.start()
-            processes.append(p)
-
-        while True:  # output_queue.qsize() > 0 or any(map(lambda p: p.is_alive(), processes)):
-            try:
-                document_data = output_queue.get(timeout=30)
-                indexed = elastic.index(index='document_data', body=document_data, op_type='index')
-                print(f"{i} - {datetime.datetime.now()}")
-                i += 1
-            except Exception:  # queue.Empty:
-                pass
-
-
-def process_exec(input: Queue, output: Queue):
-    while input.qsize() > 0:
-        file_hash = input.get()
-        file_path = f"{settings.EXTERNAL_ROOT}/{file_hash[:2]}/{file_hash[2:]}"
-        try:
-            document_data = pdfplumber_parse(file_path, file_hash)
-            if document_data is not None:
-                output.put(document_data)
-        except Exception as e:
-            print(f"File {file_hash} had an exception: {e}")
-            traceback.print_exc()
-
-
+        if not FileDocument._index.exists():
+            FileDocument.init()
+
+        files = college.File.objects \
+            .filter(external=True, mime='application/pdf') \
+            .order_by('hash') \
+            .values_list('hash', 'process_date')
+        if options['reindex']:
+            files = list(files)
+        else:
+            indexed = indexed_hashes(connections.get_connection())
+            files = [(file_hash, process_date) for file_hash, process_date in files if file_hash not in indexed]
+            self.stdout.write(f"{len(indexed)} files were already indexed")
+        if options['limit'] is not None:
+            files = files[:options['limit']]
+        if not files:
+            self.stdout.write("Nothing to index")
+            return
+
+        analysed = [file_hash for file_hash, process_date in files if process_date is not None]
+        unanalysed = [file_hash for file_hash, process_date in files if process_date is None]
+        indexed, errors = 0, 0
+        start = perf_counter()
+        if analysed:
+            self.stdout.write(f"Indexing {len(analysed)} analysed files")
+            batch = options['batch']
+            for offset in range(0, len(analysed), batch):
+                chunk = analysed[offset:offset + batch]
+                success, failed = FileDocument().update(
+                    FileDocument().get_queryset().filter(hash__in=chunk), raise_on_error=False)
+                indexed += success
+                errors += len(failed)
+                for item in failed:
+                    self.stderr.write(f"Failed to index {item}")
+            elapsed = perf_counter() - start
+            self.stdout.write(f"{indexed} analysed files indexed, {errors} indexing errors, "
+                              f"in {elapsed:.0f}s ({_rate(len(analysed), elapsed)} files/s)")
+        parsed, unparseable = 0, 0
+        start = perf_counter()
+        if unanalysed:
+            # Analysed files are written to the database and indexed as they are analysed
+            self.stdout.write(f"Analysing {len(unanalysed)} files with {options['workers']} workers")
+            parsed, unparseable = analysis.run(
+                workers=options['workers'],
+                timeout=options['timeout'],
+                memory_limit=options['memory'] or None,
+                retry_failed=options['retry_failed'],
+                hashes=unanalysed)
+            elapsed = perf_counter() - start
+            self.stdout.write(f"{parsed} files analysed and indexed, {unparseable} unparseable, "
+                              f"in {elapsed:.0f}s ({_rate(parsed + unparseable, elapsed)} files/s)")
+
+
+def indexed_hashes(elastic):
+    """
+    :param elastic: Elasticsearch client
+    :return: Set with the hashes of the indexed files (documents are identified by the file hash)
+    """
+    hits = helpers.scan(elastic, index=FileDocument._index._name, query={'_source': False}, size=5000)
+    return {hit['_id'] for hit in hits}
+
+
+def _rate(count, elapsed):
+    return f"{count / elapsed if elapsed else 0:.2f}"
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from college import utilization
+from college.choice_types import WEEKDAY_CHOICES
+
+
+class Command(BaseCommand):
+    help = 'Reports the room utilization of a period throughout a range of years.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--period', type=int, default=settings.COLLEGE_PERIOD, help='Period of the classes')
+        parser.add_argument('--from', dest='first_year', type=int, default=settings.COLLEGE_YEAR,
+                            help='First year of the report')
+        parser.add_argument('--to', dest='last_year', type=int, default=settings.COLLEGE_YEAR,
+                            help='Last year of the report')
+        parser.add_argument('--granularity', type=int, default=utilization.SLOT_MINUTES, help='Slot length (minutes)')
+        parser.add_argument('--building', type=int, default=None, help='Building id')
+
+    def handle(self, *args, **options):
+        weekdays = dict(WEEKDAY_CHOICES)
+        for year in range(options['first_year'], options['last_year'] + 1):
+            report = utilization.report(options['period'], year,
+                                        granularity=options['granularity'], building=options['building'])
+            self.stdout.write(f"{year}, period {options['period']}: {report['utilization']}% utilization")
+            for building in report['buildings']:
+                self.stdout.write(f"\t{building['abbreviation']}: {building['utilization']}%")
+            for room_type in report['room_types']:
+                self.stdout.write(f"\t{room_type['name']}: {room_type['utilization']}%")
+            peaks = ', '.join(f"{weekdays[slot['weekday']]} {slot['time']} ({slot['utilization']}%)"
+                              for slot in report['peak_slots'])
+            self.stdout.write(f"\tPeaks: {peaks}")
+            underused = ', '.join(f"{room['building']} {room['name']} ({room['utilization']}%)"
+                                  for room in report['underused'])
+            self.stdout.write(f"\tUnderused: {underused}")
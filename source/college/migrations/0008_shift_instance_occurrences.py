@@ -0,0 +1,47 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('college', '0007_external_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Holiday',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True)),
+                ('name', models.CharField(max_length=100)),
+            ],
+            options={
+                'ordering': ['date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ShiftInstanceOccurrence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField()),
+                ('room', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE,
+                                           related_name='shift_occurrences', to='college.room')),
+                ('shift_instance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                                     related_name='occurrences', to='college.shiftinstance')),
+            ],
+            options={
+                'ordering': ['start'],
+                'unique_together': {('shift_instance', 'start')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='shiftinstanceoccurrence',
+            index=models.Index(fields=['room', 'start'], name='college_occurrence_room_start'),
+        ),
+        migrations.AddIndex(
+            model_name='shiftinstanceoccurrence',
+            index=models.Index(fields=['start'], name='college_occurrence_start'),
+        ),
+    ]
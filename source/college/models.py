@@ -43,6 +43,8 @@ class Importable(djm.Model):
     disappeared = djm.BooleanField(default=False)
     #: Additional external data that doesn't otherwise fit the model
     external_data = djm.JSONField(default=dict, blank=True, null=True)
+    #: Digest of the last external data this object was synchronized with
+    external_hash = djm.CharField(null=True, blank=True, max_length=40)
 
     class Meta:
         abstract = True
@@ -693,6 +695,46 @@ class ShiftInstance(Importable):
         return "%02d:%02d" % (minutes // 60, minutes % 60)
 
 
+class ShiftInstanceOccurrence(djm.Model):
+    """
+    A dated occurrence of a :py:class:`ShiftInstance`, materialized from its weekday and time throughout the dates
+    of its class instance (see :py:mod:`college.occurrences`).
+    """
+    #: Shift instance that occurs
+    shift_instance = djm.ForeignKey(ShiftInstance, on_delete=djm.CASCADE, related_name='occurrences')
+    #: Room where the occurrence happens (the shift instance room at the time of the materialization)
+    room = djm.ForeignKey(Room, on_delete=djm.CASCADE, null=True, blank=True, related_name='shift_occurrences')
+    #: Start datetime
+    start = djm.DateTimeField()
+    #: End datetime
+    end = djm.DateTimeField()
+
+    class Meta:
+        ordering = ['start']
+        unique_together = ['shift_instance', 'start']
+        indexes = [
+            djm.Index(fields=['room', 'start'], name='college_occurrence_room_start'),
+            djm.Index(fields=['start'], name='college_occurrence_start'),
+        ]
+
+    def __str__(self):
+        return f"{self.shift_instance_id} at {self.start}"
+
+
+class Holiday(djm.Model):
+    """A day without classes"""
+    #: Date of the holiday
+    date = djm.DateField(unique=True)
+    #: Holiday name
+    name = djm.CharField(max_length=100)
+
+    class Meta:
+        ordering = ['date']
+
+    def __str__(self):
+        return f"{self.name} ({self.date})"
+
+
 class TeacherRank(djm.Model):
     #: The name of this rank
     name = djm.CharField(max_length=32)
@@ -879,29 +921,44 @@ class File(Importable):
     def get_download_url(self):
         return reverse('college:file_download', args=[self.hash])
 
+    @staticmethod
+    def external_path_for(file_hash):
+        return f"/{settings.EXTERNAL_ROOT}/{file_hash[:2]}/{file_hash[2:]}"
+
     def analyse(self):
         if self.external:
-            file_path = f"/{settings.EXTERNAL_ROOT}/{self.hash[:2]}/{self.hash[2:]}"
+            file_path = File.external_path_for(self.hash)
             try:
-                data = files.parse(file_path, self.hash)
+                data = files.parse(file_path, self.hash, meta=self.meta, pages=self.pages)
             except:
                 print(f"File {file_path} failed to parse.")
                 traceback.print_exc()
                 return
 
             if data:
-                # data.pop('images')
-                self.links = data.pop('links')
-                self.pages = data.pop('pages')
-                self.meta = data
-                self.process_date = timezone.now()
+                self.apply_analysis(data)
                 try:
                     self.save()
                 except Exception:
                     traceback.print_exc()
+                    return
+                from college.documents import index_files  # Documents depend on the models
+                index_files([self.hash])
         else:
             raise NotImplementedError()
 
+    def apply_analysis(self, data, timestamp=None):
+        """
+        Assigns (without saving) the result of a file parse
+        :param data: Parsed data (see :py:func:`scrapper.files.parse`)
+        :param timestamp: Analysis timestamp (defaults to now)
+        """
+        # data.pop('images')
+        self.links = data.pop('links')
+        self.pages = data.pop('pages')
+        self.meta = data
+        self.process_date = timezone.now() if timestamp is None else timestamp
+
 
 @reversion.register()
 class ClassFile(Importable):
@@ -0,0 +1,220 @@
+"""
+In-memory index of the room occupation.
+
+For a period, year and weekday, the index holds the occupied time slots of each room as a bitmask
+(bit ``i`` set meaning that the ``i``-th slot of the day is occupied).
+Indexes are built with a couple of queries the first time they are needed and then kept in the process memory.
+They are dropped whenever the shift instances or rooms change (after the synchronization or on edits),
+which is signaled to every process through a version number kept in the cache.
+"""
+import logging
+from threading import Lock
+from time import monotonic
+
+from django.core.cache import cache
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+
+from college import models as m
+from college.choice_types import RoomType
+
+logger = logging.getLogger(__name__)
+
+#: Default day start (minutes since midnight, 08:00)
+DAY_START = 8 * 60
+#: Default day end (minutes since midnight, 20:00)
+DAY_END = 20 * 60
+#: Default slot length (minutes)
+SLOT_MINUTES = 30
+#: Slot length of the free room lookups (minutes), which accept arbitrary intervals
+FREE_ROOM_GRANULARITY = 5
+#: Seconds after which an index is rebuilt anyway, as some caches are not shared between processes (eg. dummy)
+MAX_AGE = 10 * 60
+
+VERSION_KEY = 'occupation_version'
+
+_indexes = dict()  # {(period, year, start, end, granularity): (version, timestamp, {weekday: index})}
+_lock = Lock()
+
+
+class OccupationIndex:
+    """
+    Occupation of every room in a weekday, split in slots of a fixed length.
+    """
+
+    def __init__(self, weekday, rooms, start=DAY_START, end=DAY_END, granularity=SLOT_MINUTES):
+        """
+        :param weekday: Weekday (0 is Monday)
+        :param rooms: Rooms (with their building) which are part of the index
+        :param start: Start of the day (minutes since midnight)
+        :param end: End of the day (minutes since midnight)
+        :param granularity: Slot length (minutes)
+        """
+        self.weekday = weekday
+        self.rooms = rooms
+        self.start = start
+        self.end = end
+        self.granularity = granularity
+        self.slots = (end - start + granularity - 1) // granularity
+        self.masks = dict()  # {room_id: occupied slots bitmask}
+
+    def slot_mask(self, start, end):
+        """
+        :param start: Interval start (minutes since midnight)
+        :param end: Interval end (minutes since midnight)
+        :return: Bitmask of the slots which intersect an interval
+        """
+        first = max(0, (start - self.start) // self.granularity)
+        last = min(self.slots, -(-(end - self.start) // self.granularity))  # Ceiling division
+        if last <= first:
+            return 0
+        return ((1 << (last - first)) - 1) << first
+
+    def occupy(self, room_id, start, duration):
+        """
+        Flags the slots of a room occupied during an interval
+        :param room_id: Room id
+        :param start: Interval start (minutes since midnight)
+        :param duration: Interval duration (minutes)
+        """
+        if mask := self.slot_mask(start, start + duration):
+            self.masks[room_id] = self.masks.get(room_id, 0) | mask
+
+    def is_free(self, room_id, start, end):
+        """
+        :return: Whether a room is free during a whole interval
+        """
+        return self.masks.get(room_id, 0) & self.slot_mask(start, end) == 0
+
+    def free_rooms(self, start, end):
+        """
+        :param start: Interval start (minutes since midnight)
+        :param end: Interval end (minutes since midnight)
+        :return: List with the (non-extinguished) rooms which are free during a whole interval
+        """
+        mask = self.slot_mask(start, end)
+        masks = self.masks
+        return [room for room in self.rooms if not room.extinguished and masks.get(room.id, 0) & mask == 0]
+
+    def slot_states(self, room):
+        """
+        :param room: Room
+        :return: List with the state of each slot of a room: True if occupied,
+            otherwise False if the room is accessible or None if that is unknown
+        """
+        mask = self.masks.get(room.id, 0)
+        empty_state = False if room.type == RoomType.CLASSROOM or room.unlocked else None
+        return [True if mask >> slot & 1 else empty_state for slot in range(self.slots)]
+
+    def table(self, building=None, occupied_only=False):
+        """
+        :param building: Building whose rooms are tabled (optional, defaults to every building)
+        :param occupied_only: Whether to skip the rooms which are never occupied
+        :return: Dictionary of {building: {room: [slot states]}}
+        """
+        table = dict()
+        for room in self.rooms:
+            if building is not None and room.building_id != building.id:
+                continue
+            if occupied_only and room.id not in self.masks:
+                continue
+            table.setdefault(room.building, dict())[room] = self.slot_states(room)
+        return table
+
+
+def index(period, year, weekday, start=DAY_START, end=DAY_END, granularity=SLOT_MINUTES):
+    """
+    :param period: Period of the class instances
+    :param year: Year of the class instances
+    :param weekday: Weekday (0 is Monday)
+    :param start: Start of the day (minutes since midnight)
+    :param end: End of the day (minutes since midnight)
+    :param granularity: Slot length (minutes)
+    :return: The :py:class:`OccupationIndex` of the weekday, built if it is not known or outdated
+    """
+    key = (period, year, start, end, granularity)
+    entry = _indexes.get(key)
+    now = monotonic()
+    if entry is not None:
+        version, timestamp, weekdays = entry
+        if now - timestamp < MAX_AGE and version == _version():
+            return weekdays[weekday]
+    with _lock:
+        version = _version()
+        entry = _indexes.get(key)
+        if entry is None or entry[0] != version or now - entry[1] >= MAX_AGE:
+            entry = (version, monotonic(), build(period, year, start, end, granularity))
+            _indexes[key] = entry
+    return entry[2][weekday]
+
+
+def free_rooms(period, year, weekday, start, end, building=None, room_type=None, unlocked=None):
+    """
+    Looks up the rooms which are free during an interval, without querying the database (once the index is built)
+    :param period: Period of the class instances
+    :param year: Year of the class instances
+    :param weekday: Weekday (0 is Monday)
+    :param start: Interval start (minutes since midnight)
+    :param end: Interval end (minutes since midnight)
+    :param building: Id of the building of the rooms (optional)
+    :param room_type: Type of the rooms (optional)
+    :param unlocked: Whether the rooms are unlocked (optional)
+    :return: List of rooms
+    """
+    rooms = index(period, year, weekday, start=0, end=24 * 60, granularity=FREE_ROOM_GRANULARITY) \
+        .free_rooms(start, end)
+    return [room for room in rooms
+            if (building is None or room.building_id == building)
+            and (room_type is None or room.type == room_type)
+            and (unlocked is None or room.unlocked == unlocked)]
+
+
+def build(period, year, start=DAY_START, end=DAY_END, granularity=SLOT_MINUTES):
+    """
+    Builds the occupation indexes of every weekday of a period
+    :return: Dictionary of {weekday: OccupationIndex}
+    """
+    occupation = m.ShiftInstance.objects \
+        .filter(shift__class_instance__period=period,
+                shift__class_instance__year=year,
+                start__lt=end) \
+        .exclude(Q(room=None) | Q(weekday=None) | Q(duration=None) | Q(disappeared=True)) \
+        .values_list('weekday', 'start', 'duration', 'room_id')
+    occupation = list(occupation)
+    used_rooms = {room_id for _, _, _, room_id in occupation}
+    rooms = list(m.Room.objects
+                 .select_related('building')
+                 .filter(Q(extinguished=False) | Q(id__in=used_rooms))
+                 .order_by('building', 'name'))
+
+    weekdays = {weekday: OccupationIndex(weekday, rooms, start, end, granularity) for weekday in range(7)}
+    for weekday, shift_start, duration, room_id in occupation:
+        weekdays[weekday].occupy(room_id, shift_start, duration)
+    logger.debug(f"Built the occupation of {len(rooms)} rooms in period {period} of {year}")
+    return weekdays
+
+
+def invalidate(*args, **kwargs):
+    """
+    Drops the known indexes, in every process (as long as the cache is shared).
+    Accepts (and ignores) signal arguments.
+    """
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 1, timeout=None)
+    with _lock:
+        _indexes.clear()
+
+
+def _version():
+    return cache.get(VERSION_KEY, 0)
+
+
+def connect_signals():
+    """
+    Invalidates the indexes whenever a room or shift instance is saved or deleted
+    """
+    for model in (m.ShiftInstance, m.Room):
+        post_save.connect(invalidate, sender=model, dispatch_uid=f'occupation_{model.__name__}_save')
+        post_delete.connect(invalidate, sender=model, dispatch_uid=f'occupation_{model.__name__}_delete')
@@ -0,0 +1,160 @@
+"""
+Materialization of the shift instances (a weekday and a time of the day) into dated occurrences.
+
+A shift instance occurs on its weekday of every week between the dates of its class instance
+(or those of the class instance period), except on holidays.
+Occurrence datetimes are localized one by one, so that they keep their local time across daylight saving changes.
+
+The materialization is incremental: the expected occurrences of each shift instance are compared with the stored
+ones and only the shift instances whose occurrences differ get theirs replaced.
+"""
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, time, timedelta
+from threading import Lock
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
+
+from college import models as m
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+#: Fields of a shift instance which affect its occurrences
+OCCURRENCE_FIELDS = {'weekday', 'start', 'duration', 'room', 'disappeared'}
+
+_deferral_lock = Lock()
+_deferrals = 0
+
+
+@contextmanager
+def deferred():
+    """
+    Context (of the whole process) during which saves do not materialize occurrences, such as a synchronization,
+    which materializes everything once it ends (instead of once per saved shift instance)
+    """
+    global _deferrals
+    with _deferral_lock:
+        _deferrals += 1
+    try:
+        yield
+    finally:
+        with _deferral_lock:
+            _deferrals -= 1
+
+
+def materialize(shift_instances=None, period_instances=None):
+    """
+    Brings the stored occurrences up to date
+    :param shift_instances: Ids of the shift instances to materialize (optional)
+    :param period_instances: Period instances whose shift instances are materialized
+        (optional, defaults to the periods which did not end yet)
+    :return: Number of shift instances whose occurrences were replaced
+    """
+    rows = m.ShiftInstance.objects
+    if shift_instances is not None:
+        rows = rows.filter(id__in=shift_instances)
+    if period_instances is not None:
+        rows = rows.filter(shift__class_instance__period_instance__in=period_instances)
+    elif shift_instances is None:
+        rows = rows.filter(shift__class_instance__period_instance__date_to__gte=timezone.localdate())
+    rows = list(rows.values_list(
+        'id', 'weekday', 'start', 'duration', 'room_id', 'disappeared', 'shift__disappeared',
+        'shift__class_instance__date_from', 'shift__class_instance__date_to',
+        'shift__class_instance__period_instance__date_from', 'shift__class_instance__period_instance__date_to'))
+    if not rows:
+        return 0
+
+    first_day = min(filter(None, (row[7] or row[9] for row in rows)), default=None)
+    last_day = max(filter(None, (row[8] or row[10] for row in rows)), default=None)
+    holidays = set() if first_day is None or last_day is None else \
+        set(m.Holiday.objects.filter(date__gte=first_day, date__lte=last_day).values_list('date', flat=True))
+
+    stored = defaultdict(set)  # {shift instance id: {(start, end, room id)}}
+    for shift_instance_id, start, end, room_id in m.ShiftInstanceOccurrence.objects \
+            .filter(shift_instance__in=[row[0] for row in rows]) \
+            .values_list('shift_instance_id', 'start', 'end', 'room_id') \
+            .iterator():
+        stored[shift_instance_id].add((start, end, room_id))
+
+    changed, created = [], []
+    for row in rows:
+        expected = set(_occurrences(row, holidays))
+        if expected != stored.get(row[0], set()):
+            changed.append(row[0])
+            created += [m.ShiftInstanceOccurrence(shift_instance_id=row[0], start=start, end=end, room_id=room_id)
+                        for start, end, room_id in expected]
+
+    if changed:
+        with transaction.atomic():
+            m.ShiftInstanceOccurrence.objects.filter(shift_instance__in=changed).delete()
+            m.ShiftInstanceOccurrence.objects.bulk_create(created, batch_size=BATCH_SIZE)
+        logger.info(f"Materialized {len(created)} occurrences of {len(changed)} shift instances")
+    return len(changed)
+
+
+def _occurrences(row, holidays):
+    """
+    :param row: Shift instance row (see :py:func:`materialize`)
+    :param holidays: Set of holiday dates
+    :return: Generator of (start, end, room id) of the occurrences of a shift instance
+    """
+    _, weekday, start, duration, room_id, disappeared, shift_disappeared, \
+        date_from, date_to, period_from, period_to = row
+    if disappeared or shift_disappeared or None in (weekday, start, duration):
+        return
+    date_from, date_to = date_from or period_from, date_to or period_to
+    if date_from is None or date_to is None:
+        return
+    start_time = time(start // 60, start % 60)
+    day = date_from + timedelta(days=(weekday - date_from.weekday()) % 7)
+    while day <= date_to:
+        if day not in holidays:
+            occurrence_start = timezone.make_aware(datetime.combine(day, start_time), is_dst=False)
+            yield occurrence_start, occurrence_start + timedelta(minutes=duration), room_id
+        day += timedelta(days=7)
+
+
+def between(start, end, room=None):
+    """
+    :param start: Range start (datetime)
+    :param end: Range end (datetime)
+    :param room: Room whose occurrences are looked up (optional)
+    :return: Queryset with the occurrences which intersect a datetime range
+    """
+    occurrences = m.ShiftInstanceOccurrence.objects \
+        .filter(start__lt=end, end__gt=start) \
+        .select_related('shift_instance__shift__class_instance__parent', 'room__building')
+    if room is not None:
+        occurrences = occurrences.filter(room=room)
+    return occurrences
+
+
+def connect_signals():
+    """
+    Rematerializes the occurrences of a shift instance when it (or its shift) is saved, and those of the affected
+    periods when a holiday changes (deleted shift instances take their occurrences along).
+    Nothing is materialized while deferred (see :py:func:`deferred`) or for raw saves (fixtures).
+    """
+
+    def shift_instance_saved(instance, raw=False, update_fields=None, **_):
+        if raw or _deferrals or (update_fields is not None and not OCCURRENCE_FIELDS.intersection(update_fields)):
+            return
+        materialize(shift_instances=[instance.id])
+
+    def shift_saved(instance, raw=False, update_fields=None, **_):
+        if raw or _deferrals or (update_fields is not None and 'disappeared' not in update_fields):
+            return
+        materialize(shift_instances=list(instance.instances.values_list('id', flat=True)))
+
+    def holiday_changed(instance, **_):
+        materialize(period_instances=m.PeriodInstance.objects.filter(
+            date_from__lte=instance.date, date_to__gte=instance.date))
+
+    post_save.connect(shift_instance_saved, sender=m.ShiftInstance, weak=False, dispatch_uid='occurrences_save')
+    post_save.connect(shift_saved, sender=m.Shift, weak=False, dispatch_uid='occurrences_shift_save')
+    post_save.connect(holiday_changed, sender=m.Holiday, weak=False, dispatch_uid='occurrences_holiday_save')
+    post_delete.connect(holiday_changed, sender=m.Holiday, weak=False, dispatch_uid='occurrences_holiday_delete')
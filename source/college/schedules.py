@@ -1,232 +1,351 @@
-from college import models as college
-from college.choice_types import RoomType
+import hashlib
+import heapq
+import logging
+from collections import defaultdict
 
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
 
-def build_schedule(shift_instances: [college.ShiftInstance]):
-    week = [[], [], [], [], []]  # Monday-Friday turn instances
-    unsortable = []  # Instances without schedule information
-    end = 8 * 60  # Last turn added, to crop the end of the schedule. Starts as 8AM when there are no shifts
-    for shift_instance in shift_instances:  # Fetch every turn of this class instance
-        if hasattr(shift_instance, 'weekday') and shift_instance.weekday is not None \
-                and hasattr(shift_instance, 'start') and shift_instance.start is not None \
-                and hasattr(shift_instance, 'duration'):
-            week[shift_instance.weekday].append(shift_instance)
-            end = max(end, shift_instance.start + shift_instance.duration)
-        else:  # Otherwise it's an unsortable turn instance
-            unsortable.append(shift_instance)
-
-    for day_index, day in enumerate(week):  # Sort days in chronological order
-        week[day_index] = sorted(day, key=(lambda shift_instance: shift_instance.start))
-
-    # Outer to inner dimension: Week, day, column, row. Formatted means it displays properly, without intersection.
-    formatted_week = [[[]], [[]], [[]], [[]], [[]]]
-
-    # Sort turn instances into columns without intersection between elements
-    for f_day, day in zip(formatted_week, week):
-        for shift_instance in day:
-            allocated = False  # Whether this turn was successfully allocated in one column
-            for column in f_day:  # Iterate through existing columns
-                has_space = True  # Whether this column had space to allocate the turn
-                for allocated_turn in column:  # For every turn already in the column
-                    allocated_turn: college.ShiftInstance = allocated_turn
-                    shift_instance: college.ShiftInstance = shift_instance
-                    # If one of them intersect this one, then this column is no good, skip it
-                    # TODO check only against the last added turn, if one intersects, that would be the one
-                    if shift_instance.intersects(allocated_turn):
-                        has_space = False
-                        break
-                if has_space:
-                    column.append(shift_instance)
-                    allocated = True
-                    break
+from college import models as college, occupation
+from college.choice_types import ShiftType
+
+logger = logging.getLogger(__name__)
+
+
+#: Schedule start (minutes since midnight, 08:00)
+SCHEDULE_START = 8 * 60
+#: Schedule end (minutes since midnight, 20:00)
+SCHEDULE_END = 20 * 60
+#: Schedule row length (minutes)
+ROW_MINUTES = 30
+#: Weekdays in a schedule (Monday-Friday)
+WEEKDAYS = 5
+#: Seconds a layout stays cached. Layouts are keyed by their input, so they never get stale.
+LAYOUT_CACHE_TIMEOUT = 60 * 60 * 24
+#: Seconds a precomputed course schedule is kept. They are recomputed after every synchronization.
+COURSE_SCHEDULE_TIMEOUT = 60 * 60 * 24 * 7
+
+
+class ScheduleLayout:
+    """
+    Placement of shift instances in a weekly grid of 30 minute rows, where each weekday has as many columns as the
+    maximum number of simultaneous instances.
+    The layout refers to the instances by their position. Its compact form (see :py:meth:`compact`) can thus be
+    cached and then rendered with freshly fetched instances, either by the templates or by API clients.
+    """
+
+    def __init__(self, intervals):
+        """
+        :param intervals: List with the (weekday, start, duration) of each shift instance,
+            or None for the instances without a schedule
+        """
+        self.days = [[] for _ in range(WEEKDAYS)]  # Weekday columns, each a list of (row, rowspan, position)
+        self.unsortable = []  # Positions of the instances without a schedule
+        self.end = SCHEDULE_START  # Latest end, to crop the end of the schedule
+
+        events = [[] for _ in range(WEEKDAYS)]
+        for position, interval in enumerate(intervals):
+            if interval is None or not 0 <= interval[0] < WEEKDAYS:
+                self.unsortable.append(position)
+                continue
+            weekday, start, duration = interval
+            events[weekday].append((start, position, duration))
+            self.end = max(self.end, start + duration)
+
+        for day, day_events in zip(self.days, events):
+            day_events.sort()
+            free = []  # Heap of the columns that are free at the current row
+            busy = []  # Heap of the (row where it frees up, column) of the columns which are still busy
+            for start, position, duration in day_events:
+                row = max(0, (start - SCHEDULE_START) // ROW_MINUTES)
+                rowspan = max(1, duration // ROW_MINUTES)
+                while busy and busy[0][0] <= row:
+                    heapq.heappush(free, heapq.heappop(busy)[1])
+                if free:
+                    column = heapq.heappop(free)
                 else:
-                    continue
-            if not allocated:  # New column needed
-                f_day.append([shift_instance])  # Append a new column to this day with the element already on it
-
-    schedule = [[], [], [], [], []]
-    for day, schedule_day in zip(formatted_week, schedule):
-        for column in day:  # For every day in the column based week
-            schedule_column = []
-            last_addition = 8 * 60  # 8 AM
-            for event in column:  # For every element in that column
-                margin = event.start - last_addition  # Minutes from the last element
-                gaps = margin // 30  # Every thirty minutes there's one gap
-                [schedule_column.append(None) for _ in range(gaps)]  # Fill empty gaps
-                schedule_column.append({'shift': event, 'rowspan': event.duration // 30,
-                                        'start': event.minutes_to_str(event.start)})
-                # Well, I kinda lost myself when I came back to comment. This would be margin + event duration
-                last_addition += margin + 30  # But works with 30 minutes and doesn't with the event duration ¯\_(ツ )_/¯
-            for _ in range((20 * 60 - last_addition) // 30):  # Fill with None events till 8 PM
-                # TODO fill with None events only till the 'end' to save some pointless None array additions
-                schedule_column.append(None)
-            schedule_day.append(schedule_column)
-
-    weekday_colspans = list(map(lambda day: len(day), schedule))  # Calculate the width of every weekday
-    rows = []  # The schedule will be broken in rows. HTML doesn't like column-based tables
-    # A rowspan makes the next row element shift right.
-    skips = {}  # Signal those shifts in order not to add (None) elements that would get shifted
-    [rows.append([]) for _ in range(12 * 60 // 30)]  # 30 minute spaces in 12 hours from 8AM to 8PM
-    for row_index, row in enumerate(rows):
-        column_offset = 0  # Tuesday isn't the first column. Store the previous days offset to have the correct column
-        for day_index, day in enumerate(schedule):  # Run through the days once for every row
-            for column_index, column in enumerate(day):
-                column_index = column_index + column_offset  # Consider the shift that the previous days do to the cols
-                if column_index in skips:  # If this column has an above element with >1 rowspan
-                    skips[column_index] -= 1  # Decrement the remaining number of spans
-                    if skips[column_index] == 0:
-                        del skips[column_index]
-                    continue  # And skip adding the corresponding event
-
-                event = column[row_index]
-                row.append(event)
-                if event and event['rowspan'] > 1:  # If the event is not a None and has a >1 rowspan
-                    skips[column_index] = event['rowspan'] - 1  # Tag it in the skips, for the next column to be skipped
-            column_offset += weekday_colspans[day_index]  # Add this day to the offsets
-
-    empty_rows_start = 0
-    for row in rows[:]:  # For every row which only has None elements
-        empty = True
-        for column in row:
-            if column is not None:
-                empty = False
-                break
-        if empty:
-            empty_rows_start += 1
-        else:
-            break
-
-    empty_rows_end = (20 * 60 - end) // 30  # Rows to ignore at the end when adding to the result. Read last TODO
-
-    initial_time = 8 * 6 + empty_rows_start * 3  # Initial schedule time (in tens of minutes)
-    result = []
-    # For every relevant row (ignore empty rows at the start/end)
-    for row in rows[empty_rows_start:(-empty_rows_end if empty_rows_end > 0 else None)]:
-        # TODO take that HTML out of here. Does not belong here
-        result.append((f'{initial_time // 6}:{initial_time % 6}0 '
-                       f'<span class="end-time">{(initial_time + 3) // 6}:{(initial_time + 3) % 6}0</span>', row))
-        initial_time += 3
-    return weekday_colspans, result, unsortable
+                    column = len(day)
+                    day.append([])
+                day[column].append((row, rowspan, position))
+                heapq.heappush(busy, (row + rowspan, column))
+
+    @staticmethod
+    def intervals(shift_instances):
+        """
+        :param shift_instances: Shift instances
+        :return: Layout input of each instance (see :py:meth:`__init__`)
+        """
+        return [(shift_instance.weekday, shift_instance.start, shift_instance.duration)
+                if getattr(shift_instance, 'weekday', None) is not None
+                and getattr(shift_instance, 'start', None) is not None
+                and getattr(shift_instance, 'duration', None) is not None
+                else None
+                for shift_instance in shift_instances]
+
+    def compact(self, ids):
+        """
+        :param ids: Ids of the laid out shift instances, in their layout order
+        :return: JSON-ready layout, cropped to the rows between the first start and the last end, as a dictionary with
+            the first row time (``start``, minutes since midnight), ``row_minutes``, the row count (``rows``),
+            the column count of each weekday (``columns``), the events as [weekday, column, row, rowspan, position]
+            (``events``, rows counted from the first), the positions of the instances without a schedule
+            (``unsortable``) and the instance ids (``ids``)
+        """
+        row_count = (SCHEDULE_END - SCHEDULE_START) // ROW_MINUTES
+        events = [[weekday, column_index, row, rowspan, position]
+                  for weekday, day in enumerate(self.days)
+                  for column_index, column in enumerate(day)
+                  for row, rowspan, position in column
+                  if row < row_count]
+        first_row = min((event[2] for event in events), default=row_count)
+        last_row = row_count - max(0, (SCHEDULE_END - self.end) // ROW_MINUTES)
+        for event in events:
+            event[2] -= first_row
+        return {
+            'start': SCHEDULE_START + first_row * ROW_MINUTES,
+            'row_minutes': ROW_MINUTES,
+            'rows': max(0, last_row - first_row),
+            'columns': [max(1, len(day)) for day in self.days],
+            'events': events,
+            'unsortable': self.unsortable,
+            'ids': list(ids),
+        }
+
+
+def layout(shift_instances):
+    """
+    :param shift_instances: Shift instances, in the order they are going to be rendered
+    :return: The compact layout of the instances (see :py:meth:`ScheduleLayout.compact`),
+        reused from the cache when the same instances were laid out before
+    """
+    intervals = ScheduleLayout.intervals(shift_instances)
+    ids = [shift_instance.id for shift_instance in shift_instances]
+    digest = hashlib.sha1(repr(list(zip(ids, intervals))).encode()).hexdigest()
+    cache_key = f'schedule_layout_{digest}'
+    compact_layout = cache.get(cache_key)
+    if compact_layout is None:
+        compact_layout = ScheduleLayout(intervals).compact(ids)
+        cache.set(cache_key, compact_layout, timeout=LAYOUT_CACHE_TIMEOUT)
+    return compact_layout
+
+
+def render(compact_layout, shift_instances):
+    """
+    Expands a compact layout into table rows
+    :param compact_layout: Layout (see :py:meth:`ScheduleLayout.compact`)
+    :param shift_instances: The laid out shift instances
+    :return: Tuple with the column count of each weekday, the schedule rows and the instances without a schedule.
+        Rows are ((start time, end time), row cells) pairs, where cells are either None or events that span rows.
+    """
+    shift_instances = {shift_instance.id: shift_instance for shift_instance in shift_instances}
+    shift_instances = [shift_instances.get(shift_instance_id) for shift_instance_id in compact_layout['ids']]
+    # Each column as {row: event} for the event starts and a set with the rows covered by their spans
+    columns = [[(dict(), set()) for _ in range(colspan)] for colspan in compact_layout['columns']]
+    for weekday, column, row, rowspan, position in compact_layout['events']:
+        shift_instance = shift_instances[position]
+        if shift_instance is None:
+            continue
+        starts, covered = columns[weekday][column]
+        starts[row] = {'shift': shift_instance, 'rowspan': rowspan,
+                       'start': shift_instance.minutes_to_str(shift_instance.start)}
+        covered.update(range(row + 1, row + rowspan))
+    columns = [column for day in columns for column in day]
+
+    rows = []
+    row_minutes = compact_layout['row_minutes']
+    for row_index in range(compact_layout['rows']):
+        row = []
+        for starts, covered in columns:
+            if row_index in starts:
+                row.append(starts[row_index])
+            elif row_index not in covered:
+                row.append(None)
+        row_start = compact_layout['start'] + row_index * row_minutes
+        rows.append(((_time_label(row_start), _time_label(row_start + row_minutes)), row))
+    unsortable = [shift_instances[position] for position in compact_layout['unsortable']]
+    return compact_layout['columns'], rows, [shift_instance for shift_instance in unsortable if shift_instance]
+
+
+def _time_label(minutes):
+    return f'{minutes // 60}:{minutes % 60:02d}'
+
+
+def build_schedule(shift_instances: [college.ShiftInstance]):
+    """
+    Lays out shift instances in a weekly schedule (see :py:class:`ScheduleLayout`)
+    :param shift_instances: Shift instances
+    :return: Tuple with the column count of each weekday, the schedule rows and the instances without a schedule
+    """
+    shift_instances = sorted(shift_instances, key=lambda shift_instance: shift_instance.id)
+    return render(layout(shift_instances), shift_instances)
 
 
 def build_shifts_schedule(shifts: [college.Shift]):
-    shift_instances = [shift_instance
-                      for shift in shifts
-                      for shift_instance in shift.instances.exclude(disappeared=True).all()]
-    return build_schedule(shift_instances)
+    """
+    Lays out the instances of shifts in a weekly schedule, fetching them in a single query
+    :param shifts: Shifts
+    :return: Tuple with the column count of each weekday, the schedule rows and the instances without a schedule
+    """
+    return build_schedule(shifts_instances(shifts))
 
 
-def build_occupation_table(period, year, weekday):
-    # {building: {room: [time slot occupation]}}
-    start_time = 8 * 60  # Start at 08:00
-    end_time = 20 * 60  # End at 20:00
-    slots = (end_time - start_time) // 30
-    building_room_timeslots = dict()
-    shift_instances = college.ShiftInstance.objects \
-        .select_related('room', 'room__building') \
-        .order_by('room__building', 'room', 'start') \
-        .filter(weekday=weekday,
-                start__lt=end_time,
-                shift__class_instance__period=period,
-                shift__class_instance__year=year) \
-        .exclude(room=None).all()
-
-    current_room = None
-    room_slots = None
-    for shift_instance in shift_instances:
-        if shift_instance.room != current_room:
-            if current_room is None or shift_instance.room.building != current_room.building:
-                building_dict = dict()
-                building_room_timeslots[shift_instance.room.building] = building_dict
-            else:
-                building_dict = building_room_timeslots[current_room.building]
-
-            current_room = shift_instance.room
-            empty_state = False if current_room == RoomType.CLASSROOM or current_room.unlocked else None
-            room_slots = slots * [empty_state]
-            building_dict[current_room] = room_slots
-
-        # Fill the corresponding slots for this turn instance
-        if shift_instance.start < start_time:
-            if shift_instance.start + shift_instance.duration > start_time:
-                busy_slots = (shift_instance.start - start_time + shift_instance.duration) // 30
-                room_slots[:busy_slots] = busy_slots * [True]
-            else:
-                continue
-        else:
-            start_slot = (shift_instance.start - start_time) // 30
-            if shift_instance.start + shift_instance.duration > end_time:
-                relevant_duration = end_time - shift_instance.start
-            else:
-                relevant_duration = shift_instance.duration
-            busy_slots = relevant_duration // 30
-            room_slots[start_slot:start_slot + busy_slots] = busy_slots * [True]
-
-    # Fetch remaining rooms (without classes associated)
-    rooms = college.Room.objects \
-        .select_related('building') \
-        .order_by('building') \
-        .exclude(extinguished=True).all()
-    for room in rooms:
-        empty_state = False if room == RoomType.CLASSROOM or room.unlocked else None
-        if room.building in building_room_timeslots:
-            building_dict = building_room_timeslots[room.building]
-            if room in building_dict:
+def shifts_instances(shifts: [college.Shift]):
+    """
+    :param shifts: Shifts
+    :return: Queryset with the (scheduled or not) instances of the shifts
+    """
+    return college.ShiftInstance.objects \
+        .filter(shift__in=[shift.id for shift in shifts]) \
+        .exclude(disappeared=True) \
+        .select_related('shift__class_instance__parent', 'room__building')
+
+
+def serialize(shift_instances):
+    """
+    :param shift_instances: Shift instances (with their shift, class and room)
+    :return: JSON-ready layout of the instances, along with their data
+    """
+    shift_instances = sorted(shift_instances, key=lambda shift_instance: shift_instance.id)
+    return {
+        'shift_instances': [{
+            'id': shift_instance.id,
+            'shift': shift_instance.shift_id,
+            'class_instance': shift_instance.shift.class_instance_id,
+            'class': shift_instance.shift.class_instance.parent.abbreviation,
+            'type': shift_instance.shift.type_abbreviation,
+            'number': shift_instance.shift.number,
+            'weekday': shift_instance.weekday,
+            'start': shift_instance.start,
+            'duration': shift_instance.duration,
+            'room': None if shift_instance.room is None else
+            {'id': shift_instance.room_id, 'name': shift_instance.room.short_str()},
+        } for shift_instance in shift_instances],
+        'layout': layout(shift_instances),
+    }
+
+
+def course_schedule(course_id, curricular_year, period, year=None):
+    """
+    :param course_id: Course id
+    :param curricular_year: Curricular year (as suggested by the course curriculum)
+    :param period: Period of the class instances
+    :param year: Year of the class instances (defaults to the current one)
+    :return: The schedule of the classes of a curricular year of a course (see :py:func:`precompute_course_schedules`)
+    """
+    year = settings.COLLEGE_YEAR if year is None else year
+    schedule = cache.get(_course_schedule_key(course_id, curricular_year, period, year))
+    if schedule is None:
+        schedules = precompute_course_schedules(year, course_ids=[course_id])
+        schedule = schedules.get((course_id, curricular_year, period))
+        if schedule is None:
+            schedule = _course_schedule(course_id, curricular_year, period, year, [])
+            cache.set(_course_schedule_key(course_id, curricular_year, period, year), schedule,
+                      timeout=COURSE_SCHEDULE_TIMEOUT)
+    return schedule
+
+
+def precompute_course_schedules(year=None, course_ids=None):
+    """
+    Lays out and caches the schedules of the curricular years of the courses.
+    A schedule has the shifts of the classes that the course curriculum suggests for a curricular year and period.
+    Every schedule is computed from the same handful of queries, regardless of the number of courses.
+    :param year: Year of the class instances (defaults to the current one)
+    :param course_ids: Ids of the courses whose schedules are computed (optional, defaults to every course)
+    :return: Dictionary of {(course id, curricular year, period): schedule}
+    """
+    year = settings.COLLEGE_YEAR if year is None else year
+    courses = college.Course.objects.exclude(curriculum=None)
+    if course_ids is not None:
+        courses = courses.filter(id__in=course_ids)
+    course_components = {course_id: aggregation.get('_ids', []) for course_id, aggregation
+                         in courses.values_list('id', 'curriculum__aggregation')}
+
+    components = college.CurricularClassComponent.objects \
+        .filter(id__in={component_id for ids in course_components.values() for component_id in ids}) \
+        .exclude(suggested_year=None) \
+        .values_list('id', 'klass_id', 'suggested_year', 'suggested_period')
+    components = {component_id: (class_id, curricular_year, period)
+                  for component_id, class_id, curricular_year, period in components}
+
+    class_instances = defaultdict(list)  # {class id: [(class instance id, period)]}
+    for instance_id, class_id, period in college.ClassInstance.objects \
+            .filter(parent__in={class_id for class_id, _, _ in components.values()}, year=year) \
+            .values_list('id', 'parent_id', 'period'):
+        class_instances[class_id].append((instance_id, period))
+
+    shift_instances = defaultdict(list)  # {class instance id: [shift instance rows]}
+    for row in college.ShiftInstance.objects \
+            .filter(shift__class_instance__in={instance_id for instances in class_instances.values()
+                                               for instance_id, _ in instances}) \
+            .exclude(Q(disappeared=True) | Q(shift__disappeared=True)) \
+            .order_by('id') \
+            .values_list('id', 'shift_id', 'shift__shift_type', 'shift__number', 'shift__class_instance_id',
+                         'shift__class_instance__parent__abbreviation', 'weekday', 'start', 'duration',
+                         'room_id', 'room__name', 'room__building__abbreviation'):
+        shift_instances[row[4]].append(row)
+
+    schedules = defaultdict(list)  # {(course id, curricular year, period): [shift instance rows]}
+    for course_id, component_ids in course_components.items():
+        for component_id in component_ids:
+            if component_id not in components:
                 continue
-            building_dict[room] = slots * [empty_state]
-        else:
-            building_room_timeslots[room.building] = {room: slots * [empty_state]}
-    return building_room_timeslots
+            class_id, curricular_year, suggested_period = components[component_id]
+            for instance_id, period in class_instances[class_id]:
+                if suggested_period is None or suggested_period == period:
+                    schedules[(course_id, curricular_year, period)] += shift_instances[instance_id]
+
+    schedules = {key: _course_schedule(*key, year, sorted(set(rows))) for key, rows in schedules.items()}
+    cache.set_many({_course_schedule_key(*key, year): schedule for key, schedule in schedules.items()},
+                   timeout=COURSE_SCHEDULE_TIMEOUT)
+    logger.debug(f"Precomputed {len(schedules)} schedules of {len(course_components)} courses")
+    return schedules
+
+
+def _course_schedule(course_id, curricular_year, period, year, rows):
+    """
+    :param rows: Shift instance rows, sorted by id
+    :return: JSON-ready course schedule, with its shift instances and their layout (see :py:func:`serialize`)
+    """
+    schedule_layout = ScheduleLayout([None if None in (weekday, start, duration) else (weekday, start, duration)
+                                      for _, _, _, _, _, _, weekday, start, duration, _, _, _ in rows])
+    return {
+        'course': course_id,
+        'curricular_year': curricular_year,
+        'period': period,
+        'year': year,
+        'shift_instances': [{
+            'id': instance_id,
+            'shift': shift_id,
+            'class_instance': class_instance_id,
+            'class': abbreviation,
+            'type': ShiftType.abbreviation(shift_type),
+            'number': number,
+            'weekday': weekday,
+            'start': start,
+            'duration': duration,
+            'room': None if room_id is None else {'id': room_id, 'name': f'{building} {room_name}'},
+        } for instance_id, shift_id, shift_type, number, class_instance_id, abbreviation,
+              weekday, start, duration, room_id, room_name, building in rows],
+        'layout': schedule_layout.compact([row[0] for row in rows]),
+    }
+
+
+def _course_schedule_key(course_id, curricular_year, period, year):
+    return f'course_schedule_{course_id}_{curricular_year}_{period}_{year}'
+
+
+def build_occupation_table(period, year, weekday):
+    """
+    :return: The room occupation in 30 minute slots, from 08:00 to 20:00, as {building: {room: [slot states]}}.
+        See :py:meth:`college.occupation.OccupationIndex.slot_states`.
+    """
+    return occupation.index(period, year, weekday).table()
 
 
 def build_building_occupation_table(period, year, weekday, building):
-    start_time = 8 * 60  # Start at 08:00
-    end_time = 20 * 60  # End at 20:00
-    slots = (end_time - start_time) // 30
-    room_timeslots = dict()
-    shift_instances = college.ShiftInstance.objects \
-        .select_related('room', 'room__building') \
-        .order_by('room', 'start') \
-        .filter(weekday=weekday,
-                start__lt=end_time,
-                shift__class_instance__period=period,
-                shift__class_instance__year=year,
-                room__building=building) \
-        .exclude(room=None).all()
-
-    current_room = None
-    room_slots = None
-    for shift_instance in shift_instances:
-        if shift_instance.room != current_room:
-            current_room = shift_instance.room
-            empty_state = False if current_room == RoomType.CLASSROOM or current_room.unlocked else None
-            room_slots = slots * [empty_state]
-            room_timeslots[current_room] = room_slots
-
-        # Fill the corresponding slots for this turn instance
-        if shift_instance.start < start_time:
-            if shift_instance.start + shift_instance.duration > start_time:
-                busy_slots = (shift_instance.start - start_time + shift_instance.duration) // 30
-                room_slots[:busy_slots] = busy_slots * [True]
-            else:
-                continue
-        else:
-            start_slot = (shift_instance.start - start_time) // 30
-            if shift_instance.start + shift_instance.duration > end_time:
-                relevant_duration = end_time - shift_instance.start
-            else:
-                relevant_duration = shift_instance.duration
-            busy_slots = relevant_duration // 30
-            room_slots[start_slot:start_slot + busy_slots] = busy_slots * [True]
-
-    # # Fetch remaining rooms (without classes associated)
-    # rooms = college.Room.objects \
-    #     .select_related('building') \
-    #     .filter(building=building) \
-    #     .exclude(extinguished=True).all()
-    # for room in rooms:
-    #     empty_state = False if room == RoomType.CLASSROOM or room.unlocked else None
-    #     if room in room_timeslots:
-    #         continue
-    #     room_timeslots[room] = slots * [empty_state]
-    return room_timeslots
+    """
+    :return: The occupation of the occupied rooms of a building in 30 minute slots, from 08:00 to 20:00,
+        as {room: [slot states]}
+    """
+    return occupation.index(period, year, weekday).table(building, occupied_only=True).get(building, dict())
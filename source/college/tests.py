@@ -0,0 +1,178 @@
+from datetime import date, time, timedelta
+
+from django.test import SimpleTestCase
+from django.utils import timezone
+
+from college import conflicts, utilization, schedules, occurrences
+
+
+class OverlappingInstancesTest(SimpleTestCase):
+    def test_overlap(self):
+        # (shift instance id, shift id, weekday, start, duration)
+        overlaps = conflicts.overlapping_instances([
+            (1, 10, 0, 9 * 60, 120),
+            (2, 20, 0, 10 * 60, 60),
+            (3, 30, 0, 12 * 60, 60),
+        ])
+        self.assertEqual(overlaps, {(10, 20): [(1, 2)]})
+
+    def test_touching_intervals(self):
+        # An instance which starts as another ends does not overlap it
+        overlaps = conflicts.overlapping_instances([
+            (1, 10, 0, 9 * 60, 60),
+            (2, 20, 0, 10 * 60, 60),
+        ])
+        self.assertEqual(overlaps, {})
+
+    def test_same_shift(self):
+        # Instances of the same shift do not conflict with each other
+        overlaps = conflicts.overlapping_instances([
+            (1, 10, 0, 9 * 60, 120),
+            (2, 10, 0, 10 * 60, 60),
+        ])
+        self.assertEqual(overlaps, {})
+
+    def test_weekdays(self):
+        overlaps = conflicts.overlapping_instances([
+            (1, 10, 0, 9 * 60, 120),
+            (2, 20, 1, 9 * 60, 120),
+        ])
+        self.assertEqual(overlaps, {})
+
+    def test_lowest_shift_first(self):
+        overlaps = conflicts.overlapping_instances([
+            (1, 20, 2, 9 * 60, 120),
+            (2, 10, 2, 10 * 60, 60),
+            (3, 30, 2, 10 * 60 + 30, 60),
+        ])
+        self.assertEqual(overlaps, {(10, 20): [(2, 1)], (20, 30): [(1, 3)], (10, 30): [(2, 3)]})
+
+
+class ConflictReportTest(SimpleTestCase):
+    def setUp(self):
+        overlaps = {(10, 20): [(1, 2)]}
+        student_shifts = {100: {10, 20}, 200: {10, 30}}
+        self.report = conflicts.ConflictReport(overlaps, student_shifts, {10: 1, 20: 2, 30: 3})
+
+    def test_for_student(self):
+        self.assertEqual(self.report.for_student(100), [(10, 20, [(1, 2)])])
+        self.assertEqual(self.report.for_student(200), [])
+
+    def test_for_class_instance(self):
+        self.assertEqual(self.report.for_class_instance(2), {100: [(10, 20)]})
+        self.assertEqual(self.report.for_class_instance(3), {})
+
+
+class UtilizationTest(SimpleTestCase):
+    def test_merge_intervals(self):
+        rows = [
+            (1, 0, 9 * 60, 120),  # Double booked with the next (which ends earlier)
+            (1, 0, 10 * 60, 30),
+            (1, 0, 11 * 60, 60),  # Touches the first
+            (1, 0, 14 * 60, 60),
+            (1, 1, 9 * 60, 60),  # Another weekday
+            (2, 1, 9 * 60 + 30, 60),  # Another room
+        ]
+        self.assertEqual(list(utilization.merge_intervals(rows)), [
+            (1, 0, 9 * 60, 180),
+            (1, 0, 14 * 60, 60),
+            (1, 1, 9 * 60, 60),
+            (2, 1, 9 * 60 + 30, 60),
+        ])
+        self.assertEqual(list(utilization.merge_intervals([])), [])
+
+    def test_matrix(self):
+        rooms = [(1, 'A', 1, 'B1', None), (2, 'B', 1, 'B1', None)]
+        matrix = utilization.UtilizationMatrix(rooms, start=8 * 60, end=10 * 60, granularity=60)
+        matrix.add(1, 0, 8 * 60 + 30, 60)
+        matrix.add(1, 1, 7 * 60, 600)  # Cropped to the day
+        matrix.add(3, 0, 8 * 60, 60)  # Unknown room
+        self.assertEqual(matrix.slots, 2)
+        self.assertEqual(matrix.room_utilization(weekdays=2), {1: (60 + 120) / 240, 2: 0})
+        self.assertEqual(matrix.slot_utilization(weekdays=1), [[30 / 120, 30 / 120]])
+        self.assertEqual(matrix.group_utilization(lambda room: room[3], weekdays=2), {'B1': 180 / 240 / 2})
+
+
+class ScheduleLayoutTest(SimpleTestCase):
+    def test_columns(self):
+        layout = schedules.ScheduleLayout([
+            (0, 9 * 60, 120),
+            (0, 10 * 60, 60),  # Overlaps the first, so it goes to a second column
+            (0, 11 * 60, 60),  # Starts as the first ends, taking its column back
+            (0, 11 * 60, 30),  # Overlaps the previous, taking the second column
+        ])
+        self.assertEqual(layout.days[0], [[(2, 4, 0), (6, 2, 2)], [(4, 2, 1), (6, 1, 3)]])
+        self.assertEqual(layout.days[1:], [[]] * (schedules.WEEKDAYS - 1))
+        self.assertEqual(layout.end, 12 * 60)
+
+    def test_lowest_free_column(self):
+        layout = schedules.ScheduleLayout([
+            (2, 8 * 60, 60),
+            (2, 8 * 60, 120),
+            (2, 8 * 60, 60),
+            (2, 9 * 60, 60),  # The first and third columns are free, the first is taken
+        ])
+        self.assertEqual(layout.days[2], [[(0, 2, 0), (2, 2, 3)], [(0, 4, 1)], [(0, 2, 2)]])
+
+    def test_unsortable(self):
+        layout = schedules.ScheduleLayout([None, (5, 9 * 60, 60), (1, 9 * 60, 60)])
+        self.assertEqual(layout.unsortable, [0, 1])
+        self.assertEqual(layout.days[1], [[(2, 2, 2)]])
+
+    def test_compact(self):
+        layout = schedules.ScheduleLayout([(0, 9 * 60, 60), (1, 10 * 60, 60), None])
+        self.assertEqual(layout.compact([10, 20, 30]), {
+            'start': 9 * 60,
+            'row_minutes': schedules.ROW_MINUTES,
+            'rows': 4,
+            'columns': [1] * schedules.WEEKDAYS,
+            'events': [[0, 0, 0, 2, 0], [1, 0, 2, 2, 1]],
+            'unsortable': [2],
+            'ids': [10, 20, 30],
+        })
+
+    def test_compact_empty(self):
+        compact = schedules.ScheduleLayout([]).compact([])
+        self.assertEqual(compact['rows'], 0)
+        self.assertEqual(compact['events'], [])
+
+
+class OccurrencesTest(SimpleTestCase):
+    @staticmethod
+    def row(weekday=0, start=10 * 60, duration=90, disappeared=False, shift_disappeared=False,
+            date_from=date(2021, 3, 20), date_to=date(2021, 4, 5), period_from=None, period_to=None):
+        return (1, weekday, start, duration, 7, disappeared, shift_disappeared,
+                date_from, date_to, period_from, period_to)
+
+    def test_weekly(self):
+        result = list(occurrences._occurrences(self.row(), set()))
+        self.assertEqual([timezone.localtime(start).date() for start, _, _ in result],
+                         [date(2021, 3, 22), date(2021, 3, 29), date(2021, 4, 5)])
+        for start, end, room in result:
+            self.assertEqual(end - start, timedelta(minutes=90))
+            self.assertEqual(room, 7)
+
+    def test_daylight_saving(self):
+        # Lisbon switches to summer time on the 28th of March of 2021, occurrences keep their local time
+        result = list(occurrences._occurrences(self.row(), set()))
+        self.assertEqual({timezone.localtime(start).time() for start, _, _ in result}, {time(10)})
+        self.assertEqual([start.utcoffset() for start, _, _ in result],
+                         [timedelta(0), timedelta(hours=1), timedelta(hours=1)])
+
+    def test_holidays(self):
+        result = list(occurrences._occurrences(self.row(), {date(2021, 3, 29)}))
+        self.assertEqual([timezone.localtime(start).date() for start, _, _ in result],
+                         [date(2021, 3, 22), date(2021, 4, 5)])
+
+    def test_period_dates(self):
+        row = self.row(weekday=2, date_from=None, date_to=None,
+                       period_from=date(2021, 3, 1), period_to=date(2021, 3, 10))
+        result = list(occurrences._occurrences(row, set()))
+        self.assertEqual([timezone.localtime(start).date() for start, _, _ in result],
+                         [date(2021, 3, 3), date(2021, 3, 10)])
+
+    def test_nothing_to_occur(self):
+        self.assertEqual(list(occurrences._occurrences(self.row(disappeared=True), set())), [])
+        self.assertEqual(list(occurrences._occurrences(self.row(shift_disappeared=True), set())), [])
+        self.assertEqual(list(occurrences._occurrences(self.row(start=None), set())), [])
+        self.assertEqual(list(occurrences._occurrences(self.row(date_from=None), set())), [])
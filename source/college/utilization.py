@@ -0,0 +1,215 @@
+"""
+Room utilization statistics.
+
+The occupation of a period (the same shift instances :py:mod:`college.occupation` indexes) is accumulated into a
+flat room × weekday × slot matrix of occupied minutes, backed by an :py:class:`array.array`, from which the
+aggregates (utilization by room, building, room type and time slot) are sliced.
+Rows are streamed from the database as tuples, so that years of history can be reported without model instances.
+"""
+import logging
+from array import array
+
+from django.core.cache import cache
+from django.db.models import Q
+
+from college import models as m, occupation
+from college.choice_types import RoomType
+
+logger = logging.getLogger(__name__)
+
+#: Default slot length (minutes)
+SLOT_MINUTES = 60
+#: Weekdays which count towards the room capacity (Monday to Friday)
+WORKING_DAYS = 5
+#: Utilization under which a room is considered underused
+UNDERUSED_THRESHOLD = 0.2
+#: Types of the rooms meant for classes, which are reported even when unused
+TEACHING_ROOM_TYPES = (RoomType.CLASSROOM, RoomType.AUDITORIUM, RoomType.LABORATORY)
+#: Seconds a report is cached (reports are also dropped along with the occupation indexes)
+CACHE_TIMEOUT = 60 * 60 * 24
+
+
+class UtilizationMatrix:
+    """
+    Occupied minutes of each room, weekday and slot of a period.
+    """
+
+    def __init__(self, rooms, start=occupation.DAY_START, end=occupation.DAY_END, granularity=SLOT_MINUTES):
+        """
+        :param rooms: List of (room id, name, building id, building abbreviation, room type)
+        :param start: Start of the day (minutes since midnight)
+        :param end: End of the day (minutes since midnight)
+        :param granularity: Slot length (minutes)
+        """
+        self.rooms = rooms
+        self.start = start
+        self.end = end
+        self.granularity = granularity
+        self.slots = (end - start + granularity - 1) // granularity
+        self.room_rows = {room[0]: row for row, room in enumerate(rooms)}
+        self.row_size = 7 * self.slots
+        self.cells = array('H', bytes(2 * len(rooms) * self.row_size))
+
+    def add(self, room_id, weekday, start, duration):
+        """
+        Accounts for the occupation of a room during an interval, which must not overlap the others of the room
+        """
+        row = self.room_rows.get(room_id)
+        if row is None:
+            return
+        cells, granularity = self.cells, self.granularity
+        offset = row * self.row_size + weekday * self.slots
+        end = min(start + duration, self.end)
+        position = max(start, self.start)
+        while position < end:
+            slot = (position - self.start) // granularity
+            slot_end = min(self.start + (slot + 1) * granularity, end)
+            index = offset + slot
+            cells[index] += slot_end - position
+            position = slot_end
+
+    def room_utilization(self, weekdays=WORKING_DAYS):
+        """
+        :param weekdays: Number of weekdays (starting at Monday) which are accounted for
+        :return: Dictionary of {room id: occupied fraction}
+        """
+        capacity = weekdays * self.slots * self.granularity
+        span = weekdays * self.slots
+        return {room[0]: sum(self.cells[row * self.row_size:row * self.row_size + span]) / capacity
+                for row, room in enumerate(self.rooms)}
+
+    def slot_utilization(self, weekdays=WORKING_DAYS):
+        """
+        :param weekdays: Number of weekdays (starting at Monday) which are accounted for
+        :return: List with a list per weekday with the occupied fraction of each slot (across every room)
+        """
+        capacity = len(self.rooms) * self.granularity
+        if capacity == 0:
+            return [[0] * self.slots for _ in range(weekdays)]
+        return [[sum(self.cells[weekday * self.slots + slot::self.row_size]) / capacity for slot in range(self.slots)]
+                for weekday in range(weekdays)]
+
+    def group_utilization(self, key, weekdays=WORKING_DAYS):
+        """
+        :param key: Function which maps a room tuple into its group
+        :param weekdays: Number of weekdays (starting at Monday) which are accounted for
+        :return: Dictionary of {group: occupied fraction}
+        """
+        utilization = self.room_utilization(weekdays)
+        groups = dict()
+        for room in self.rooms:
+            groups.setdefault(key(room), []).append(utilization[room[0]])
+        return {group: sum(values) / len(values) for group, values in groups.items()}
+
+    def slot_time(self, slot):
+        return m.ShiftInstance.minutes_to_str(self.start + slot * self.granularity)
+
+
+def build(period, year, start=occupation.DAY_START, end=occupation.DAY_END, granularity=SLOT_MINUTES,
+          building=None):
+    """
+    Builds the utilization matrix of a period
+    :param period: Period of the class instances
+    :param year: Year of the class instances
+    :param start: Start of the day (minutes since midnight)
+    :param end: End of the day (minutes since midnight)
+    :param granularity: Slot length (minutes)
+    :param building: Id of the building whose rooms are accounted for (optional)
+    :return: :py:class:`UtilizationMatrix`
+    """
+    instances = m.ShiftInstance.objects \
+        .filter(shift__class_instance__period=period,
+                shift__class_instance__year=year,
+                start__lt=end) \
+        .exclude(Q(room=None) | Q(weekday=None) | Q(start=None) | Q(duration=None) | Q(disappeared=True))
+    rooms = m.Room.objects.filter(
+        Q(type__in=TEACHING_ROOM_TYPES, extinguished=False)
+        | Q(id__in=instances.values('room')))
+    if building is not None:
+        rooms = rooms.filter(building=building)
+        instances = instances.filter(room__building=building)
+    rooms = list(rooms
+                 .order_by('building', 'name')
+                 .values_list('id', 'name', 'building_id', 'building__abbreviation', 'type'))
+
+    matrix = UtilizationMatrix(rooms, start, end, granularity)
+    # Rows come sorted so that the overlapping (double booked) intervals of a room can be merged as they stream
+    rows = instances \
+        .order_by('room_id', 'weekday', 'start') \
+        .values_list('room_id', 'weekday', 'start', 'duration') \
+        .iterator()
+    count = 0
+    for room_id, weekday, interval_start, duration in merge_intervals(rows):
+        count += 1
+        matrix.add(room_id, weekday, interval_start, duration)
+    logger.debug(f"Built the utilization of {len(rooms)} rooms with {count} occupied intervals "
+                 f"in period {period} of {year}")
+    return matrix
+
+
+def merge_intervals(rows):
+    """
+    Merges the overlapping (double booked) intervals of each room as they stream
+    :param rows: Iterable of (room id, weekday, start, duration), sorted
+    :return: Generator of (room id, weekday, start, duration) of the disjoint occupied intervals
+    """
+    current = None  # (room id, weekday, start, end)
+    for room_id, weekday, start, duration in rows:
+        end = start + duration
+        if current is not None and current[:2] == (room_id, weekday) and start <= current[3]:
+            current = (room_id, weekday, current[2], max(current[3], end))
+            continue
+        if current is not None:
+            yield current[0], current[1], current[2], current[3] - current[2]
+        current = (room_id, weekday, start, end)
+    if current is not None:
+        yield current[0], current[1], current[2], current[3] - current[2]
+
+
+def report(period, year, granularity=SLOT_MINUTES, building=None, peaks=10):
+    """
+    :param period: Period of the class instances
+    :param year: Year of the class instances
+    :param granularity: Slot length (minutes)
+    :param building: Id of the building whose rooms are accounted for (optional)
+    :param peaks: Number of peak slots to list
+    :return: Dictionary with the utilization (as percentages) overall, by building, room type and time slot,
+        along with the peak slots and the underused rooms
+    """
+    cache_key = f'utilization_{period}_{year}_{granularity}_{building}_{peaks}_' \
+                f'{cache.get(occupation.VERSION_KEY, 0)}'
+    result = cache.get(cache_key)
+    if result is not None:
+        return result
+
+    matrix = build(period, year, granularity=granularity, building=building)
+    rooms = matrix.room_utilization()
+    slots = matrix.slot_utilization()
+    room_types = dict(RoomType.CHOICES)
+    peak_slots = sorted(((weekday, slot) for weekday in range(len(slots)) for slot in range(matrix.slots)),
+                        key=lambda key: slots[key[0]][key[1]], reverse=True)[:peaks]
+    result = {
+        'period': period,
+        'year': year,
+        'granularity': granularity,
+        'start': matrix.start,
+        'utilization': _percentage(sum(rooms.values()) / len(rooms) if rooms else 0),
+        'buildings': [{'id': building_id, 'abbreviation': abbreviation, 'utilization': _percentage(value)}
+                      for (building_id, abbreviation), value
+                      in matrix.group_utilization(lambda room: (room[2], room[3])).items()],
+        'room_types': [{'type': room_type, 'name': room_types.get(room_type), 'utilization': _percentage(value)}
+                       for room_type, value in matrix.group_utilization(lambda room: room[4]).items()],
+        'slots': [[_percentage(value) for value in weekday] for weekday in slots],
+        'peak_slots': [{'weekday': weekday, 'time': matrix.slot_time(slot),
+                        'utilization': _percentage(slots[weekday][slot])}
+                       for weekday, slot in peak_slots],
+        'underused': [{'id': room_id, 'name': name, 'building': abbreviation, 'utilization': _percentage(rooms[room_id])}
+                      for room_id, name, _, abbreviation, _ in matrix.rooms
+                      if rooms[room_id] < UNDERUSED_THRESHOLD],
+    }
+    cache.set(cache_key, result, timeout=CACHE_TIMEOUT)
+    return result
+
+
+def _percentage(fraction):
+    return round(fraction * 100, 1)
@@ -213,10 +213,6 @@ def student_view(request, student_id):
 def teacher_view(request, teacher_id):
     teacher = get_object_or_404(m.Teacher.objects.select_related('rank'), id=teacher_id)
     context = build_base_context(request)
-    shifts = teacher.shifts \
-        .filter(class_instance__year=settings.COLLEGE_YEAR, class_instance__period=settings.COLLEGE_PERIOD) \
-        .select_related('class_instance__parent') \
-        .exclude(disappeared=True).all()
     context['pcode'] = "c_teachers"
     context['title'] = teacher.name
     context['teacher'] = teacher
@@ -227,7 +223,6 @@ def teacher_view(request, teacher_id):
             .select_related('parent') \
             .distinct()
     context['reviews'] = teacher.reviews.all()
-    context['weekday_spans'], context['schedule'], context['unsortable'] = schedules.build_shifts_schedule(shifts)
     context['sub_nav'] = [
         {'name': 'Faculdade', 'url': reverse('college:index')},
         {'name': 'Professores', 'url': '#'},
@@ -491,7 +486,6 @@ def class_instance_shifts_view(request, instance_id):
         .order_by('shift_type', 'number') \
         .prefetch_related('instances__room__building') \
         .all()
-    context['weekday_spans'], context['schedule'], context['unsortable'] = schedules.build_shifts_schedule(shifts)
     context['shifts'] = shifts
     sub_nav = _class_instance_nav(instance)
     sub_nav.append({'name': 'Turnos', 'url': request.get_raw_uri()})
@@ -1194,7 +1188,7 @@ def room_view(request, room_id):
         .filter(shift__class_instance__year=settings.COLLEGE_YEAR,
                 shift__class_instance__period=settings.COLLEGE_PERIOD) \
         .exclude(disappeared=True) \
-        .all()
+        .select_related('shift__class_instance__parent', 'room__building')
     context = build_base_context(request)
     context['pcode'] = "c_campus_building_room"
     context['title'] = str(room)
@@ -1,170 +1,123 @@
 import hashlib
-import logging
-import traceback
-from io import StringIO
-
-from pdfminer import pdfparser, pdfdocument
-from pdfminer.converter import TextConverter, PDFPageAggregator
-from pdfminer.pdfdocument import PDFDocument
-from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
-from pdfminer.pdfpage import PDFPage
-from pdfminer.pdfparser import PDFParser
-from pdfminer.layout import LTFigure, LTImage, LAParams
-import fitz
-import pdfplumber
-from bs4 import UnicodeDammit
 
-logging.getLogger("pdfminer").setLevel(logging.WARNING)
+import fitz
 
 
-def parse(file_path, file_hash):
-    parser_data = {}
-    data = {
-        'parsers': parser_data
-    }
-    pymu_data = pymu_parse(file_path)
-    parser_data['pymu'] = {
-        'revision': 2020121,
-        'data': pymu_data
-    }
-    if pymu_data:
-        data['pages'] = list(map(lambda p: p['text'], pymu_data['pages']))
-        data['links'] = list(
-            set([link for page_links in map(lambda p: p['links'], pymu_data['pages']) for link in page_links]))
+#: Revision of each PyMuPDF stage, bumped whenever the output of the stage changes
+PYMU_STAGES = {
+    'text': 2021031,
+    'links': 2021031,
+    'toc': 2021031,
+    'content_hash': 2021031,
+    'visual_hash': 2021031,
+}
+#: Revision of the PyMuPDF parser as a whole (the newest of its stages)
+PYMU_REVISION = max(PYMU_STAGES.values())
+#: Stages which run unless told otherwise (the visual hash requires rendering every page)
+DEFAULT_STAGES = ('text', 'links', 'toc', 'content_hash')
+#: Zoom at which pages are rendered for the visual hash (a grayscale thumbnail tells pages apart just as well)
+VISUAL_HASH_ZOOM = 0.2
+#: Stages whose results are stored per page
+PAGE_STAGES = ('links', 'content_hash', 'visual_hash')
+
+
+def outdated_stages(meta, stages=DEFAULT_STAGES):
+    """
+    :param meta: Stored parse metadata (``File.meta``), if any
+    :param stages: Stages of interest
+    :return: List with the stages whose stored results are missing or were produced by an older revision
+    """
+    parsed = ((meta or {}).get('parsers') or {}).get('pymu') or {}
+    parsed_stages = parsed.get('stages') or {}
+    return [stage for stage in stages if parsed_stages.get(stage) != PYMU_STAGES[stage]]
+
+
+def parse(file_path, file_hash, meta=None, pages=None, stages=DEFAULT_STAGES):
+    """
+    Parses a PDF, opening it only once and running only the stages whose stored results are not current
+    :param file_path: Path of the file
+    :param file_hash: Hash of the file
+    :param meta: Stored parse metadata (``File.meta``), whose current stages are reused (optional)
+    :param pages: Stored page texts (``File.pages``), reused if the text stage is current (optional)
+    :param stages: Stages to run (see :py:data:`PYMU_STAGES`)
+    :return: Dictionary with the page texts, the links and the metadata of each parser, or None if the file
+        is not a readable PDF
+    """
+    stages = set(stages) | {'text'}  # Page texts are always part of the result
+    pending = set(outdated_stages(meta, stages))
+    if pages is None:
+        pending.add('text')
+    previous = ((meta or {}).get('parsers') or {}).get('pymu') or {}
+    previous_data = previous.get('data') or {}
+    previous_stages = {stage: revision for stage, revision in (previous.get('stages') or {}).items()
+                       if stage in stages and stage not in pending}
+
+    if pending:
+        try:
+            doc = fitz.open(file_path)
+        except RuntimeError:
+            return None
+        try:
+            pymu_data = pymu_parse(doc, pending, previous_data.get('pages'), previous_stages)
+        finally:
+            doc.close()
+        if pymu_data is None:
+            return None
+        if 'text' not in pending:
+            pymu_data.pop('texts')
+        else:
+            pages = pymu_data.pop('texts')
+        if 'toc' not in pending and 'toc' in previous_stages:
+            pymu_data['toc'] = previous_data.get('toc')
     else:
-        return None
-    plumber_data = pdfplumber_parse(file_path, file_hash)
-    parser_data['plumber'] = {
-        'revision': 2020121,
-        'data': plumber_data
-    }
-    return data
+        pymu_data = previous_data
 
-
-def pdfplumber_parse(file_path, file_hash):
-    pages = []
-    links = []
-
-    try:
-        with pdfplumber.open(file_path) as pdf:
-            meta = pdf.metadata
-            pages_cont = len(pdf.pages)
-            if pages_cont > 300:
-                return None
-            for i, page in enumerate(pdf.pages):
-                page_links = []
-                try:
-                    for link in page.hyperlinks:
-                        links.append(link['uri'])
-                        page_links.append(link['uri'])
-                except UnicodeDecodeError:
-                    pass
-                except Exception as e:
-                    print(f"Exception in page {i} of {file_hash}: {e}")
-                    traceback.print_exc()
-                # for image in page.images:
-                #     im = Image.frombytes(
-                #         mode="1",
-                #         data=image['stream'].get_data(),
-                #         size=image['srcsize'],
-                #         decoder_name='raw')
-                # page = page.dedupe_chars(tolerance=1)
-                text = page.extract_text()
-                if text is None:
-                    text = ''
-
-                pages.append({
-                    'text': text,
-                    'links': page_links,
-                    'width': int(page.width),
-                    'height': int(page.height)})
-            print(f"Ended processing {file_path}")
-    except pdfparser.PDFSyntaxError:
-        raise Exception(f"{file_hash} is not a PDF")  # TODO proper exception
-    except pdfdocument.PDFPasswordIncorrect:
-        return None
-    except Exception as e:
-        raise Exception(f"{file_hash} had exception {e}")  # TODO proper exception
-
-    return {
-        'pages': pages,
-        'links': links,
-        'meta': meta,
+    parsers = dict((meta or {}).get('parsers') or {})  # Results of other (older) parsers are kept
+    parsers['pymu'] = {
+        'revision': PYMU_REVISION,
+        'stages': {**previous_stages, **{stage: PYMU_STAGES[stage] for stage in pending}},
+        'data': pymu_data,
     }
-
-
-def pdfminer_parse(file_path, file_hash):
-    output_string = StringIO()
-    try:
-        with open(file_path, 'rb') as fp:
-            parser = PDFParser(fp)
-            doc = PDFDocument(parser)
-
-            laparams = LAParams()
-            rsrcmgr = PDFResourceManager(caching=True)
-            txt_device = TextConverter(rsrcmgr, output_string, codec='utf-8', laparams=laparams)
-            aggr_device = PDFPageAggregator(rsrcmgr, laparams=laparams)
-            txt_interpreter = PDFPageInterpreter(rsrcmgr, txt_device)
-            aggr_interpreter = PDFPageInterpreter(rsrcmgr, aggr_device)
-            from pdfminer.high_level import extract_pages
-            extract_pages("test.pdf")
-            for page in PDFPage.get_pages(fp, caching=True):
-                txt_interpreter.process_page(page)
-                aggr_interpreter.process_page(page)
-                layout = aggr_device.get_result()
-                # for element in layout:
-                #     if isinstance(element, LTImage):
-                #         print()
-                #     elif isinstance(element, LTFigure):
-                #         print()
-                # TODO Complete
-    except pdfparser.PDFSyntaxError:
-        print(f"{file_hash} is not a PDF")
-        return None
-
+    links = {link for page in pymu_data['pages'] for link in page.get('links', ())}
     return {
-        'text': output_string.getvalue(),
-        'meta': flatten_and_unicode(doc.info)
+        'parsers': parsers,
+        'pages': pages,
+        'links': sorted(links),
     }
 
 
-def pymu_parse(file_path):
-    try:
-        doc = fitz.open(file_path)
-    except RuntimeError:
-        return None
-
+def pymu_parse(doc, stages, previous_pages=None, reused=()):
+    """
+    Runs a set of stages over an open document
+    :param doc: PyMuPDF document
+    :param stages: Set of stages to run (see :py:data:`PYMU_STAGES`)
+    :param previous_pages: Stored page results (optional)
+    :param reused: Stages whose stored page results are carried over
+    :return: Dictionary with the page texts, the page results and the document metadata, or None if the document
+        is not a readable PDF
+    """
     if not doc.isPDF:
-        return
-
-    try:
-        toc = doc.get_toc()
-    except ValueError:
-        return
-    pages = []
-    for page in doc:
-        links = []
-        for link in page.getLinks():
-            uri = link.get('uri')
-            if uri:
-                links.append(uri)
-                continue
-
-            file = link.get('file')
-            if file:
-                links.append('file:' + file)
-                continue
-        pages.append({
-            'text': page.getText('text'),
-            # 'structure': page.getText('dict'),
-            'links': links,
-            # 'annotations': list(page.annots()),
-            'width': int(page.MediaBoxSize.x),
-            'height': int(page.MediaBoxSize.y),
-            'content_hash': hashlib.sha1(page.read_contents()).hexdigest(),
-            'visual_hash': hashlib.sha1(page.getPixmap().samples).hexdigest()})
+        return None
+    toc = None
+    if 'toc' in stages:
+        try:
+            toc = doc.get_toc()
+        except ValueError:
+            return None
+
+    reused = [stage for stage in PAGE_STAGES if stage in reused and stage not in stages]
+    texts, pages = [], []
+    for index, text, page in iter_pages(doc, stages):
+        if reused and previous_pages is not None and index < len(previous_pages):
+            previous = previous_pages[index]
+            for stage in reused:
+                if stage in previous:
+                    page[stage] = previous[stage]
+        texts.append(text)
+        pages.append(page)
 
     return {
+        'texts': texts,
         'pages': pages,
         'pages_count': doc.pageCount,
         'meta': doc.metadata,
@@ -172,30 +125,38 @@ def pymu_parse(file_path):
     }
 
 
-def flatten_and_unicode(data):
-    result = dict()
-    for subinfo in data:
-        for (key, value) in subinfo.items():
-            if isinstance(value, bytes):
-                try:
-                    unicode_value = UnicodeDammit(value).unicode_markup.strip()
-                except Exception as e:
-                    continue
-                if unicode_value != '':
-                    result[key] = unicode_value
-            elif isinstance(value, list):
-                unicode_value = []
-                if (all(map(lambda subval: isinstance(value, bytes), value))):
-                    for subval in value:
-                        try:
-                            unicode_subval = UnicodeDammit(subval).unicode_markup.strip()
-                            if unicode_subval != '':
-                                unicode_value.append(unicode_subval)
-                        except Exception as e:
-                            pass
-
-                if len(unicode_value) > 0:
-                    result[key] = unicode_value
-            # else:
-            #     print(f"Subinfo with an unknown type {value}")
-    return result
+def iter_pages(doc, stages=DEFAULT_STAGES):
+    """
+    Streams the results of the per page stages, one page at a time
+    :param doc: PyMuPDF document
+    :param stages: Stages to run (see :py:data:`PYMU_STAGES`)
+    :return: Generator of (page index, page text or None, dictionary with the page dimensions and stage results)
+    """
+    visual_matrix = fitz.Matrix(VISUAL_HASH_ZOOM, VISUAL_HASH_ZOOM)
+    for index, page in enumerate(doc):
+        result = {
+            'width': int(page.MediaBoxSize.x),
+            'height': int(page.MediaBoxSize.y)}
+        if 'links' in stages:
+            result['links'] = page_links(page)
+        if 'content_hash' in stages:
+            result['content_hash'] = hashlib.sha1(page.read_contents()).hexdigest()
+        if 'visual_hash' in stages:
+            pixmap = page.getPixmap(matrix=visual_matrix, colorspace=fitz.csGRAY, alpha=False)
+            result['visual_hash'] = hashlib.sha1(pixmap.samples).hexdigest()
+        yield index, page.getText('text') if 'text' in stages else None, result
+
+
+def page_links(page):
+    links = []
+    for link in page.getLinks():
+        uri = link.get('uri')
+        if uri:
+            links.append(uri)
+            continue
+
+        file = link.get('file')
+        if file:
+            links.append('file:' + file)
+            continue
+    return links
@@ -334,8 +334,14 @@ REWARDS = {
 
 CLIPY = {
     'host': "clipy:5000",
+    'timeout': 60,  # Seconds
+    'retries': 3,
+    'backoff': 1,  # Seconds, doubled after each retry
+    'pool_size': 20,
+    'concurrency': 10,
 }
 CLIPY_HOST = "clipy:5000"
+TRIGRAM_SEARCH = False  # Requires the pg_trgm Postgres extension
 CLIPY_MIN_UPDATE_MARGIN = 6  # Hours
 CLIPY_MIN_EXPLICIT_UPDATE_MARGIN = 5  # Minutes
 CLIPY_RECENT_YEAR_MARGIN = 2  # Years
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class SupernovaConfig(AppConfig):
     name = 'supernova'
+
+    def ready(self):
+        from supernova import calendars
+        calendars.connect_signals()
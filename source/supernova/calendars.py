@@ -0,0 +1,325 @@
+"""
+Schedule service, which assembles the schedule entries of users, teachers, class instances and buildings.
+
+The shift instances of the ongoing periods are tabled once (by shift) and that table is shared by every schedule.
+Cached data is keyed by version numbers, which get bumped whenever the underlying rows change:
+
+- The shift table version, by the synchronization and by shift (instance) edits.
+- The version of each user and group, by edits to their schedule entries.
+
+Schedules are therefore never stale, without having to shorten the cache timeouts.
+"""
+import datetime
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
+
+from college import models as college
+from groups import models as groups
+from users import models as users
+from users.utils import get_students
+
+#: Seconds a versioned cache entry is kept (they never get stale, so this only bounds the cache usage)
+CACHE_TIMEOUT = 60 * 60 * 24
+
+SHIFTS_VERSION_KEY = 'schedule_shifts_version'
+
+
+def _version(key):
+    return cache.get(key, 0)
+
+
+def _bump(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, timeout=None)
+    cache.set(f'{key}_timestamp', timezone.now(), timeout=None)
+
+
+def versions(user_id=None, group_ids=()):
+    """
+    :param user_id: Id of the user whose entries are included (optional)
+    :param group_ids: Ids of the groups whose entries are included
+    :return: Tuple with the versions of the shift table, user and groups and the time of their last invalidation
+    """
+    keys = [SHIFTS_VERSION_KEY]
+    if user_id is not None:
+        keys.append(f'schedule_user_{user_id}_version')
+    keys += [f'schedule_group_{group_id}_version' for group_id in sorted(group_ids)]
+    values = cache.get_many(keys + [f'{key}_timestamp' for key in keys])
+    timestamps = [values[f'{key}_timestamp'] for key in keys if f'{key}_timestamp' in values]
+    return tuple(values.get(key, 0) for key in keys), max(timestamps, default=None)
+
+
+def invalidate_shifts(*args, **kwargs):
+    """
+    Invalidates every shift based schedule. Accepts (and ignores) signal arguments.
+    """
+    _bump(SHIFTS_VERSION_KEY)
+
+
+def invalidate_user(user_id):
+    """
+    Invalidates the personal entries of a user
+    """
+    _bump(f'schedule_user_{user_id}_version')
+
+
+def invalidate_group(group_id):
+    """
+    Invalidates the entries of a group
+    """
+    _bump(f'schedule_group_{group_id}_version')
+
+
+def current_period_instance_ids():
+    """
+    :return: Ids of the ongoing period instances
+    """
+    today = datetime.date.today()
+    cache_key = f'schedule_periods_{today}'
+    period_ids = cache.get(cache_key)
+    if period_ids is None:
+        period_ids = sorted(college.PeriodInstance.objects
+                            .filter(date_from__lte=today, date_to__gte=today)
+                            .values_list('id', flat=True))
+        cache.set(cache_key, period_ids, timeout=CACHE_TIMEOUT)
+    return period_ids
+
+
+def shift_table():
+    """
+    :return: Dictionary of {shift id: [shift instance rows]} with every shift of the ongoing periods
+    """
+    period_ids = current_period_instance_ids()
+    cache_key = f"schedule_shifts_{_version(SHIFTS_VERSION_KEY)}_{'_'.join(map(str, period_ids))}"
+    table = cache.get(cache_key)
+    if table is None:
+        table = {shift_id: [] for shift_id in college.Shift.objects
+                 .filter(class_instance__period_instance__in=period_ids)
+                 .exclude(disappeared=True)
+                 .values_list('id', flat=True)}
+        table.update(_shift_rows(college.ShiftInstance.objects.filter(
+            shift__class_instance__period_instance__in=period_ids)))
+        cache.set(cache_key, table, timeout=CACHE_TIMEOUT)
+    return table
+
+
+def _shift_rows(shift_instances):
+    """
+    :param shift_instances: Queryset of shift instances
+    :return: Dictionary of {shift id: [shift instance rows]}
+    """
+    rows = defaultdict(list)
+    shift_instances = shift_instances \
+        .select_related('shift__class_instance__parent', 'room__building') \
+        .exclude(disappeared=True)
+    for instance in shift_instances:
+        shift = instance.shift
+        rows[shift.id].append({
+            'id': instance.id,
+            'period_instance': shift.class_instance.period_instance_id,
+            'type': shift.type_abbreviation,
+            'title': instance.title,
+            'short_title': instance.short_title,
+            'abbreviation': shift.long_abbreviation,
+            'weekday': instance.weekday,
+            'start': instance.start,
+            'time': None if instance.start is None else instance.start_str,
+            'end_time': None if instance.start is None or instance.duration is None else instance.end_str,
+            'duration': instance.duration,
+            'room': instance.room_id,
+            'building': None if instance.room is None else instance.room.building_id,
+            'location': None if instance.room is None else str(instance.room),
+            'url': shift.get_absolute_url(),
+        })
+    return rows
+
+
+def shift_rows(shift_ids):
+    """
+    :param shift_ids: Shift ids
+    :return: The shift instance rows of the shifts. Those of the ongoing periods come from the shared table.
+    """
+    table = shift_table()
+    shift_ids = set(shift_ids)
+    missing = shift_ids.difference(table)
+    rows = [row for shift_id in shift_ids.intersection(table) for row in table[shift_id]]
+    if missing:
+        rows += [row for shift_rows in _shift_rows(college.ShiftInstance.objects.filter(shift__in=missing)).values()
+                 for row in shift_rows]
+    return rows
+
+
+def _shift_entry(row, title='title'):
+    return {
+        'type': row['type'],
+        'title': row[title],
+        'weekday': row['weekday'],
+        'time': row['time'],
+        'duration': row['duration'],
+        'url': row['url'],
+    }
+
+
+def _periodic_entry(entry, entry_type):
+    return {
+        'id': entry.id,
+        'type': entry_type,
+        'title': entry.title,
+        'weekday': entry.weekday,
+        'time': entry.time,
+        'duration': entry.duration,
+        'start': entry.start_date,
+        'end': entry.end_date,
+    }
+
+
+def _once_entry(entry, entry_type):
+    return {
+        'id': entry.id,
+        'type': entry_type,
+        'title': entry.title,
+        'datetime': entry.datetime.isoformat().split('+')[0],
+        'duration': entry.duration,
+    }
+
+
+def user_entries(user):
+    """
+    :return: Tuple with the periodic and the one-time personal entries of a user
+    """
+    cache_key = f"schedule_user_entries_{user.id}_{_version(f'schedule_user_{user.id}_version')}"
+    entries = cache.get(cache_key)
+    if entries is None:
+        entries = (
+            [_periodic_entry(entry, 'U') for entry in users.SchedulePeriodic.objects.filter(user=user)],
+            [_once_entry(entry, 'U') for entry in users.ScheduleOnce.objects.filter(user=user)])
+        cache.set(cache_key, entries, timeout=CACHE_TIMEOUT)
+    return entries
+
+
+def group_entries(group_ids):
+    """
+    :return: Tuple with the periodic and the one-time entries of several groups
+    """
+    periodic, once = [], []
+    for group_id in group_ids:
+        cache_key = f"schedule_group_entries_{group_id}_{_version(f'schedule_group_{group_id}_version')}"
+        entries = cache.get(cache_key)
+        if entries is None:
+            entries = (
+                [_periodic_entry(entry, 'G') for entry in groups.SchedulePeriodic.objects.filter(group=group_id)],
+                [_once_entry(entry, 'G') for entry in groups.ScheduleOnce.objects.filter(group=group_id)])
+            cache.set(cache_key, entries, timeout=CACHE_TIMEOUT)
+        periodic += entries[0]
+        once += entries[1]
+    return periodic, once
+
+
+def user_shift_rows(students):
+    """
+    :param students: Students of a user
+    :return: The shift instance rows of the ongoing periods that the students are enrolled to
+    """
+    table = shift_table()
+    shift_ids = college.ShiftStudents.objects.filter(student__in=students).values_list('shift_id', flat=True)
+    return [row for shift_id in shift_ids if shift_id in table for row in table[shift_id]]
+
+
+def user_schedule(user):
+    """
+    :return: The periodic entries of a user: the shifts of the ongoing periods, personal and group entries
+    """
+    primary_students, _ = get_students(user)
+    entries = [_shift_entry(row) for row in user_shift_rows(primary_students)]
+    entries += user_entries(user)[0]
+    entries += group_entries(user.groups_custom.values_list('id', flat=True))[0]
+    return entries
+
+
+def user_calendar(user):
+    """
+    :return: Every entry of a user, both periodic and one-time, including the events of the enrolled classes
+    """
+    primary_students, _ = get_students(user)
+    entries = [_shift_entry(row) for row in user_shift_rows(primary_students)]
+    user_periodic, user_once = user_entries(user)
+    group_periodic, group_once = group_entries(user.groups_custom.values_list('id', flat=True))
+    entries += user_once + user_periodic + group_once + group_periodic
+    class_events = college.ClassInstanceEvent.objects \
+        .select_related('class_instance__parent') \
+        .filter(class_instance__enrollments__student__in=primary_students)
+    for event in class_events:
+        entries.append({
+            'type': 'CE',
+            'title': str(event),
+            'datetime': event.datetime_str,
+            'duration': event.duration if event.duration else 0,
+        })
+    return entries
+
+
+def group_calendar(group):
+    """
+    :return: Every entry of a group, both one-time and periodic
+    """
+    periodic, once = group_entries([group.id])
+    return once + periodic
+
+
+def teacher_schedule(teacher):
+    """
+    :return: The shifts of the ongoing periods that a teacher lectures
+    """
+    table = shift_table()
+    return [_shift_entry(row)
+            for shift_id in teacher.shifts.values_list('id', flat=True) if shift_id in table
+            for row in table[shift_id]]
+
+
+def class_instance_schedule(class_instance):
+    """
+    :return: The shifts of a class instance (from any period)
+    """
+    shift_ids = class_instance.shifts.exclude(disappeared=True).values_list('id', flat=True)
+    return [_shift_entry(row, title='abbreviation') for row in shift_rows(shift_ids)]
+
+
+def building_schedule(building):
+    """
+    :return: The shifts of the ongoing periods that happen in a building, formatted as calendar resource events
+    """
+    return [{
+        'resourceId': row['room'],
+        'title': row['short_title'],
+        'daysOfWeek': [(row['weekday'] + 1) % 7],  # Meant to aid fullcalendar, weekday shifted
+        'startTime': row['time'],
+        'endTime': row['end_time'],
+        'url': row['url'],
+    } for rows in shift_table().values() for row in rows
+        if row['building'] == building.id and row['weekday'] is not None]
+
+
+def connect_signals():
+    """
+    Invalidates the schedules whenever their rows are saved or deleted
+    """
+    for model in (college.Shift, college.ShiftInstance):
+        post_save.connect(invalidate_shifts, sender=model, dispatch_uid=f'schedule_{model.__name__}_save')
+        post_delete.connect(invalidate_shifts, sender=model, dispatch_uid=f'schedule_{model.__name__}_delete')
+
+    def user_entry_changed(instance, **_):
+        invalidate_user(instance.user_id)
+
+    def group_entry_changed(instance, **_):
+        invalidate_group(instance.group_id)
+
+    for model, receiver in ((users.ScheduleOnce, user_entry_changed), (users.SchedulePeriodic, user_entry_changed),
+                            (groups.ScheduleOnce, group_entry_changed), (groups.SchedulePeriodic, group_entry_changed)):
+        uid = f'schedule_{model._meta.label}'
+        post_save.connect(receiver, sender=model, weak=False, dispatch_uid=f'{uid}_save')
+        post_delete.connect(receiver, sender=model, weak=False, dispatch_uid=f'{uid}_delete')
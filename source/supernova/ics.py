@@ -0,0 +1,307 @@
+"""
+iCalendar (RFC 5545) feeds of the schedules assembled by :py:mod:`supernova.calendars`.
+
+Periodic entries are expanded with weekly recurrence rules, bounded by the dates of their period instance
+(shifts) or by their own start and end dates (personal and group entries).
+Local times refer to settings.TIME_ZONE, whose VTIMEZONE is derived from the time zone database.
+Feeds are generated line by line, to be streamed, and are conditioned by an ETag which only changes when
+the schedule versions (or the last save of the scheduled entity) change, so that polling clients mostly get 304s.
+"""
+import calendar
+import datetime
+from functools import lru_cache
+from hashlib import sha1
+from zoneinfo import ZoneInfo
+
+from django.conf import settings
+from django.utils.crypto import salted_hmac, constant_time_compare
+
+from college import models as college
+from supernova import calendars
+from users.utils import get_students
+
+PRODID = '-//Supernova//Calendar//PT'
+WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+#: Maximum length of a content line (octets, excluding the line break)
+LINE_LENGTH = 75
+
+TOKEN_SALT = 'supernova.ics.feed'
+
+
+def feed_token(user):
+    """
+    :param user: User
+    :return: Token which grants access to the calendar feed of a user (for clients which can't authenticate)
+    """
+    return salted_hmac(TOKEN_SALT, user.id).hexdigest()[:32]
+
+
+def valid_token(user, token):
+    return token is not None and constant_time_compare(feed_token(user), token)
+
+
+def conditions(last_save=None, user_id=None, group_ids=()):
+    """
+    :param last_save: Last save of the scheduled entities (optional)
+    :param user_id: Id of the user whose entries are part of the feed (optional)
+    :param group_ids: Ids of the groups whose entries are part of the feed
+    :return: Tuple with the ETag and the last modification datetime (or None) of a feed
+    """
+    versions, invalidated = calendars.versions(user_id=user_id, group_ids=group_ids)
+    state = (versions, calendars.current_period_instance_ids(), last_save)
+    etag = sha1(repr(state).encode()).hexdigest()
+    return etag, max(filter(None, (last_save, invalidated)), default=None)
+
+
+def user_feed(user, base_url=''):
+    """
+    :param user: User
+    :param base_url: Prefix of the event urls (scheme and host)
+    :return: Generator with the lines of the feed of every entry of a user
+    """
+    primary_students, _ = get_students(user)
+    user_periodic, user_once = calendars.user_entries(user)
+    group_periodic, group_once = calendars.group_entries(user.groups_custom.values_list('id', flat=True))
+    events = college.ClassInstanceEvent.objects \
+        .select_related('class_instance__parent') \
+        .filter(class_instance__enrollments__student__in=primary_students)
+    return _calendar(
+        f'Supernova - {user.nickname}',
+        _shift_events(calendars.user_shift_rows(primary_students), base_url),
+        _entry_events(user_periodic + group_periodic + user_once + group_once),
+        _class_events(events))
+
+
+def group_feed(group):
+    """
+    :param group: Group
+    :return: Generator with the lines of the feed of the entries of a group
+    """
+    periodic, once = calendars.group_entries([group.id])
+    return _calendar(f'Supernova - {group.abbreviation}', _entry_events(periodic + once))
+
+
+def class_instance_feed(class_instance, base_url=''):
+    """
+    :param class_instance: Class instance
+    :param base_url: Prefix of the event urls (scheme and host)
+    :return: Generator with the lines of the feed of the shifts and events of a class instance
+    """
+    shift_ids = class_instance.shifts.exclude(disappeared=True).values_list('id', flat=True)
+    events = college.ClassInstanceEvent.objects \
+        .select_related('class_instance__parent') \
+        .filter(class_instance=class_instance)
+    return _calendar(
+        f'Supernova - {class_instance}',
+        _shift_events(calendars.shift_rows(shift_ids), base_url),
+        _class_events(events))
+
+
+def room_feed(room, base_url=''):
+    """
+    :param room: Room
+    :param base_url: Prefix of the event urls (scheme and host)
+    :return: Generator with the lines of the feed of the ongoing shifts which happen in a room
+    """
+    rows = [row for rows in calendars.shift_table().values() for row in rows if row['room'] == room.id]
+    return _calendar(f'Supernova - {room}', _shift_events(rows, base_url))
+
+
+def _calendar(name, *events):
+    """
+    :param name: Calendar name
+    :param events: Iterables of event line generators
+    :return: Generator with the (folded) lines of a calendar
+    """
+    header = ('BEGIN:VCALENDAR', 'VERSION:2.0', f'PRODID:{PRODID}', 'CALSCALE:GREGORIAN',
+              f'X-WR-CALNAME:{_escape(name)}', f'X-WR-TIMEZONE:{settings.TIME_ZONE}')
+    yield from map(_fold, header)
+    yield from map(_fold, _timezone(settings.TIME_ZONE, datetime.date.today().year))
+    for event_group in events:
+        for event in event_group:
+            yield from map(_fold, event)
+    yield _fold('END:VCALENDAR')
+
+
+def _shift_events(rows, base_url):
+    """
+    :param rows: Shift instance rows (see :py:func:`supernova.calendars.shift_table`)
+    :return: Generator of events, each recurring weekly through the period instance of its shift
+    """
+    rows = [row for row in rows if None not in (row['weekday'], row['start'], row['duration'])]
+    periods = {period.id: period for period in college.PeriodInstance.objects
+               .filter(id__in={row['period_instance'] for row in rows})
+               .exclude(date_from=None)
+               .exclude(date_to=None)}
+    for row in rows:
+        period = periods.get(row['period_instance'])
+        if period is None:
+            continue
+        first_day = _next_weekday(period.date_from, row['weekday'])
+        start = datetime.datetime.combine(first_day, datetime.time(row['start'] // 60, row['start'] % 60))
+        yield _event(
+            f"shift-instance-{row['id']}@supernova",
+            row['title'],
+            start,
+            duration=row['duration'],
+            rule=f"FREQ=WEEKLY;BYDAY={WEEKDAYS[row['weekday']]};UNTIL={period.date_to:%Y%m%d}T235959Z",
+            location=row['location'],
+            url=base_url + row['url'])
+
+
+def _entry_events(entries):
+    """
+    :param entries: Personal or group entries (see :py:func:`supernova.calendars.user_entries`)
+    :return: Generator of events, periodic entries recurring weekly from their start until their end (if any)
+    """
+    for entry in entries:
+        # Personal and group entries, periodic or not, are stored apart and have their own ids
+        uid = f"entry-{entry['type']}-{'periodic' if 'weekday' in entry else 'once'}-{entry['id']}@supernova"
+        if 'weekday' in entry:
+            start = datetime.datetime.combine(_next_weekday(entry['start'], entry['weekday']), entry['time'])
+            rule = f"FREQ=WEEKLY;BYDAY={WEEKDAYS[entry['weekday']]}"
+            if entry['end'] is not None:
+                rule += f";UNTIL={entry['end']:%Y%m%d}T235959Z"
+            yield _event(uid, entry['title'], start, duration=entry['duration'], rule=rule)
+        else:
+            # Stored in UTC, formatted without the offset
+            start = datetime.datetime.fromisoformat(entry['datetime']).replace(tzinfo=datetime.timezone.utc)
+            yield _event(uid, entry['title'], start, duration=entry['duration'])
+
+
+def _class_events(events):
+    """
+    :param events: Class instance events
+    :return: Generator of events, all day long when their time is unknown
+    """
+    for event in events:
+        start = event.date if event.time is None else datetime.datetime.combine(event.date, event.time)
+        yield _event(f'class-event-{event.id}@supernova', str(event), start, duration=event.duration)
+
+
+def _event(uid, summary, start, duration=None, rule=None, location=None, url=None):
+    """
+    :param uid: Unique (and persistent) identifier of the event
+    :param summary: Event title
+    :param start: Start date (all day event), local datetime (naive) or UTC datetime (aware)
+    :param duration: Duration in minutes (optional)
+    :param rule: Recurrence rule (optional)
+    :param location: Location (optional)
+    :param url: Absolute url (optional)
+    :return: Generator with the lines of an event
+    """
+    yield 'BEGIN:VEVENT'
+    yield f'UID:{uid}'
+    yield f'DTSTAMP:{datetime.datetime.now(datetime.timezone.utc):%Y%m%dT%H%M%SZ}'
+    if not isinstance(start, datetime.datetime):
+        yield f'DTSTART;VALUE=DATE:{start:%Y%m%d}'
+    elif start.tzinfo is None:
+        yield f'DTSTART;TZID={settings.TIME_ZONE}:{start:%Y%m%dT%H%M%S}'
+    else:
+        yield f'DTSTART:{start.astimezone(datetime.timezone.utc):%Y%m%dT%H%M%SZ}'
+    if duration:
+        yield f'DURATION:PT{duration}M'
+    if rule:
+        yield f'RRULE:{rule}'
+    yield f'SUMMARY:{_escape(summary)}'
+    if location:
+        yield f'LOCATION:{_escape(location)}'
+    if url:
+        yield f'URL:{url}'
+    yield 'END:VEVENT'
+
+
+@lru_cache(maxsize=4)
+def _timezone(name, year):
+    """
+    :param name: Time zone name
+    :param year: Year whose daylight saving transitions become the yearly rules of the time zone
+    :return: Tuple with the lines of the VTIMEZONE of a time zone
+    """
+    zone = ZoneInfo(name)
+    lines = ['BEGIN:VTIMEZONE', f'TZID:{name}']
+    transitions = _transitions(zone, year)
+    if not transitions:
+        moment = datetime.datetime(year, 1, 1, tzinfo=datetime.timezone.utc).astimezone(zone)
+        offset = _offset(moment.utcoffset())
+        lines += ['BEGIN:STANDARD', 'DTSTART:19700101T000000', f'TZOFFSETFROM:{offset}', f'TZOFFSETTO:{offset}',
+                  f'TZNAME:{moment.tzname()}', 'END:STANDARD']
+    for moment, offset_from in transitions:
+        local = moment.astimezone(zone)
+        # Transitions are described in the local time that precedes them
+        before = (moment + offset_from).replace(tzinfo=None)
+        week = -1 if before.day + 7 > calendar.monthrange(year, before.month)[1] else (before.day - 1) // 7 + 1
+        component = 'DAYLIGHT' if local.dst() else 'STANDARD'
+        first = _nth_weekday(1970, before.month, before.weekday(), week)
+        lines += [f'BEGIN:{component}',
+                  f'DTSTART:{datetime.datetime.combine(first, before.time()):%Y%m%dT%H%M%S}',
+                  f'RRULE:FREQ=YEARLY;BYMONTH={before.month};BYDAY={week}{WEEKDAYS[before.weekday()]}',
+                  f'TZOFFSETFROM:{_offset(offset_from)}',
+                  f'TZOFFSETTO:{_offset(local.utcoffset())}',
+                  f'TZNAME:{local.tzname()}',
+                  f'END:{component}']
+    lines.append('END:VTIMEZONE')
+    return tuple(lines)
+
+
+def _transitions(zone, year):
+    """
+    :return: List with the (UTC datetime, previous offset) of the offset changes of a time zone during a year
+    """
+    transitions = []
+    moment = datetime.datetime(year, 1, 1, tzinfo=datetime.timezone.utc)
+    offset = moment.astimezone(zone).utcoffset()
+    while moment.year == year:
+        following = moment + datetime.timedelta(hours=1)
+        following_offset = following.astimezone(zone).utcoffset()
+        if following_offset != offset:
+            transitions.append((following, offset))
+            offset = following_offset
+        moment = following
+    return transitions
+
+
+def _nth_weekday(year, month, weekday, week):
+    """
+    :param week: Week of the month (starting at 1), or -1 for the last one
+    :return: The date of the nth weekday (0 is Monday) of a month
+    """
+    days = calendar.monthrange(year, month)[1]
+    if week == -1:
+        last = datetime.date(year, month, days)
+        return last - datetime.timedelta(days=(last.weekday() - weekday) % 7)
+    return _next_weekday(datetime.date(year, month, 1), weekday) + datetime.timedelta(weeks=week - 1)
+
+
+def _offset(delta):
+    minutes = int(delta.total_seconds()) // 60
+    return f"{'-' if minutes < 0 else '+'}{abs(minutes) // 60:02d}{abs(minutes) % 60:02d}"
+
+
+def _next_weekday(date, weekday):
+    """
+    :return: The first date, starting at a given date, that happens at a weekday (0 is Monday)
+    """
+    return date + datetime.timedelta(days=(weekday - date.weekday()) % 7)
+
+
+def _escape(text):
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def _fold(line):
+    """
+    :return: A content line, split in lines of up to LINE_LENGTH octets (without breaking characters)
+    """
+    encoded = line.encode()
+    if len(encoded) <= LINE_LENGTH:
+        return line + '\r\n'
+    parts = []
+    start, limit = 0, LINE_LENGTH
+    while start < len(encoded):
+        end = min(start + limit, len(encoded))
+        while end < len(encoded) and encoded[end] & 0xC0 == 0x80:  # UTF-8 continuation byte
+            end -= 1
+        parts.append(encoded[start:end].decode())
+        start, limit = end, LINE_LENGTH - 1  # Continuation lines start with a space
+    return '\r\n '.join(parts) + '\r\n'
@@ -0,0 +1,80 @@
+from django.test import SimpleTestCase
+
+from supernova import ics
+from supernova.utils import trigrams, name_similarity, NameIndex
+
+
+class NameSimilarityTest(SimpleTestCase):
+    def test_trigrams(self):
+        self.assertEqual(trigrams("Ana"), {'  a', ' an', 'ana', 'na '})
+        self.assertEqual(trigrams("  "), set())
+
+    def test_similarity(self):
+        # Case, accents and punctuation are irrelevant
+        self.assertEqual(name_similarity("José Conceição", "jose conceicao"), 1.0)
+        self.assertEqual(name_similarity("João M. Silva", "joao m silva"), 1.0)
+        similar = name_similarity("João Silva", "Joana Silva")
+        self.assertGreater(similar, 0.5)
+        self.assertLess(similar, 1.0)
+        self.assertEqual(name_similarity("Ana", "Rui"), 0.0)
+        self.assertEqual(name_similarity("", "Rui"), 0.0)
+
+    def test_symmetry(self):
+        self.assertEqual(name_similarity("João Silva", "Joana Silva"), name_similarity("Joana Silva", "João Silva"))
+
+
+class NameIndexTest(SimpleTestCase):
+    def setUp(self):
+        self.index = NameIndex([("João Manuel Silva", 1), ("Maria Santos", 2)])
+
+    def test_match(self):
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.index.match("joao m. silva"), 1)
+        self.assertEqual(self.index.match("Maria dos Santos"), 2)
+        self.assertIsNone(self.index.match("Pedro"))
+
+    def test_threshold(self):
+        self.assertIsNone(self.index.match("Maria dos Santos", threshold=0.9))
+        self.assertEqual(self.index.match("Maria Santos", threshold=0.9), 2)
+
+    def test_scores(self):
+        scores = self.index.scores("Maria Santos")
+        self.assertEqual(scores[1], 1.0)
+        self.assertLess(scores[0], 0.2)
+        self.assertEqual(self.index.scores("Pedro"), {})
+
+    def test_additions_drop_the_cache(self):
+        self.assertIsNone(self.index.match("Pedro Costa"))
+        self.index.add("Pedro Costa", 3)
+        self.assertEqual(self.index.match("Pedro Costa"), 3)
+
+    def test_match_many(self):
+        self.assertEqual(self.index.match_many(["joao silva", "joao silva", "xyz"]), {'joao silva': 1, 'xyz': None})
+
+
+class FoldTest(SimpleTestCase):
+    def unfold(self, folded):
+        self.assertTrue(folded.endswith('\r\n'))
+        lines = folded[:-2].split('\r\n')
+        for line in lines:
+            self.assertLessEqual(len(line.encode()), ics.LINE_LENGTH)
+        for line in lines[1:]:
+            self.assertTrue(line.startswith(' '))
+        return lines[0] + ''.join(line[1:] for line in lines[1:])
+
+    def test_short(self):
+        self.assertEqual(ics._fold('SUMMARY:Aula'), 'SUMMARY:Aula\r\n')
+        line = 'X' * ics.LINE_LENGTH
+        self.assertEqual(ics._fold(line), line + '\r\n')
+
+    def test_long(self):
+        line = 'DESCRIPTION:' + 'a' * 200
+        folded = ics._fold(line)
+        self.assertEqual(self.unfold(folded), line)
+        self.assertEqual(len(folded.split('\r\n')[0]), ics.LINE_LENGTH)
+
+    def test_multibyte(self):
+        # Multibyte characters are never split between lines, whichever the offset they start at
+        for prefix in range(4):
+            line = 'SUMMARY:' + 'x' * prefix + 'Álgebra Linear e Geometria Analítica ção' * 5 + '€😀' * 20
+            self.assertEqual(self.unfold(ics._fold(line)), line)
@@ -1,3 +1,6 @@
+import re
+import unicodedata
+from collections import defaultdict
 from difflib import SequenceMatcher
 import diff_match_patch as dmp_module
 from math import log
@@ -44,6 +47,122 @@ def correlation(a: str, b: str):
     return SequenceMatcher(None, a, b).ratio()
 
 
+_non_alphanumeric_exp = re.compile(r'[^a-z0-9]+')
+
+
+def normalize_name(name: str):
+    """
+    Normalizes a name for comparisons, dropping case, accents and punctuation.
+    :param name: Name to normalize
+    :return: Normalized name
+    """
+    decomposed = unicodedata.normalize('NFKD', name)
+    ascii_name = ''.join(char for char in decomposed if not unicodedata.combining(char)).lower()
+    return _non_alphanumeric_exp.sub(' ', ascii_name).strip()
+
+
+def trigrams(name: str):
+    """
+    Splits a name in the set of its word trigrams, padded just like Postgres' pg_trgm does
+    :param name: Name to split
+    :return: Set of trigrams of the normalized name
+    """
+    result = set()
+    for word in normalize_name(name).split():
+        padded = f'  {word} '
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+def name_similarity(a: str, b: str):
+    """
+    Trigram similarity of two names (comparable to the pg_trgm similarity)
+    :param a: First name
+    :param b: Second name
+    :return: Similarity ratio between 0 and 1
+    """
+    a, b = trigrams(a), trigrams(b)
+    if not a or not b:
+        return 0.0
+    common = len(a & b)
+    return common / (len(a) + len(b) - common)
+
+
+class NameIndex:
+    """
+    | Index of names for fuzzy lookups by trigram similarity.
+    | Names are indexed by trigram, so a lookup only compares against the names which share trigrams with it.
+    """
+
+    def __init__(self, entries=()):
+        """
+        :param entries: Iterable of (name, value) pairs
+        """
+        self._values = []
+        self._sizes = []
+        self._postings = defaultdict(list)
+        self._cache = dict()
+        for name, value in entries:
+            self.add(name, value)
+
+    def __len__(self):
+        return len(self._values)
+
+    def add(self, name: str, value):
+        """
+        Indexes a value by its name
+        :param name: Name of the value
+        :param value: Value returned by the lookups
+        """
+        index = len(self._values)
+        name_trigrams = trigrams(name)
+        self._values.append(value)
+        self._sizes.append(len(name_trigrams))
+        for trigram in name_trigrams:
+            self._postings[trigram].append(index)
+        self._cache.clear()
+
+    def scores(self, name: str):
+        """
+        :param name: Name to look for
+        :return: Dictionary of {value index: similarity} with every indexed name similar to the provided one
+        """
+        name_trigrams = trigrams(name)
+        common = defaultdict(int)
+        for trigram in name_trigrams:
+            for index in self._postings.get(trigram, ()):
+                common[index] += 1
+        size = len(name_trigrams)
+        return {index: count / (size + self._sizes[index] - count) for index, count in common.items()}
+
+    def match(self, name: str, threshold: float = 0.0):
+        """
+        Finds the value whose name is the most similar to the provided one
+        :param name: Name to look for
+        :param threshold: Similarity that the match has to exceed
+        :return: The closest value or None if there is no match
+        """
+        if (name, threshold) in self._cache:
+            return self._cache[(name, threshold)]
+        scores = self.scores(name)
+        best = None
+        if scores:
+            index, similarity = max(scores.items(), key=lambda score: score[1])
+            if similarity > threshold:
+                best = self._values[index]
+        self._cache[(name, threshold)] = best
+        return best
+
+    def match_many(self, names, threshold: float = 0.0):
+        """
+        Finds the values whose names are the most similar to each of the provided ones
+        :param names: Iterable of names to look for
+        :param threshold: Similarity that the matches have to exceed
+        :return: Dictionary of {name: closest value or None}
+        """
+        return {name: self.match(name, threshold) for name in set(names)}
+
+
 class _diff_match_patch(dmp_module.diff_match_patch):
 
     def diff_prettyHtml(self, diffs):
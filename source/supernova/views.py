@@ -3,7 +3,7 @@ import random
 
 from django.contrib.auth.decorators import login_required
 from django.core.cache import cache
-from django.db.models import Q, F, Count
+from django.db.models import Count
 from django.shortcuts import render
 from django.urls import reverse
 from django.utils import timezone
@@ -13,7 +13,7 @@ from services.utils import get_next_meal_items
 from supernova import models as m
 from supernova import forms as f
 from news import models as news
-from college import models as college
+from college import models as college, occupation
 from groups import models as groups
 from learning import models as learning
 
@@ -43,17 +43,9 @@ def index(request):
     context['meal_items'], context['meal_date'], time = next_meal_items
     context['meal_name'] = 'Almoço' if time == 2 else 'Jantar'
 
-    free_rooms = cache.get('free_rooms')
-    if free_rooms is None:
-        free_rooms = college.Room.objects \
-            .annotate(shift_instances__end=F('shift_instances__start') + F('shift_instances__duration')) \
-            .filter(unlocked=True) \
-            .select_related('building') \
-            .order_by('building__abbreviation', 'name') \
-            .exclude(Q(shift_instances__start__lt=minutes + 5) & Q(shift_instances__end__gt=minutes)) \
-            .distinct('building__abbreviation', 'name')
-        cache.set('free_rooms', free_rooms, timeout=60)
-    context['free_rooms'] = random.sample(set(free_rooms), min(10, len(free_rooms))) if len(free_rooms) > 0 else []
+    free_rooms = occupation.free_rooms(
+        settings.COLLEGE_PERIOD, settings.COLLEGE_YEAR, now.weekday(), minutes, minutes + 5, unlocked=True)
+    context['free_rooms'] = random.sample(free_rooms, min(10, len(free_rooms)))
 
     metrics = cache.get('usage_metrics')
     if metrics is None:
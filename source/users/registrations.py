@@ -13,7 +13,7 @@ import jinja2
 
 import college.models as college
 import users.models as users
-from supernova.utils import correlation
+from supernova.utils import correlation, normalize_name
 from users import triggers
 from users.exceptions import InvalidToken, ExpiredRegistration, AccountExists
 from users.utils import calculate_points, award_user
@@ -102,8 +102,10 @@ def validate_token(email, token) -> users.User:
                 if registration.requested_student:
                     student_name = registration.requested_student.name
                 # Teacher email is known and matches or names are very very close
+                # (the threshold is that of the sequence correlation, trigram similarities are lower for the same names)
                 if registration.email == registration.requested_teacher.email or \
-                        (student_name and correlation(student_name, registration.requested_teacher.name) > 0.9):
+                        (student_name and correlation(normalize_name(student_name),
+                                                      normalize_name(registration.requested_teacher.name)) > 0.9):
                     triggers.teacher_assignment(user, registration.requested_teacher)
                 else:
                     # Do nothing, those need to be approved manually
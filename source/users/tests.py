@@ -200,3 +200,41 @@ class InviteRegistrationTest(TestCase):
         self.assertEquals(logged_user, created_user)
         self.assertEquals(page.url, reverse('users:profile', args=[created_user.nickname]))
         self.assertTrue(student in created_user.students.all())
+
+
+class CalendarFeedTest(TestCase):
+    def setUp(self):
+        self.user = m.User.objects.create(
+            nickname="feed_nick",
+            username="feed_user",
+            password="")
+        m.SchedulePeriodic.objects.create(
+            user=self.user,
+            title="Natação, piscina",
+            weekday=2,
+            time=datetime(2021, 1, 1, 18, 30).time(),
+            duration=60,
+            start_date=datetime(2021, 1, 1).date())
+
+    def test_feed(self):
+        from supernova import ics
+        client = Client()
+        url = reverse('api:user_calendar_feed', args=[self.user.nickname])
+        self.assertEqual(client.get(url).status_code, 404)
+        self.assertEqual(client.get(url, {'token': 'forged'}).status_code, 404)
+
+        response = client.get(url, {'token': ics.feed_token(self.user)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/calendar; charset=utf-8')
+        content = b''.join(response.streaming_content).decode()
+        self.assertTrue(content.startswith('BEGIN:VCALENDAR\r\n'))
+        self.assertIn('SUMMARY:Natação\\, piscina\r\n', content)
+        self.assertIn('RRULE:FREQ=WEEKLY;BYDAY=WE\r\n', content)
+        self.assertIn('DTSTART;TZID=Europe/Lisbon:20210106T183000\r\n', content)
+        self.assertIn('BEGIN:VTIMEZONE\r\nTZID:Europe/Lisbon\r\n', content)
+        self.assertIn('RRULE:FREQ=YEARLY;BYMONTH=3;BYDAY=-1SU\r\n', content)
+        entry = m.SchedulePeriodic.objects.get(user=self.user)
+        self.assertIn(f'UID:entry-U-periodic-{entry.id}@supernova\r\n', content)
+
+        response = client.get(url, {'token': ics.feed_token(self.user)}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
@@ -16,6 +16,7 @@ from users import forms as f
 from users import registrations, exceptions
 from college import models as college
 from college import schedules
+from supernova import ics
 from supernova.views import build_base_context
 from .utils import get_students, get_user_stats
 
@@ -242,6 +243,8 @@ def user_calendar_view(request, nickname):
     context = build_base_context(request)
     user = get_object_or_404(m.User.objects, nickname=nickname)
     context['profile_user'] = user
+    context['feed_url'] = request.build_absolute_uri(
+        reverse('api:user_calendar_feed', args=[nickname]) + f'?token={ics.feed_token(user)}')
     context['pcode'] = "u_calendar"
     context['title'] = "Calendário de " + nickname
     context['sub_nav'] = [